@@ -0,0 +1,114 @@
+"""
+Lambda 関数のコールドスタート時の import 時間を計測する
+
+`python -X importtime` で app モジュールを import し、モジュールごとの import 時間
+(累積)を集計して表示する。--max-ms を指定した場合、合計が閾値を超えると終了コード 1 を返す。
+
+[Example]
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --env WEBHOOK_RAW_PASSTHROUGH=true --max-ms 150
+    python benchmarks/import_time.py --app-dir processor --top 30
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app モジュールの import 時に必須の環境変数(ダミー値)
+DUMMY_ENV = {
+    "LINE_CHANNEL_SECRET": "dummy",
+    "LINE_CHANNEL_ACCESS_TOKEN": "dummy",
+    "SQS_QUEUE_URL": "dummy",
+    "AWS_DEFAULT_REGION": "ap-northeast-1",
+}
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def measure(app_dir, code, env):
+    """
+    別プロセスで code を実行し、モジュールごとの import 時間を返却する
+
+    Returns:
+        dict: {モジュール名: (self [us], cumulative [us])}
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=app_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit("Failed to run %r in %s" % (code, app_dir))
+    timings = {}
+    for line in result.stderr.splitlines():
+        matched = IMPORTTIME_LINE.match(line)
+        if matched:
+            self_us, cumulative_us, _, name = matched.groups()
+            timings[name] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--app-dir", default="webhook", help="Lambda 関数のディレクトリ"
+    )
+    parser.add_argument("--module", default="app", help="import するモジュール")
+    parser.add_argument("--repeat", type=int, default=5, help="計測回数(中央値を表示)")
+    parser.add_argument("--top", type=int, default=15, help="表示するモジュール数")
+    parser.add_argument(
+        "--env", action="append", default=[], help="追加の環境変数 (KEY=VALUE)"
+    )
+    parser.add_argument(
+        "--max-ms", type=float, default=None, help="合計 import 時間の上限 [ms]"
+    )
+    args = parser.parse_args()
+
+    app_dir = os.path.join(ROOT_DIR, args.app_dir)
+    env = dict(os.environ)
+    env.update(DUMMY_ENV)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    # インタプリタの起動時に import されるモジュールは集計から除く
+    startup = set(measure(app_dir, "pass", env))
+    runs = [
+        measure(app_dir, "import %s" % args.module, env) for _ in range(args.repeat)
+    ]
+    names = set().union(*runs) - startup
+    median = {}
+    for name in names:
+        samples = [run[name] for run in runs if name in run]
+        median[name] = (
+            statistics.median(s[0] for s in samples),
+            statistics.median(s[1] for s in samples),
+        )
+
+    total_us = median[args.module][1]
+    print("%-50s %12s %12s" % ("module", "self [ms]", "cumul [ms]"))
+    for name, (self_us, cumulative_us) in sorted(
+        median.items(), key=lambda item: item[1][1], reverse=True
+    )[: args.top]:
+        print("%-50s %12.1f %12.1f" % (name, self_us / 1000, cumulative_us / 1000))
+    print("%-50s %12s %12.1f" % ("TOTAL", "", total_us / 1000))
+
+    if args.max_ms is not None and total_us / 1000 > args.max_ms:
+        print(
+            "[ERROR] import time %.1f ms exceeds %.1f ms"
+            % (total_us / 1000, args.max_ms)
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+processor の SQS イベント処理のスループットを、同期版と asyncio 版 (PROCESSOR_ASYNC) で比較する
+
+DynamoDB, OpenAI, LINE の呼び出しを指定した時間だけ待つダミーに置き換え、
+複数のトークルームのテキストメッセージを含む SQS イベントを処理する時間と、OpenAI の応答待ちの間に存在したスレッド数の最大値を表示する。
+
+[Example]
+    python benchmarks/processor_throughput.py
+    python benchmarks/processor_throughput.py --records 50 --rooms 50 --concurrency 50 --openai-ms 3000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from unittest import mock
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "processor"
+    ),
+)
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "dummy")
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+
+import app  # noqa: E402
+
+
+def create_event(records: int, rooms: int) -> dict:
+    return {
+        "Records": [
+            {
+                "messageId": "m%d" % i,
+                "eventSource": "aws:sqs",
+                "attributes": {"MessageGroupId": "g%d" % (i % rooms)},
+                "body": json.dumps(
+                    {"event_type": "text_message", "line_event": {"replyToken": "t"}}
+                ),
+            }
+            for i in range(records)
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=10, help="レコード数")
+    parser.add_argument("--rooms", type=int, default=10, help="トークルーム数")
+    parser.add_argument("--concurrency", type=int, default=10, help="最大並列数")
+    parser.add_argument(
+        "--dynamodb-ms", type=float, default=20, help="DynamoDB の応答時間"
+    )
+    parser.add_argument(
+        "--openai-ms", type=float, default=1000, help="OpenAI の応答時間"
+    )
+    parser.add_argument("--line-ms", type=float, default=100, help="LINE の応答時間")
+    args = parser.parse_args()
+
+    dynamodb_sec = args.dynamodb_ms / 1000
+    openai_sec = args.openai_ms / 1000
+    line_sec = args.line_ms / 1000
+    max_threads = [0]
+    chatgpt = mock.Mock()
+    history = mock.Mock(get_response_message_content=lambda: "answer")
+
+    def prepare_text_message_event(line_event, system_message="", local=False):
+        time.sleep(dynamodb_sec * 3)  # 投稿の保存、履歴の取得、同じリクエストの検索
+        return None, chatgpt, None
+
+    def save_chatgpt_request_history(talk_room_history, chatgpt, error_message=None):
+        time.sleep(dynamodb_sec)
+        return history
+
+    def send(timeout=None, on_chunk=None):
+        max_threads[0] = max(max_threads[0], threading.active_count())
+        time.sleep(openai_sec)
+        return True
+
+    async def asend(timeout=None):
+        max_threads[0] = max(max_threads[0], threading.active_count())
+        await asyncio.sleep(openai_sec)
+        return True
+
+    def reply_text_message(line_event, text_message, quick_reply=None):
+        time.sleep(line_sec)
+
+    async def async_reply_text_message(
+        self, line_event, text_message, quick_reply=None
+    ):
+        await asyncio.sleep(line_sec)
+
+    chatgpt.send = send
+    chatgpt.asend = asend
+    event = create_event(args.records, args.rooms)
+    with mock.patch.object(
+        app, "prepare_text_message_event", prepare_text_message_event
+    ), mock.patch.object(
+        app, "save_chatgpt_request_history", save_chatgpt_request_history
+    ), mock.patch.object(
+        app.Line, "reply_text_message", reply_text_message
+    ), mock.patch.object(
+        app.AsyncLine, "reply_text_message", async_reply_text_message
+    ), mock.patch.object(
+        app, "PROCESSOR_MAX_CONCURRENCY", args.concurrency
+    ):
+        for name, processor_async in (("sync", False), ("async", True)):
+            max_threads[0] = 0
+            with mock.patch.object(app, "PROCESSOR_ASYNC", processor_async):
+                start = time.perf_counter()
+                result = app.lambda_handler(event, None)
+                elapsed = time.perf_counter() - start
+            assert not result["batchItemFailures"], result
+            print(
+                "%-5s : %8.3f sec, %8.1f records/sec, %4d threads (max)"
+                % (name, elapsed, args.records / elapsed, max_threads[0])
+            )
+
+
+if __name__ == "__main__":
+    main()
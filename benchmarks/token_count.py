@@ -0,0 +1,94 @@
+"""
+ChatGpt オブジェクトの生成(トークン数の計算)にかかる時間を計測する
+
+過去のリクエスト(会話履歴)を含む ChatGpt オブジェクトの生成を繰り返し、1リクエストあたりの
+時間を表示する。"before" は count_tokens のたびに tiktoken.encoding_for_model を呼ぶ
+(エンコーディングをキャッシュしない)場合の時間。
+
+[Example]
+    python benchmarks/token_count.py
+    python benchmarks/token_count.py --history 50 --repeat 200 --model gpt-4
+"""
+
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "processor"
+    ),
+)
+
+import tiktoken  # noqa: E402
+from services import chatgpt  # noqa: E402
+from services.chatgpt import ChatGpt, ChatGptRole  # noqa: E402
+
+
+def create_past_request(history: int) -> list:
+    past_request = [
+        {"role": ChatGptRole.SYSTEM.value, "content": "You are the ChatGPT."}
+    ]
+    for i in range(history):
+        past_request.append(
+            {
+                "role": ChatGptRole.USER.value,
+                "content": "これは %d 番目の質問です。Please answer briefly." % i,
+            }
+        )
+        past_request.append(
+            {
+                "role": ChatGptRole.ASSISTANT.value,
+                "content": "これは %d 番目の回答です。" % i
+                + "Lorem ipsum dolor sit amet. " * 5,
+            }
+        )
+    return past_request
+
+
+def run(model: str, past_request: list, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        ChatGpt(
+            model_name=model,
+            max_tokens=1000000,
+            system_message="You are the ChatGPT.",
+            text_message="What is your favorite sport?",
+            past_request=past_request,
+        )
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="gpt-3.5-turbo", help="モデル名")
+    parser.add_argument("--history", type=int, default=20, help="過去の受け答えの数")
+    parser.add_argument("--repeat", type=int, default=100, help="計測回数")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    chatgpt.get_encoding(args.model)
+    print(
+        "load encoding : %8.3f ms (first call only)"
+        % ((time.perf_counter() - start) * 1000)
+    )
+
+    past_request = create_past_request(args.history)
+
+    def count_tokens_without_cache(self, content):
+        if not content:
+            return 0
+        return len(tiktoken.encoding_for_model(self.model_name).encode(content))
+
+    with mock.patch.object(ChatGpt, "count_tokens", count_tokens_without_cache):
+        before = run(args.model, past_request, args.repeat)
+    after = run(args.model, past_request, args.repeat)
+    print("before        : %8.3f ms/request" % (before * 1000))
+    print("after         : %8.3f ms/request" % (after * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -65,10 +65,20 @@ parameter_overrides = [
   'OpenaiApiKey=$OPENAI_API_KEY',
   'OpenaiModelName=$OPENAI_MODEL_NAME',
   'OpenaiModelMaxTokens=$OPENAI_MODEL_MAX_TOKENS',
+  'OpenaiCompletionReservedTokens=${OPENAI_COMPLETION_RESERVED_TOKENS:-0}',
   'OpenaiChatGptSystemMessage=$OPENAI_CHAT_GPT_SYSTEM_MESSAGE',
   'OpenaiRequestTimeout=$OPENAI_REQUEST_TIMEOUT',
   'OpenaiRequestTimeoutErrorMessage=$OPENAI_REQUEST_TIMEOUT_ERROR_MESSAGE',
-  'QuickReply=$QUICK_REPLY'
+  'QuickReply=$QUICK_REPLY',
+  'OpenaiMaxRetries=${OPENAI_MAX_RETRIES:-3}',
+  'OpenaiHedgePercentile=${OPENAI_HEDGE_PERCENTILE:-0}',
+  'OpenaiStream=${OPENAI_STREAM:-false}',
+  'ProcessorMaxConcurrency=${PROCESSOR_MAX_CONCURRENCY:-10}',
+  'ProcessorAsync=${PROCESSOR_ASYNC:-false}',
+  'SemanticCacheThreshold=${SEMANTIC_CACHE_THRESHOLD:-0}',
+  'ConversationStore=${CONVERSATION_STORE:-request_history}',
+  'ConversationSummaryThresholdTokens=${CONVERSATION_SUMMARY_THRESHOLD_TOKENS:-0}',
+  'WebhookRawPassthrough=${WEBHOOK_RAW_PASSTHROUGH:-false}'
 ]
 image_repositories = ["LineBotWebhook=$AWS_ACCOUNT_ID.dkr.ecr.$AWS_REGION.amazonaws.com/$WEBHOOK_DOCKER_REPO_NAME", "LineBotProcessor=$AWS_ACCOUNT_ID.dkr.ecr.$AWS_REGION.amazonaws.com/$PROCESSOR_DOCKER_REPO_NAME"]
 EOS
@@ -1,13 +1,24 @@
 import os
 import json
+import asyncio
 import datetime
-import time
+import itertools
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from linebot.exceptions import LineBotApiError
 from common.logger_factory import LoggerFactory
+from common.delayed_task_queue import DelayedTaskQueue
+from common.deadline import Deadline
+from common.lru_cache import LruCache
+from common.semantic_cache import SemanticCache
+from models.db_client import DbClient
 from models.model_base import SortKeyComparison
 from models.talk_room_history import TalkRoomHistory
 from models.chat_gpt_request_history import ChatGptRequestHistory
-from services.line import Line
-from services.chatgpt import ChatGpt
+from models.conversation_turn import ConversationTurn
+from models.conversation_summary import ConversationSummary
+from services.line import Line, LineStreamReplier, AsyncLine
+from services.chatgpt import ChatGpt, ChatGptRole
 
 # ログ出力設定
 LOGGER_LEVEL = os.environ.get("LOGGER_LEVEL", "INFO")
@@ -23,6 +34,133 @@ OPENAI_REQUEST_TIMEOUT_ERROR_MESSAGE = (
     .replace("\\n", "\n")
 )
 
+# Lambda の残り時間のうち、最後のレコードの後処理(保存・返信)のために残しておく秒数
+PROCESSOR_DEADLINE_MARGIN_SEC = float(
+    os.environ.get("PROCESSOR_DEADLINE_MARGIN_SEC", 3)
+)
+
+# 残り時間がこの秒数未満の場合は、レコードの処理を始めずに失敗として返す(再処理させる)
+PROCESSOR_MIN_RECORD_SEC = float(os.environ.get("PROCESSOR_MIN_RECORD_SEC", 2))
+
+# ChatGPTの応答をストリーミングで受信し、生成途中から分割して返信する
+OPENAI_STREAM = os.environ.get("OPENAI_STREAM", "false").lower() == "true"
+
+# asyncio でレコードを処理する(OpenAI/LINE の応答待ちを他のトークルームの処理と重ねる)
+PROCESSOR_ASYNC = os.environ.get("PROCESSOR_ASYNC", "false").lower() == "true"
+
+# asyncio で処理する場合に、DynamoDB の呼び出しなどを実行するスレッドの最大数
+PROCESSOR_ASYNC_MAX_THREADS = int(os.environ.get("PROCESSOR_ASYNC_MAX_THREADS", 4))
+
+# 異なるトークルームのレコードを並列に処理する最大数
+PROCESSOR_MAX_CONCURRENCY = int(os.environ.get("PROCESSOR_MAX_CONCURRENCY", 10))
+
+# テキスト以外のメッセージに返信するまでの秒数
+NON_TEXT_MESSAGE_REPLY_DELAY_SEC = float(
+    os.environ.get("NON_TEXT_MESSAGE_REPLY_DELAY_SEC", 5)
+)
+
+# 同じ内容のリクエストへの応答(リクエスト履歴)を保持するキャッシュの最大バイト数(0 の場合は保持しない)
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 8388608))
+
+# requestId をキーに、リクエスト履歴のデータを保持する(GSI2 への問い合わせを省く)
+response_cache = LruCache(RESPONSE_CACHE_MAX_BYTES)
+
+# 会話履歴の無いリクエストで、ほぼ同じ内容の質問への応答を返す類似度(文字 n-gram の Jaccard 係数)の下限
+# (0 の場合は類似の質問への応答を返さない)
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 10000))
+# この文字数を超える質問は、類似の質問を探さない(類似度の計算が応答を遅らせないように)
+SEMANTIC_CACHE_MAX_TEXT_CHARS = int(
+    os.environ.get("SEMANTIC_CACHE_MAX_TEXT_CHARS", 500)
+)
+
+# システムメッセージと質問をキーに、リクエスト履歴のデータを保持する(OpenAI API の呼び出しを省く)
+semantic_cache = None
+if SEMANTIC_CACHE_THRESHOLD > 0:
+    semantic_cache = SemanticCache(
+        SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        max_text_chars=SEMANTIC_CACHE_MAX_TEXT_CHARS,
+        ttl=int(os.environ.get("REQUEST_KEEP_SEC", 604800)),  # type: ignore
+    )
+
+# 会話の保存先 ("request_history": リクエスト全体を ChatGptRequestHistory に保存する、
+# "turn_log": 受け答えを1件ずつ ConversationTurn に追記する)
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "request_history")
+
+# 受け答えの seq が他の処理と重複した場合に、保存を試みる最大回数
+CONVERSATION_TURN_MAX_ATTEMPTS = 3
+
+# CONVERSATION_STORE が "turn_log" の場合に、リクエストのトークン数がこの値を超えたら古い受け答えを要約する
+# (0 の場合は要約しない)
+CONVERSATION_SUMMARY_THRESHOLD_TOKENS = int(
+    os.environ.get("CONVERSATION_SUMMARY_THRESHOLD_TOKENS", 0)
+)
+
+# 要約せずに残す、新しい受け答えの数
+CONVERSATION_SUMMARY_KEEP_TURNS = int(
+    os.environ.get("CONVERSATION_SUMMARY_KEEP_TURNS", 4)
+)
+
+# 1回の要約に含める受け答えの最大数
+CONVERSATION_SUMMARY_MAX_TURNS = 50
+
+# 要約(応答)用に確保するトークン数(要約に含める受け答えは、残りのトークン数に収まる分だけ)
+CONVERSATION_SUMMARY_COMPLETION_TOKENS = int(
+    os.environ.get("CONVERSATION_SUMMARY_COMPLETION_TOKENS", 1024)
+)
+
+# 要約に使う ChatGPT の振る舞いの定義
+CONVERSATION_SUMMARY_SYSTEM_MESSAGE = os.environ.get(
+    "CONVERSATION_SUMMARY_SYSTEM_MESSAGE",
+    "Summarize the following conversation between the user and the assistant, "
+    "including the previous summary at the beginning if any, so that the assistant "
+    "can continue the conversation. Keep names, facts, the user's requests and "
+    "unanswered questions. Write the summary in the language of the conversation.",
+).strip("\"'")
+
+# 遅延させて返信するためのキュー(後続のレコードの処理を止めずに待つ)
+delayed_task_queue = DelayedTaskQueue()
+
+# 返信を待たせずに会話を要約するためのキュー(返信のキューとは別のスレッドで実行する)
+summary_task_queue = DelayedTaskQueue()
+
+# トークン数の計算に使う tiktoken のエンコーディングをコールドスタート時に読み込む
+try:
+    ChatGpt.preload_encoding()
+except Exception:
+    logger.warning("Failed to preload the tiktoken encoding", exc_info=True)
+
+
+class InvalidRecordError(Exception):
+    """SQSのレコードの本文が正しくない(再処理しても成功しない)"""
+
+
+def get_record_body(record) -> dict:
+    """SQSのレコードの本文(JSON)を返す。本文が正しくない場合は InvalidRecordError を送出する。"""
+    try:
+        body = json.loads(record["body"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidRecordError(
+            "Invalid record body: %s" % record.get("messageId")
+        ) from e
+    if not isinstance(body, dict):
+        raise InvalidRecordError("Invalid record body: %s" % record.get("messageId"))
+    return body
+
+
+def is_retriable_error(error: Exception) -> bool:
+    """レコードの処理で発生した例外が、再処理すれば成功する可能性のあるものの場合に True を返す。
+
+    レコードの本文が正しくない場合と、LINE Messaging API のクライアントエラー
+    (応答トークンの期限切れ等の 4xx。429 を除く)の場合は False を返す。
+    """
+    if isinstance(error, InvalidRecordError):
+        return False
+    if isinstance(error, LineBotApiError):
+        return not 400 <= error.status_code < 500 or error.status_code == 429
+    return True
+
 
 def is_message_event(event_body) -> bool:
     if event_body.get("event_type") == "text_message":
@@ -55,33 +193,50 @@ def get_quick_reply():
     return None
 
 
-def process_text_message_event(
-    line_event, system_message: str = "", local: bool = False
-) -> ChatGptRequestHistory | None:
-    """LINEイベント(テキストメッセージ)の処理。
-       テキストメッセージをChatGPTで処理し、処理結果を返す。
+def prepare_text_message_event(
+    line_event,
+    system_message: str = "",
+    local: bool = False,
+    deadline: Deadline | None = None,
+) -> tuple[TalkRoomHistory, ChatGpt, ChatGptRequestHistory | None]:
+    """LINEイベント(テキストメッセージ)を保存し、ChatGPTへのリクエストを準備する。
 
     Args:
         line_event: LINEイベント(テキストメッセージ)
          system_message: 空文字以外の場合に ChatGPT の振る舞いの定義に使われるメッセージ(テスト用)
          local: True の場合に DynamoDB Local を使用する(テスト用)
+         deadline: レコードの処理の期限(DynamoDB クライアントのタイムアウトに使う)
 
     Returns:
-        ChatGptRequestHistory: ChatGPTへのリクエスト履歴オプジェクト(処理結果含む)
+        tuple: トークルームの投稿、送信するリクエストを含む ChatGpt オブジェクト、
+            同じ内容のリクエストを送信済みの場合はそのリクエスト履歴(無ければ None)
     """
 
     # トークルームの投稿を DynamoDB に保存
-    talk_room_history = TalkRoomHistory.from_line_event(line_event, local=local)
+    db_client = None
+    if deadline:
+        db_client = DbClient.get_client(local=local, timeout=deadline.remaining())
+    talk_room_history = TalkRoomHistory.from_line_event(
+        line_event, local=local, db_client=db_client
+    )
     talk_room_history.save()
     text_message = talk_room_history.textMessage
 
     logger.info(talk_room_history.serialize())
 
-    past_time = datetime.datetime.now() - datetime.timedelta(
-        seconds=int(os.environ.get("REQUEST_KEEP_SEC", 604800))  # type: ignore
-    )
+    past_time = get_past_time()
+
+    if CONVERSATION_STORE == "turn_log":
+        # 送信用メッセージ一覧に今回のメッセージと、制限に収まる範囲の新しい受け答えを含む ChatGpt オブジェクトを生成
+        chatgpt = ChatGpt(system_message=system_message, text_message=text_message)
+        add_conversation_turns(chatgpt, talk_room_history, past_time)
+        return (
+            talk_room_history,
+            chatgpt,
+            find_cached_chatgpt_request_history(chatgpt, past_time, talk_room_history),
+        )
 
-    # ChatGPTへのリクエスト履歴を取得
+    # ChatGPTへのリクエスト履歴を取得(リクエストとトークン数だけを読む)
     past_chatgpt_request_histories = ChatGptRequestHistory.find(
         ChatGptRequestHistory.get_query(
             talk_room_history.talkRoomId,
@@ -89,126 +244,808 @@ def process_text_message_event(
             sort_key1=past_time.isoformat(),
             limit=1,
             reverse=True,
+            projection=["request", "tokenCounts"],
         ),
         db_client=talk_room_history.get_db_client(),
     )
     past_request = []
-    if len(past_chatgpt_request_histories) > 0:
+    past_request_tokens = None
+    if (
+        len(past_chatgpt_request_histories) > 0
+        and past_chatgpt_request_histories[0].request
+    ):
         past_chatgpt_request_history = past_chatgpt_request_histories[0]
         past_request = json.loads(past_chatgpt_request_history.request)
+        # 保存済みのトークン数があれば、過去のメッセージのトークン数を数え直さない
+        past_request_tokens = past_chatgpt_request_history.get_request_tokens()
 
     # 送信用メッセージ一覧に今回のメッセージと過去のリクエスト中のメッセージを含む ChatGpt オブジェクトを生成
     chatgpt = ChatGpt(
         system_message=system_message,
         text_message=text_message,
         past_request=past_request,
+        past_request_tokens=past_request_tokens,
+    )
+
+    return (
+        talk_room_history,
+        chatgpt,
+        find_cached_chatgpt_request_history(chatgpt, past_time, talk_room_history),
+    )
+
+
+def get_past_time() -> datetime.datetime:
+    """これより前の会話を参照しない日時 (REQUEST_KEEP_SEC 秒前) を返す。"""
+    return datetime.datetime.now() - datetime.timedelta(
+        seconds=int(os.environ.get("REQUEST_KEEP_SEC", 604800))  # type: ignore
+    )
+
+
+def add_conversation_turns(
+    chatgpt: ChatGpt,
+    talk_room_history: TalkRoomHistory,
+    past_time: datetime.datetime,
+):
+    """past_time 以降のトークルームの受け答えを、トークン数の制限に収まる範囲で新しいものから chatgpt に追加する。
+
+    会話の要約がある場合は要約を先に追加し、要約済みの受け答えは追加しない。
+    """
+    db_client = talk_room_history.get_db_client()
+    after_seq = 0
+    if CONVERSATION_SUMMARY_THRESHOLD_TOKENS > 0:
+        summary = find_conversation_summary(
+            talk_room_history.talkRoomId, past_time, db_client
+        )
+        if summary:
+            tokens = None
+            if summary.encoding == chatgpt.encoding.name:
+                tokens = summary.tokens
+            if chatgpt.add_summary(summary.summary, tokens):
+                after_seq = summary.lastSeq
+    turns = ConversationTurn.find_recent(
+        talk_room_history.talkRoomId,
+        past_time.isoformat(),
+        chatgpt.max_tokens - chatgpt.tokens,
+        chatgpt.count_tokens,
+        chatgpt.encoding.name,
+        db_client=db_client,
+        after_seq=after_seq,
+    )
+    messages, counts = ConversationTurn.to_request(turns)
+    chatgpt.add_past_request(
+        messages, {"encoding": chatgpt.encoding.name, "counts": counts}
+    )
+
+
+def find_conversation_summary(
+    talk_room_id: str, past_time: datetime.datetime, db_client: DbClient
+) -> ConversationSummary | None:
+    """past_time 以降に保存したトークルームの会話の要約を返す(無ければ None)。"""
+    summaries = ConversationSummary.find(
+        ConversationSummary.get_query(talk_room_id), db_client=db_client
     )
+    if len(summaries) > 0 and summaries[0].createdAt >= past_time.isoformat():
+        return summaries[0]
+    return None
+
+
+def summarize_conversation(
+    talk_room_id: str, db_client: DbClient
+) -> ConversationSummary | None:
+    """トークルームの古い受け答えを、それまでの要約とあわせて要約し直して保存する。
+
+    新しい CONVERSATION_SUMMARY_KEEP_TURNS 件の受け答えは要約せずに残す。
+    要約する受け答えが CONVERSATION_SUMMARY_MAX_TURNS 件を超える場合や、要約用に
+    CONVERSATION_SUMMARY_COMPLETION_TOKENS トークンを確保した残りに収まらない場合は、
+    古いものから収まる分だけを要約し、残りは次回の要約に回す
+    (1件目の受け答えだけで収まらない場合は、切り詰めて要約する)。
+    より新しい受け答えまで含む要約が先に保存された場合は保存しない。
+
+    Returns:
+        ConversationSummary: 保存した要約(要約する受け答えが無い場合、保存しなかった場合は None)
+    """
+    past_time = get_past_time()
+    summary = find_conversation_summary(talk_room_id, past_time, db_client)
+    after_seq = summary.lastSeq if summary else 0
+    last_seq = (
+        ConversationTurn.get_latest_seq(talk_room_id, db_client)
+        - CONVERSATION_SUMMARY_KEEP_TURNS
+    )
+    if last_seq <= after_seq:
+        return None
+    turns = ConversationTurn.find(
+        ConversationTurn.get_query(
+            talk_room_id,
+            SortKeyComparison.BETWEEN,
+            sort_key1=str(after_seq + 1),
+            sort_key2=str(last_seq),
+            limit=CONVERSATION_SUMMARY_MAX_TURNS,
+        ),
+        db_client=db_client,
+    )
+    chatgpt = ChatGpt(
+        system_message=CONVERSATION_SUMMARY_SYSTEM_MESSAGE,
+        completion_tokens=CONVERSATION_SUMMARY_COMPLETION_TOKENS,
+    )
+    available_tokens = chatgpt.max_tokens - chatgpt.tokens
+    lines = [summary.summary] if summary else []
+    tokens = sum(chatgpt.count_tokens(line) + 1 for line in lines)
+    # 読まなかった受け答えや、収まらなかった受け答えを要約済みにしない
+    truncated = len(turns) >= CONVERSATION_SUMMARY_MAX_TURNS
+    included_seq = after_seq
+    for turn in turns:
+        if turn.createdAt >= past_time.isoformat():
+            turn_lines = ["user: %s" % turn.userMessage]
+            if turn.assistantMessage is not None:
+                turn_lines.append("assistant: %s" % turn.assistantMessage)
+            # 改行の分を1トークンとして数える
+            turn_tokens = sum(chatgpt.count_tokens(line) + 1 for line in turn_lines)
+            if tokens + turn_tokens > available_tokens and included_seq > after_seq:
+                truncated = True
+                break
+            lines.extend(turn_lines)
+            tokens += turn_tokens
+        included_seq = turn.seq
+    if truncated:
+        last_seq = included_seq
+    if not lines:
+        return None
+
+    chatgpt = ChatGpt(
+        system_message=CONVERSATION_SUMMARY_SYSTEM_MESSAGE,
+        text_message="\n".join(lines),
+        completion_tokens=CONVERSATION_SUMMARY_COMPLETION_TOKENS,
+    )
+    if not chatgpt.send(timeout=OPENAI_REQUEST_TIMEOUT):
+        return None
+    content = chatgpt.get_response_message_content()
+    if not content:
+        return None
+    conversation_summary = ConversationSummary.create_instance(
+        talk_room_id,
+        content,
+        last_seq,
+        tokens=chatgpt.count_tokens(content),
+        encoding=chatgpt.encoding.name,
+        db_client=db_client,
+    )
+    try:
+        conversation_summary.save()
+    except db_client.exceptions.ConditionalCheckFailedException:
+        logger.info("A newer conversation summary already exists: %s" % talk_room_id)
+        return None
+
+    logger.info(conversation_summary.serialize())
+
+    return conversation_summary
+
+
+def find_cached_chatgpt_request_history(
+    chatgpt: ChatGpt,
+    past_time: datetime.datetime,
+    talk_room_history: TalkRoomHistory,
+) -> ChatGptRequestHistory | None:
+    """past_time から現時点までに同じ(またはほぼ同じ)内容のリクエストを送信していた場合は、そのリクエスト履歴を返す。"""
+    chatgpt_request_history = find_chatgpt_request_history(
+        ChatGptRequestHistory.hash_string(
+            json.dumps(chatgpt.get_request(), ensure_ascii=False)
+        ),
+        past_time,
+        talk_room_history.get_db_client(),
+    )
+    if chatgpt_request_history is None:
+        chatgpt_request_history = find_similar_chatgpt_request_history(
+            chatgpt.get_request(), past_time, talk_room_history.get_db_client()
+        )
+    return chatgpt_request_history
+
+
+def find_chatgpt_request_history(
+    request_id: str, past_time: datetime.datetime, db_client: DbClient
+) -> ChatGptRequestHistory | None:
+    """past_time 以降に送信した、同じ内容のリクエストの履歴を返す(無ければ None)。
+
+    プロセス内のキャッシュ(response_cache)を先に探し、無い場合は GSI2 に問い合わせる
+    (GSI2 からはキーとレスポンスだけを読む)。
+    """
+    data = response_cache.get(request_id)
+    if data is not None and data["createdAt"] > past_time.isoformat():
+        return ChatGptRequestHistory(dict(data), db_client)
 
     chatgpt_request_histories = ChatGptRequestHistory.find(
         ChatGptRequestHistory.get_gs2_query(
-            ChatGptRequestHistory.hash_string(
-                json.dumps(chatgpt.get_request(), ensure_ascii=False)
-            ),
-            limit=1,
-            reverse=True,
+            request_id, limit=1, reverse=True, projection=["response"]
         ),
-        db_client=talk_room_history.get_db_client(),
+        db_client=db_client,
     )
     if len(chatgpt_request_histories) > 0:
         chatgpt_request_history: ChatGptRequestHistory = chatgpt_request_histories[0]
         if chatgpt_request_history.createdAt > past_time.isoformat():
-            # past_time から現時点までに同じ内容のリクエストを送信していた場合は、そのリクエスト履歴を返却
+            cache_chatgpt_request_history(chatgpt_request_history)
             return chatgpt_request_history
+    return None
 
-    try:
-        if chatgpt.send(timeout=OPENAI_REQUEST_TIMEOUT):  # OpenAIのサーバにメッセージを送信
-            # OpenAIのサーバに送信したリクエストと、受信したレスポンスを DynamoDB に保存
-            chatgpt_request_history = ChatGptRequestHistory.create_instance(
-                talk_room_history.talkRoomId,
-                talk_room_history.userId,
-                chatgpt.get_request(),  # OpenAIのサーバに送信したリクエスト
-                chatgpt.get_response(),  # OpenAIのサーバから受信したレスポンス
-                db_client=talk_room_history.get_db_client(),
+
+def find_similar_chatgpt_request_history(
+    request: list, past_time: datetime.datetime, db_client: DbClient
+) -> ChatGptRequestHistory | None:
+    """past_time 以降に送信した、ほぼ同じ内容の質問のリクエストの履歴を返す(無ければ None)。
+
+    会話履歴を含まない(システムメッセージと質問だけの)リクエストに限り、semantic_cache を探す。
+    """
+    if semantic_cache is None or not is_standalone_request(request):
+        return None
+    data = semantic_cache.get(request[0]["content"], request[1]["content"])
+    if data is not None and data["createdAt"] > past_time.isoformat():
+        return ChatGptRequestHistory(dict(data), db_client)
+    return None
+
+
+def is_standalone_request(request: list) -> bool:
+    """リクエストがシステムメッセージと質問だけで構成されている場合に True を返す。"""
+    return (
+        len(request) == 2
+        and request[0]["role"] == ChatGptRole.SYSTEM.value
+        and request[1]["role"] == ChatGptRole.USER.value
+    )
+
+
+def cache_chatgpt_request_history(chatgpt_request_history: ChatGptRequestHistory):
+    """リクエスト履歴を response_cache と semantic_cache に保持する(エラーメッセージの履歴は保持しない)。"""
+    if chatgpt_request_history.is_error_response():
+        return
+    serialized = chatgpt_request_history.serialize()
+    data = json.loads(serialized)
+    response_cache.put(
+        chatgpt_request_history.requestId,
+        data,
+        len(serialized.encode("utf-8")),
+    )
+    if (
+        semantic_cache is not None
+        # 射影でリクエストを読まなかった履歴は、読み直してまで保持しない
+        and chatgpt_request_history.is_loaded("request")
+        and chatgpt_request_history.request
+    ):
+        request = json.loads(chatgpt_request_history.request)
+        if is_standalone_request(request):
+            semantic_cache.put(request[0]["content"], request[1]["content"], data)
+
+
+def save_chatgpt_request_history(
+    talk_room_history: TalkRoomHistory,
+    chatgpt: ChatGpt,
+    error_message: str | None = None,
+) -> ChatGptRequestHistory:
+    """OpenAIのサーバに送信したリクエストと、受信したレスポンス(またはエラーメッセージ)を DynamoDB に保存する。
+
+    CONVERSATION_STORE が "turn_log" の場合は、今回の受け答えを ConversationTurn に追記し、
+    リクエスト履歴には(会話履歴を含まないリクエストを除き)リクエスト全体を保存しない。
+    """
+    turn_log = CONVERSATION_STORE == "turn_log"
+    chatgpt_request_history = ChatGptRequestHistory.create_instance(
+        talk_room_history.talkRoomId,
+        talk_room_history.userId,
+        chatgpt.get_request(),  # OpenAIのサーバに送信したリクエスト
+        chatgpt.get_response(),  # OpenAIのサーバから受信したレスポンス
+        error_message=error_message,
+        db_client=talk_room_history.get_db_client(),
+        request_tokens=None if turn_log else chatgpt.get_request_tokens(),
+        store_request=not turn_log or is_standalone_request(chatgpt.get_request()),
+    )
+    chatgpt_request_history.save()
+    cache_chatgpt_request_history(chatgpt_request_history)
+    if turn_log:
+        assistant_message = None
+        if not chatgpt_request_history.is_error_response():
+            assistant_message = chatgpt.get_response_message_content()
+        record_conversation_turn(talk_room_history, chatgpt, assistant_message)
+
+    logger.info(chatgpt_request_history.serialize())
+
+    return chatgpt_request_history
+
+
+def save_cached_conversation_turn(
+    talk_room_history: TalkRoomHistory,
+    chatgpt: ChatGpt,
+    chatgpt_request_history: ChatGptRequestHistory,
+):
+    """CONVERSATION_STORE が "turn_log" の場合に、キャッシュから返した応答との受け答えを ConversationTurn に追記する。
+
+    リクエストを送信しなくても、次のリクエストの会話履歴に今回の受け答えを含めるため。
+    """
+    if CONVERSATION_STORE != "turn_log":
+        return
+    assistant_message = None
+    if not chatgpt_request_history.is_error_response():
+        assistant_message = chatgpt_request_history.get_response_message_content()
+    record_conversation_turn(talk_room_history, chatgpt, assistant_message)
+
+
+def record_conversation_turn(
+    talk_room_history: TalkRoomHistory,
+    chatgpt: ChatGpt,
+    assistant_message: str | None,
+):
+    """今回の受け答えを ConversationTurn に追記し、リクエストのトークン数が多い場合は古い受け答えの要約を予約する。"""
+    save_conversation_turn(talk_room_history, chatgpt, assistant_message)
+    if (
+        assistant_message is not None
+        and CONVERSATION_SUMMARY_THRESHOLD_TOKENS > 0
+        and chatgpt.tokens > CONVERSATION_SUMMARY_THRESHOLD_TOKENS
+    ):
+        # 返信を待たせないように、古い受け答えの要約は別のスレッドで行う
+        summary_task_queue.schedule(
+            0,
+            summarize_conversation,
+            talk_room_history.talkRoomId,
+            talk_room_history.get_db_client(),
+            key=talk_room_history.talkRoomId,
+        )
+
+
+def save_conversation_turn(
+    talk_room_history: TalkRoomHistory,
+    chatgpt: ChatGpt,
+    assistant_message: str | None,
+) -> ConversationTurn | None:
+    """今回の受け答えを、トークルームの最新の seq の次の seq で ConversationTurn に追記する。
+
+    他の処理が同じ seq で先に追記した場合は、最新の seq を読み直して保存し直す。
+
+    Args:
+        talk_room_history: トークルームの投稿
+        chatgpt: 送信したリクエストを含む ChatGpt オブジェクト
+        assistant_message: ChatGPT の応答(エラーの場合は None)
+
+    Returns:
+        ConversationTurn: 保存した受け答え(保存できなかった場合は None)
+    """
+    db_client = talk_room_history.get_db_client()
+    # トークン数の制限で切り詰めた今回のメッセージ
+    user_message = chatgpt.get_request()[-1]["content"]
+    tokens = (
+        chatgpt.get_request_tokens()["counts"][-1],
+        chatgpt.count_tokens(assistant_message),
+    )
+    for _ in range(CONVERSATION_TURN_MAX_ATTEMPTS):
+        conversation_turn = ConversationTurn.create_instance(
+            talk_room_history.talkRoomId,
+            talk_room_history.userId,
+            ConversationTurn.get_latest_seq(talk_room_history.talkRoomId, db_client)
+            + 1,
+            user_message,
+            assistant_message,
+            tokens=tokens,
+            encoding=chatgpt.encoding.name,
+            db_client=db_client,
+        )
+        try:
+            conversation_turn.save()
+            return conversation_turn
+        except db_client.exceptions.ConditionalCheckFailedException:
+            logger.warning(
+                "Conversation turn %d already exists: %s"
+                % (conversation_turn.seq, conversation_turn.talkRoomId)
             )
-            chatgpt_request_history.save()
+    logger.error(
+        "Failed to save a conversation turn: %s" % talk_room_history.talkRoomId
+    )
+    return None
 
-            logger.info(chatgpt_request_history.serialize())
 
-            return chatgpt_request_history
+def process_text_message_event(
+    line_event,
+    system_message: str = "",
+    local: bool = False,
+    on_chunk: Callable[[str, bool], None] | None = None,
+    deadline: Deadline | None = None,
+) -> ChatGptRequestHistory | None:
+    """LINEイベント(テキストメッセージ)の処理。
+       テキストメッセージをChatGPTで処理し、処理結果を返す。
+
+    Args:
+        line_event: LINEイベント(テキストメッセージ)
+         system_message: 空文字以外の場合に ChatGPT の振る舞いの定義に使われるメッセージ(テスト用)
+         local: True の場合に DynamoDB Local を使用する(テスト用)
+         on_chunk: 指定した場合は応答をストリーミングで受信し、生成途中の応答を渡す
+         deadline: レコードの処理の期限(OpenAI の応答を待つ期限、DynamoDB のタイムアウトに使う)
+
+    Returns:
+        ChatGptRequestHistory: ChatGPTへのリクエスト履歴オプジェクト(処理結果含む)
+    """
+    talk_room_history, chatgpt, chatgpt_request_history = prepare_text_message_event(
+        line_event, system_message=system_message, local=local, deadline=deadline
+    )
+    if chatgpt_request_history:
+        save_cached_conversation_turn(
+            talk_room_history, chatgpt, chatgpt_request_history
+        )
+        return chatgpt_request_history
+
+    try:
+        # OpenAIのサーバにメッセージを送信
+        if chatgpt.send(
+            timeout=OPENAI_REQUEST_TIMEOUT,
+            on_chunk=on_chunk,
+            deadline=deadline.expires_at if deadline else None,
+        ):
+            return save_chatgpt_request_history(talk_room_history, chatgpt)
     except Exception:
         logger.error("Request timed out", exc_info=True)
         # タイムアウトした場合は、タイムアウトエラーメッセージを返す
-        chatgpt_request_history = ChatGptRequestHistory.create_instance(
-            talk_room_history.talkRoomId,
-            talk_room_history.userId,
-            chatgpt.get_request(),  # OpenAIのサーバに送信したリクエスト
+        return save_chatgpt_request_history(
+            talk_room_history,
+            chatgpt,
             error_message=OPENAI_REQUEST_TIMEOUT_ERROR_MESSAGE,
-            db_client=talk_room_history.get_db_client(),
         )
-        chatgpt_request_history.save()
+    return None
+
 
-        logger.info(chatgpt_request_history.serialize())
+async def process_text_message_event_async(
+    line_event,
+    system_message: str = "",
+    local: bool = False,
+    deadline: Deadline | None = None,
+) -> ChatGptRequestHistory | None:
+    """process_text_message_event の asyncio 版。
 
+    DynamoDB の呼び出し(とトークン数の計算)はスレッドプールで実行し、
+    OpenAI のサーバからの応答を待つ間は他のトークルームの処理を進める。
+    """
+    talk_room_history, chatgpt, chatgpt_request_history = await asyncio.to_thread(
+        prepare_text_message_event, line_event, system_message, local, deadline
+    )
+    if chatgpt_request_history:
+        await asyncio.to_thread(
+            save_cached_conversation_turn,
+            talk_room_history,
+            chatgpt,
+            chatgpt_request_history,
+        )
         return chatgpt_request_history
+
+    try:
+        # OpenAIのサーバにメッセージを送信
+        if await chatgpt.asend(
+            timeout=OPENAI_REQUEST_TIMEOUT,
+            deadline=deadline.expires_at if deadline else None,
+        ):
+            return await asyncio.to_thread(
+                save_chatgpt_request_history, talk_room_history, chatgpt
+            )
+    except Exception:
+        logger.error("Request timed out", exc_info=True)
+        # タイムアウトした場合は、タイムアウトエラーメッセージを返す
+        return await asyncio.to_thread(
+            save_chatgpt_request_history,
+            talk_room_history,
+            chatgpt,
+            OPENAI_REQUEST_TIMEOUT_ERROR_MESSAGE,
+        )
     return None
 
 
-def process_sqs_event(event):
-    if not event.get("Records") or type(event["Records"]) is not list:
+def process_sqs_record(record, deadline: Deadline | None = None):
+    """SQSのレコード1件の処理。処理に失敗した場合は例外を送出する。
+
+    Args:
+        record: SQSのレコード
+        deadline: レコードの処理の期限
+    """
+    if record.get("eventSource") != "aws:sqs":
         return
-    for record in event["Records"]:
-        if record.get("eventSource") == "aws:sqs":
-            body = json.loads(record["body"])
-            if is_message_event(body):
-                if body.get("event_type") == "text_message":
-                    model = process_text_message_event(body.get("line_event"))
-                    if model:
-                        Line.reply_text_message(
-                            body.get("line_event"),
-                            model.get_response_message_content(),
-                            quick_reply=get_quick_reply(),
-                        )
+    body = get_record_body(record)
+    if is_message_event(body):
+        if body.get("event_type") == "text_message":
+            replier = None
+            if OPENAI_STREAM:
+                replier = LineStreamReplier(
+                    body.get("line_event"), quick_reply=get_quick_reply()
+                )
+            model = process_text_message_event(
+                body.get("line_event"),
+                on_chunk=replier.send if replier else None,
+                deadline=deadline,
+            )
+            if replier and replier.error is not None:
+                if replier.sent_count == 0:
+                    # 何も送信できなかった場合は、ストリーミングしない場合と同じく失敗とする
+                    raise replier.error
+                # 送信済みの部分を再送しないように、残りは送らない
+                return
+            if model:
+                content = model.get_response_message_content()
+                if replier and replier.sent_count > 0:
+                    # ストリーミングで送信済みの場合は、送信していない内容(エラーメッセージ等)のみ送る
+                    if content and content != replier.sent_text:
+                        replier.send(content, last=True)
                 else:
-                    if body.get("event_type") == "image_message":
-                        pass
-                    elif body.get("event_type") == "video_message":
-                        pass
-                    elif body.get("event_type") == "audio_message":
-                        pass
-                    elif body.get("event_type") == "location_message":
-                        pass
-                    elif body.get("event_type") == "sticker_message":
-                        pass
-                    elif body.get("event_type") == "file_message":
-                        pass
-                    # テキスト以外のメッセージには、5秒待ってから固定のLINEスタンプを返す
-                    # TODO: 投稿内容に応じた返信の実装、または、複数のLINEスタンプからランダムに選択
-                    time.sleep(5)  # 5秒待つ
-                    Line.reply_sticker_message(
+                    Line.reply_text_message(
                         body.get("line_event"),
-                        package_id="11538",
-                        sticker_id="51626499",
+                        content,
+                        quick_reply=get_quick_reply(),
                     )
-            else:
-                # TODO: イベントごとに処理を記述
-                if body.get("event_type") == "follow":
-                    pass
-                elif body.get("event_type") == "unfollow":
-                    pass
-                elif body.get("event_type") == "join":
-                    pass
-                elif body.get("event_type") == "leave":
-                    pass
-                elif body.get("event_type") == "member_joined":
-                    pass
-                elif body.get("event_type") == "member_left":
-                    pass
+        else:
+            if body.get("event_type") == "image_message":
+                pass
+            elif body.get("event_type") == "video_message":
+                pass
+            elif body.get("event_type") == "audio_message":
+                pass
+            elif body.get("event_type") == "location_message":
+                pass
+            elif body.get("event_type") == "sticker_message":
+                pass
+            elif body.get("event_type") == "file_message":
+                pass
+            # テキスト以外のメッセージには、5秒待ってから固定のLINEスタンプを返す
+            # 待つ間も後続のレコードを処理できるように、遅延キューに登録する
+            # TODO: 投稿内容に応じた返信の実装、または、複数のLINEスタンプからランダムに選択
+            delayed_task_queue.schedule(
+                NON_TEXT_MESSAGE_REPLY_DELAY_SEC,
+                Line.reply_sticker_message,
+                body.get("line_event"),
+                "11538",  # package_id
+                "51626499",  # sticker_id
+                key=record.get("messageId"),
+            )
+    else:
+        # TODO: イベントごとに処理を記述
+        if body.get("event_type") == "follow":
+            pass
+        elif body.get("event_type") == "unfollow":
+            pass
+        elif body.get("event_type") == "join":
+            pass
+        elif body.get("event_type") == "leave":
+            pass
+        elif body.get("event_type") == "member_joined":
+            pass
+        elif body.get("event_type") == "member_left":
+            pass
+
+
+async def process_sqs_record_async(
+    record, line: AsyncLine, deadline: Deadline | None = None
+):
+    """process_sqs_record の asyncio 版。
+
+    テキストメッセージ以外のレコードと、ストリーミングで返信する場合は、
+    process_sqs_record をスレッドプールで実行する。
+
+    Args:
+        record: SQSのレコード
+        line: LINEへの返信に使う AsyncLine
+        deadline: レコードの処理の期限
+    """
+    if record.get("eventSource") != "aws:sqs":
+        return
+    body = get_record_body(record)
+    if body.get("event_type") != "text_message" or OPENAI_STREAM:
+        await asyncio.to_thread(process_sqs_record, record, deadline)
+        return
+    model = await process_text_message_event_async(
+        body.get("line_event"), deadline=deadline
+    )
+    if model:
+        await line.reply_text_message(
+            body.get("line_event"),
+            model.get_response_message_content(),
+            quick_reply=get_quick_reply(),
+        )
+
+
+def group_sqs_records(records: list) -> dict:
+    """レコードをメッセージグループ(トークルーム)ごとに受信順にまとめる。"""
+    record_groups = {}
+    for record in records:
+        group_id = record.get("attributes", {}).get("MessageGroupId")
+        if group_id is None:
+            group_id = record.get("messageId")
+        record_groups.setdefault(group_id, []).append(record)
+    return record_groups
+
+
+def get_failed_message_ids(records: list, results: list) -> list:
+    """グループごとの処理結果(失敗した messageId のリスト)を、受信順の messageId にまとめる。"""
+    failed_message_ids = set(itertools.chain.from_iterable(results))
+    return [
+        record.get("messageId")
+        for record in records
+        if record.get("messageId") in failed_message_ids
+    ]
+
+
+def wait_delayed_tasks(deadline: Deadline | None = None):
+    """遅延させた返信と会話の要約がすべて終わるまで待つ。
+
+    失敗した返信はログに残すだけで、レコードの失敗にはしない
+    (同じメッセージグループの後続のレコードは処理済みのため、そのレコードだけを
+    再処理させると FIFO キューの順序が崩れる)。要約の失敗もレコードの失敗にしない。
+    """
+    failed_message_ids = delayed_task_queue.wait(
+        deadline.timeout() if deadline else None
+    )
+    if failed_message_ids:
+        logger.error(
+            "Failed to send %d delayed reply(ies): %s"
+            % (len(failed_message_ids), failed_message_ids)
+        )
+    summary_task_queue.wait(deadline.timeout() if deadline else None)
+
+
+def get_record_deadline(
+    deadline: Deadline | None, records: list, i: int
+) -> Deadline | None:
+    """records[i] の処理の期限を返す。
+
+    OPENAI_REQUEST_TIMEOUT 秒(残り時間がそれより短い場合は残り時間)を持ち時間とする
+    (未処理のレコードの件数で等分すると、1件あたりの持ち時間が OpenAI の応答を待つには短くなる)。
+    残り時間が PROCESSOR_MIN_RECORD_SEC 未満の場合は TimeoutError を送出する
+    (処理を始めなかったレコードは失敗として返し、再処理させる)。
+    """
+    if deadline is None:
+        return None
+    if deadline.remaining() < PROCESSOR_MIN_RECORD_SEC:
+        raise TimeoutError(
+            "Not enough time left to process %d record(s)" % (len(records) - i)
+        )
+    return Deadline.after(deadline.timeout(OPENAI_REQUEST_TIMEOUT))
+
+
+def process_sqs_record_group(records: list, deadline: Deadline | None = None) -> list:
+    """同じメッセージグループ(トークルーム)のレコードを順番に処理する。
+
+    FIFOキューの順序を保つため、処理に失敗したレコード以降のレコードは処理しない。
+    期限までに処理を始められないレコードも、失敗として返す(タイムアウトで強制終了させない)。
+    再処理しても成功しない例外 (is_retriable_error) の場合は、ログに残して処理済みとする
+    (失敗として返し続けると、メッセージグループの後続のレコードが処理されなくなる)。
+
+    Args:
+        records: 同じメッセージグループのレコード(受信順)
+        deadline: Lambda 関数の呼び出しの期限
+
+    Returns:
+        list: 処理に失敗したレコードと、処理しなかったレコードの messageId
+    """
+    for i, record in enumerate(records):
+        try:
+            process_sqs_record(record, get_record_deadline(deadline, records, i))
+        except Exception as e:
+            if not is_retriable_error(e):
+                # 再処理しても成功しないため、処理済みとして後続のレコードの処理を続ける
+                logger.error(
+                    "Discarded a record that cannot be processed: %s",
+                    record.get("messageId"),
+                    exc_info=True,
+                )
+                continue
+            logger.error(
+                "Failed to process a record: %s" % record.get("messageId"),
+                exc_info=True,
+            )
+            return [r.get("messageId") for r in records[i:]]
+    return []
+
+
+def process_sqs_event(event, deadline: Deadline | None = None) -> list:
+    """SQSイベントの処理。レコードごとに処理し、失敗したレコードの messageId を返す。
+
+    レコードをメッセージグループ(トークルーム)ごとにまとめ、異なるトークルームは
+    最大 PROCESSOR_MAX_CONCURRENCY 並列で処理する。同じトークルームのレコードは
+    受信順に処理し、失敗したレコード以降は処理せずに失敗として返す。
+
+    Args:
+        event: SQSイベント
+        deadline: Lambda 関数の呼び出しの期限
+
+    Returns:
+        list: 処理に失敗したレコードの messageId
+    """
+    if not event.get("Records") or type(event["Records"]) is not list:
+        return []
+    record_groups = group_sqs_records(event["Records"])
+
+    max_workers = min(PROCESSOR_MAX_CONCURRENCY, len(record_groups))
+    if max_workers <= 1:
+        results = [
+            process_sqs_record_group(g, deadline) for g in record_groups.values()
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(
+                executor.map(
+                    process_sqs_record_group,
+                    record_groups.values(),
+                    itertools.repeat(deadline),
+                )
+            )
+
+    wait_delayed_tasks(deadline)
+
+    return get_failed_message_ids(event["Records"], results)
+
+
+async def process_sqs_record_group_async(
+    records: list, line: AsyncLine, deadline: Deadline | None = None
+) -> list:
+    """process_sqs_record_group の asyncio 版。"""
+    for i, record in enumerate(records):
+        try:
+            await process_sqs_record_async(
+                record, line, get_record_deadline(deadline, records, i)
+            )
+        except Exception as e:
+            if not is_retriable_error(e):
+                logger.error(
+                    "Discarded a record that cannot be processed: %s",
+                    record.get("messageId"),
+                    exc_info=True,
+                )
+                continue
+            logger.error(
+                "Failed to process a record: %s" % record.get("messageId"),
+                exc_info=True,
+            )
+            return [r.get("messageId") for r in records[i:]]
+    return []
+
+
+async def process_sqs_event_async(event, deadline: Deadline | None = None) -> list:
+    """process_sqs_event の asyncio 版。
+
+    異なるトークルームのレコードを1つのイベントループで最大 PROCESSOR_MAX_CONCURRENCY
+    並列に処理する。応答待ちの長い OpenAI/LINE の呼び出しはスレッドを使わず、
+    DynamoDB の呼び出しは最大 PROCESSOR_ASYNC_MAX_THREADS スレッドのプールで実行する。
+
+    Args:
+        event: SQSイベント
+        deadline: Lambda 関数の呼び出しの期限
+
+    Returns:
+        list: 処理に失敗したレコードの messageId
+    """
+    if not event.get("Records") or type(event["Records"]) is not list:
+        return []
+    record_groups = group_sqs_records(event["Records"])
+
+    # asyncio.to_thread が使うスレッドプール(asyncio.run の終了時に破棄される)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=PROCESSOR_ASYNC_MAX_THREADS)
+    )
+    semaphore = asyncio.Semaphore(PROCESSOR_MAX_CONCURRENCY)
+
+    async with AsyncLine() as line:
+
+        async def process(records):
+            async with semaphore:
+                return await process_sqs_record_group_async(records, line, deadline)
+
+        results = list(
+            await asyncio.gather(*[process(g) for g in record_groups.values()])
+        )
+
+    await asyncio.to_thread(wait_delayed_tasks, deadline)
+
+    return get_failed_message_ids(event["Records"], results)
 
 
 def lambda_handler(event, context):
     logger.info(event)
     logger.info(json.dumps(event))
-    try:
-        process_sqs_event(event)
-    except Exception:
-        logger.error("Failed to process an event", exc_info=True)
+    # Lambda 関数のタイムアウトで強制終了される前に処理を終える
+    deadline = Deadline.from_context(context, margin=PROCESSOR_DEADLINE_MARGIN_SEC)
+    # 失敗したレコードのみを再処理させる(ReportBatchItemFailures)
+    if PROCESSOR_ASYNC:
+        failed_message_ids = asyncio.run(process_sqs_event_async(event, deadline))
+    else:
+        failed_message_ids = process_sqs_event(event, deadline)
+    if failed_message_ids:
+        logger.error("Failed to process %d record(s)" % len(failed_message_ids))
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in failed_message_ids
+        ]
+    }
@@ -0,0 +1,46 @@
+import time
+
+
+class Deadline:
+    """処理を終えなければならない期限 (time.monotonic() の値)。
+
+    Lambda 関数の呼び出しの残り時間から期限を作り、レコードごとの持ち時間に分けて
+    OpenAI API のタイムアウトや DynamoDB クライアントのタイムアウトに渡す。
+    """
+
+    def __init__(self, expires_at: float):
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_context(cls, context, margin: float = 0) -> "Deadline | None":
+        """Lambda のコンテキストの残り時間から margin 秒を除いた期限を返す。
+
+        残り時間を取得できない場合(ローカルでの実行等)は None を返す。
+        """
+        if not hasattr(context, "get_remaining_time_in_millis"):
+            return None
+        return cls.after(context.get_remaining_time_in_millis() / 1000 - margin)
+
+    @classmethod
+    def after(cls, seconds: float) -> "Deadline":
+        """現在から seconds 秒後の期限を返す。"""
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self) -> float:
+        """期限までの残り秒数(期限を過ぎている場合は 0)。"""
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, timeout: float | None = None) -> float:
+        """timeout 秒を、期限までの残り秒数以内に切り詰めて返す。"""
+        if timeout is None:
+            return self.remaining()
+        return min(timeout, self.remaining())
+
+    def split(self, count: int) -> "Deadline":
+        """残り時間を count 件で等分した、1件目の期限を返す。"""
+        if count <= 1:
+            return self
+        return Deadline.after(self.remaining() / count)
@@ -0,0 +1,97 @@
+import os
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Callable, Hashable
+from common.logger_factory import LoggerFactory
+
+# ログ出力設定
+LOGGER_LEVEL = os.environ.get("LOGGER_LEVEL", "INFO")
+logger = LoggerFactory.get_logger(__name__, log_level=LOGGER_LEVEL)
+
+
+class DelayedTaskQueue:
+    """指定した秒数の経過後にタスクを実行するキュー。
+
+    タスクは1つのワーカースレッドで実行予定時刻の順に実行されるため、
+    schedule() の呼び出し元は待たされない。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._tasks = []  # (実行予定時刻, 登録順, func, args, key)
+        self._sequence = itertools.count()
+        self._running = 0
+        self._failed_keys = []
+        self._worker = None
+
+    def schedule(
+        self, delay: float, func: Callable, *args: Any, key: Hashable = None
+    ) -> None:
+        """delay 秒後に func(*args) を実行する。
+
+        Args:
+            delay: 実行までの秒数
+            func: 実行する関数
+            args: func に渡す引数
+            key: タスクの識別子(失敗した場合に wait() が返す)
+        """
+        with self._condition:
+            heapq.heappush(
+                self._tasks,
+                (time.monotonic() + delay, next(self._sequence), func, args, key),
+            )
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._condition.notify_all()
+
+    def wait(self, timeout: float | None = None) -> list:
+        """登録済みのタスクがすべて実行されるまで待つ。
+
+        Args:
+            timeout: 最大の待ち時間(秒)。None の場合は無制限
+
+        Returns:
+            list: 前回の wait() 以降に失敗したタスクと、タイムアウトまでに実行されなかったタスクの key
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._tasks or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            # タイムアウトまでに実行されなかったタスクは破棄する
+            failed_keys = self._failed_keys + [task[4] for task in self._tasks]
+            self._failed_keys = []
+            self._tasks = []
+            return failed_keys
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._tasks:
+                        # 一定時間タスクが無ければスレッドを終了する
+                        if not self._condition.wait(60) and not self._tasks:
+                            self._worker = None
+                            return
+                        continue
+                    wait_sec = self._tasks[0][0] - time.monotonic()
+                    if wait_sec <= 0:
+                        break
+                    self._condition.wait(wait_sec)
+                _, _, func, args, key = heapq.heappop(self._tasks)
+                self._running += 1
+            try:
+                func(*args)
+            except Exception:
+                logger.error("Failed to run a delayed task: %s" % key, exc_info=True)
+                with self._condition:
+                    self._failed_keys.append(key)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    self._condition.notify_all()
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LruCache:
+    """値のバイト数の合計に上限を設けた LRU キャッシュ(スレッドセーフ)。
+
+    合計が max_bytes を超える場合は、最も長く参照されていない値から破棄する。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key: (value, バイト数)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def bytes(self) -> int:
+        """キャッシュしている値のバイト数の合計"""
+        return self._bytes
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> bool:
+        """value をキャッシュする。
+
+        Args:
+            key: キー
+            value: 値
+            size: 値のバイト数
+
+        Returns:
+            bool: 値が max_bytes より大きく、キャッシュしなかった場合は False
+        """
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+        return True
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items = OrderedDict()
+            self._bytes = 0
@@ -0,0 +1,205 @@
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from typing import Any
+
+# MinHash の計算に使うメルセンヌ素数と最大値
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_WHITESPACE = re.compile(r"\s+")
+# 日本語などの ASCII 以外の文字に隣接する空白(単語の区切りではない)
+_NON_ASCII_SPACE = re.compile(r"(?<=[^\x00-\x7f]) | (?=[^\x00-\x7f])")
+
+
+def normalize_text(text: str) -> str:
+    """表記の揺れを除いたテキストを返す。
+
+    全角/半角を統一(NFKC)して小文字にし、句読点・記号を除いて、空白を1つにまとめる
+    (ASCII 以外の文字に隣接する空白は除く)。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = "".join(" " if unicodedata.category(c)[0] in ("P", "S") else c for c in text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    return _NON_ASCII_SPACE.sub("", text)
+
+
+def get_shingles(text: str, n: int) -> set:
+    """テキストの文字 n-gram の集合を返す(n 文字未満の場合はテキスト全体)。"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+class SemanticCache:
+    """ほぼ同じ内容のテキストに対する値を返すキャッシュ(スレッドセーフ)。
+
+    正規化したテキストの文字 n-gram から MinHash の署名を計算し、LSH (署名を bands 個に
+    分けたバケット)で候補を絞り込む。候補のうち n-gram 集合の Jaccard 係数が
+    threshold 以上で最も高いものの値を返す。namespace(システムメッセージ等)が
+    異なるテキストは比較しない。
+
+    MinHash の計算量はテキストの長さに比例するため、max_text_chars 文字を
+    超えるテキストはキャッシュしない(長い質問がほぼ同じ内容で繰り返されることは少ない)。
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        num_perm: int = 64,
+        bands: int = 16,
+        ngram: int = 3,
+        max_entries: int = 10000,
+        ttl: float | None = None,
+        max_text_chars: int = 500,
+    ):
+        """
+        Args:
+            threshold: 値を返す Jaccard 係数の下限 (0 < threshold <= 1)
+            num_perm: MinHash の署名の長さ(bands で割り切れること)
+            bands: LSH のバンドの数
+            ngram: n-gram の文字数
+            max_entries: 保持する最大件数(超えた場合は最も長く参照されていないものから破棄)
+            ttl: 値を保持する秒数(None の場合は無期限)
+            max_text_chars: キャッシュするテキストの最大文字数
+        """
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_text_chars = max_text_chars
+        rand = random.Random(1)
+        self._permutations = [
+            (rand.randrange(1, _MERSENNE_PRIME), rand.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self._lock = threading.Lock()
+        self._entries = (
+            OrderedDict()
+        )  # id: (namespace, テキスト, n-gram, 署名, 値, 登録時刻)
+        self._ids = {}  # (namespace, テキスト): id
+        self._buckets = {}  # (namespace, バンド番号, 署名の一部): id の集合
+        # 登録順の (登録時刻, id)。ttl が一定のため、先頭から期限切れになる
+        # (置き換えや破棄で削除済みの id も含む)
+        self._registered = deque()
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_signature(self, shingles: set) -> tuple:
+        """n-gram の集合の MinHash の署名を返す。"""
+        hashes = [
+            int.from_bytes(
+                hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big"
+            )
+            for s in shingles
+        ]
+        if not hashes:
+            return (_MAX_HASH,) * self.num_perm
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._permutations
+        )
+
+    def _get_bucket_keys(self, namespace: str, signature: tuple) -> list:
+        return [
+            (namespace, i, signature[i * self.rows : (i + 1) * self.rows])
+            for i in range(self.bands)
+        ]
+
+    def _get_shingles(self, text: str) -> tuple[str, set]:
+        """正規化したテキストと、その n-gram の集合を返す(キャッシュしないテキストの場合は空の集合)。"""
+        if len(text) > self.max_text_chars:
+            return "", set()
+        normalized = normalize_text(text)
+        return normalized, get_shingles(normalized, self.ngram)
+
+    def get(self, namespace: str, text: str) -> Any:
+        """text とほぼ同じ内容のテキストに対する値を返す(無ければ None)。"""
+        _, shingles = self._get_shingles(text)
+        if not shingles:
+            return None
+        signature = self.get_signature(shingles)
+        with self._lock:
+            self._expire()
+            candidates = set()
+            for key in self._get_bucket_keys(namespace, signature):
+                candidates.update(self._buckets.get(key, ()))
+            best_id = None
+            best_similarity = 0.0
+            for entry_id in candidates:
+                entry_shingles = self._entries[entry_id][2]
+                similarity = len(shingles & entry_shingles) / len(
+                    shingles | entry_shingles
+                )
+                if similarity >= self.threshold and similarity > best_similarity:
+                    best_id = entry_id
+                    best_similarity = similarity
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][4]
+
+    def put(self, namespace: str, text: str, value: Any) -> None:
+        """text に対する値を登録する。"""
+        normalized, shingles = self._get_shingles(text)
+        if not shingles:
+            return
+        signature = self.get_signature(shingles)
+        with self._lock:
+            entry_id = self._ids.get((namespace, normalized))
+            if entry_id is not None:
+                self._delete(entry_id)
+            entry_id = next(self._sequence)
+            registered_at = time.monotonic()
+            self._entries[entry_id] = (
+                namespace,
+                normalized,
+                shingles,
+                signature,
+                value,
+                registered_at,
+            )
+            if self.ttl is not None:
+                self._registered.append((registered_at, entry_id))
+                if len(self._registered) > 2 * self.max_entries:
+                    # 削除済みの id を除く
+                    self._registered = deque(
+                        sorted((entry[5], i) for i, entry in self._entries.items())
+                    )
+            self._ids[(namespace, normalized)] = entry_id
+            for key in self._get_bucket_keys(namespace, signature):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._delete(next(iter(self._entries)))
+
+    def _delete(self, entry_id: int) -> None:
+        namespace, normalized, _, signature, _, _ = self._entries.pop(entry_id)
+        del self._ids[(namespace, normalized)]
+        for key in self._get_bucket_keys(namespace, signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def _expire(self) -> None:
+        if self.ttl is None:
+            return
+        expired_at = time.monotonic() - self.ttl
+        # 期限切れの登録だけを先頭から確認する(_entries は参照のたびに並び順が変わる)
+        while self._registered and self._registered[0][0] <= expired_at:
+            _, entry_id = self._registered.popleft()
+            if entry_id in self._entries:
+                self._delete(entry_id)
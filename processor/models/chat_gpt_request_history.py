@@ -1,15 +1,23 @@
 import os
 import json
+import time
 import datetime
 import hashlib
 from models.db_client import DbClient
-from models.model_base import ModelBase, SortKeyComparison
+from models.model_base import KeySchema, ModelBase, SortKeyComparison
 
 
 class ChatGptRequestHistory(ModelBase):
     TABLE = os.getenv(
         "DYNAMO_CHAT_GPT_REQUEST_HISTORY_TABLE", "ChatGptRequestHistoryTable"
     )
+    # DynamoDB の TTL で削除されるまでの秒数(この期間を過ぎた履歴は参照しない)
+    EXPIRES_AFTER_SEC = int(os.getenv("REQUEST_KEEP_SEC", 604800))
+    KEY_SCHEMAS = {
+        None: KeySchema("talkRoomId", "createdAt"),
+        "GSI1": KeySchema("userId", "createdAt"),
+        "GSI2": KeySchema("requestId", "createdAt"),
+    }
 
     def __init__(
         self, data: dict, db_client: DbClient | None = None, local: bool = False
@@ -45,6 +53,14 @@ class ChatGptRequestHistory(ModelBase):
                     "minLength": 0,
                     "maxLength": 100000,
                 },
+                "tokenCounts": {
+                    "type": "string",  # JSON string
+                    "minLength": 0,
+                    "maxLength": 100000,
+                },
+                "expiresAt": {
+                    "type": "integer",  # UNIX time (DynamoDB の TTL 属性)
+                },
                 "createdAt": {
                     "type": "string",
                     "pattern": r"^(?:[\+-]?\d{4}(?!\d{2}\b))(?:(-?)(?:(?:0[1-9]|1[0-2])(?:\1(?:[12]\d|0[1-9]|3[01]))?|W(?:[0-4]\d|5[0-2])(?:-?[1-7])?|(?:00[1-9]|0[1-9]\d|[12]\d{2}|3(?:[0-5]\d|6[1-6])))(?:[T\s](?:(?:(?:[01]\d|2[0-3])(?:(:?)[0-5]\d)?|24\:?00)(?:[\.,]\d+(?!:))?)?(?:\2[0-5]\d(?:[\.,]\d+)?)?(?:[zZ]|(?:[\+-])(?:[01]\d|2[0-3]):?(?:[0-5]\d)?)?)?)?$",
@@ -70,13 +86,15 @@ class ChatGptRequestHistory(ModelBase):
         response: dict | None = None,
         error_message: str | None = None,
         db_client: DbClient | None = None,
+        request_tokens: dict | None = None,
+        store_request: bool = True,
     ) -> "ChatGptRequestHistory":
         request_str = json.dumps(request, ensure_ascii=False)
         request_id = cls.hash_string(request_str)
         if error_message or not response:
             if not error_message:
                 error_message = "empty response"
-            return ChatGptRequestHistory(
+            chatgpt_request_history = ChatGptRequestHistory(
                 {
                     "talkRoomId": talk_room_id,
                     "userId": user_id,
@@ -90,7 +108,7 @@ class ChatGptRequestHistory(ModelBase):
                 db_client=db_client,
             )
         else:
-            return ChatGptRequestHistory(
+            chatgpt_request_history = ChatGptRequestHistory(
                 {
                     "talkRoomId": talk_room_id,
                     "userId": user_id,
@@ -101,6 +119,16 @@ class ChatGptRequestHistory(ModelBase):
                 },
                 db_client=db_client,
             )
+        chatgpt_request_history.expiresAt = int(time.time()) + cls.EXPIRES_AFTER_SEC
+        if not store_request:
+            # 会話を ConversationTurn に保存する場合は、requestId だけを残す
+            chatgpt_request_history._data.pop("request")
+        if request_tokens:
+            # 次回のリクエストでトークン数を数え直さずに済むように保存する
+            chatgpt_request_history.tokenCounts = json.dumps(
+                request_tokens, ensure_ascii=False
+            )
+        return chatgpt_request_history
 
     @classmethod
     def create_table(cls, db_client: DbClient | None = None, local: bool = False):
@@ -169,94 +197,17 @@ class ChatGptRequestHistory(ModelBase):
         sort_key2: str | None = None,
         limit: int = 1,
         reverse: bool = False,
+        projection: list | None = None,
     ) -> dict:
-        if sort_op and sort_key1:
-            if sort_op == SortKeyComparison.EQ:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt = :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                }
-            elif sort_op == SortKeyComparison.LT:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt < :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.LE:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt <= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GT:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt > :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GE:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt >= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.BETWEEN:
-                if sort_key2:
-                    return {
-                        "TableName": cls.get_table(),
-                        "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt BETWEEN :createdAt1 AND :createdAt2",
-                        "ExpressionAttributeValues": {
-                            ":talkRoomId": {"S": partition_key},
-                            ":createdAt1": {"S": sort_key1},
-                            ":createdAt2": {"S": sort_key2},
-                        },
-                        "ScanIndexForward": not reverse,
-                        "Limit": limit,
-                    }
-                else:
-                    return {}
-            elif sort_op == SortKeyComparison.BEGINS_WITH:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND begins_with ( createdAt, :createdAt )",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-        return {
-            "TableName": cls.get_table(),
-            "KeyConditionExpression": "talkRoomId = :talkRoomId",
-            "ExpressionAttributeValues": {":talkRoomId": {"S": partition_key}},
-            "ScanIndexForward": not reverse,
-            "Limit": limit,
-        }
+        return cls.build_query(
+            partition_key,
+            sort_op,
+            sort_key1,
+            sort_key2,
+            limit,
+            reverse,
+            projection=projection,
+        )
 
     @classmethod
     def get_gs1_query(
@@ -267,102 +218,18 @@ class ChatGptRequestHistory(ModelBase):
         sort_key2: str | None = None,
         limit: int = 1,
         reverse: bool = False,
+        projection: list | None = None,
     ) -> dict:
-        if sort_op and sort_key1:
-            if sort_op == SortKeyComparison.EQ:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt = :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                }
-            elif sort_op == SortKeyComparison.LT:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt < :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.LE:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt <= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GT:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt > :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GE:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt >= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.BETWEEN:
-                if sort_key2:
-                    return {
-                        "TableName": cls.get_table(),
-                        "IndexName": cls.get_table() + "GSI1",
-                        "KeyConditionExpression": "userId = :userId AND createdAt BETWEEN :createdAt1 AND :createdAt2",
-                        "ExpressionAttributeValues": {
-                            ":userId": {"S": partition_key},
-                            ":createdAt1": {"S": sort_key1},
-                            ":createdAt2": {"S": sort_key2},
-                        },
-                        "ScanIndexForward": not reverse,
-                        "Limit": limit,
-                    }
-                else:
-                    return {}
-            elif sort_op == SortKeyComparison.BEGINS_WITH:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND begins_with ( createdAt, :createdAt )",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-        return {
-            "TableName": cls.get_table(),
-            "IndexName": cls.get_table() + "GSI1",
-            "KeyConditionExpression": "userId = :userId",
-            "ExpressionAttributeValues": {":userId": {"S": partition_key}},
-            "ScanIndexForward": not reverse,
-            "Limit": limit,
-        }
+        return cls.build_query(
+            partition_key,
+            sort_op,
+            sort_key1,
+            sort_key2,
+            limit,
+            reverse,
+            index="GSI1",
+            projection=projection,
+        )
 
     @classmethod
     def get_gs2_query(
@@ -373,138 +240,32 @@ class ChatGptRequestHistory(ModelBase):
         sort_key2: str | None = None,
         limit: int = 1,
         reverse: bool = False,
+        projection: list | None = None,
     ) -> dict:
-        if sort_op and sort_key1:
-            if sort_op == SortKeyComparison.EQ:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI2",
-                    "KeyConditionExpression": "#reqId = :requestId AND createdAt = :createdAt",
-                    "ExpressionAttributeNames": {"#reqId": "requestId"},
-                    "ExpressionAttributeValues": {
-                        ":requestId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                }
-            elif sort_op == SortKeyComparison.LT:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI2",
-                    "KeyConditionExpression": "#reqId = :requestId AND createdAt < :createdAt",
-                    "ExpressionAttributeNames": {"#reqId": "requestId"},
-                    "ExpressionAttributeValues": {
-                        ":requestId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.LE:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI2",
-                    "KeyConditionExpression": "#reqId = :requestId AND createdAt <= :createdAt",
-                    "ExpressionAttributeNames": {"#reqId": "requestId"},
-                    "ExpressionAttributeValues": {
-                        ":requestId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GT:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI2",
-                    "KeyConditionExpression": "#reqId = :requestId AND createdAt > :createdAt",
-                    "ExpressionAttributeNames": {"#reqId": "requestId"},
-                    "ExpressionAttributeValues": {
-                        ":requestId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GE:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI2",
-                    "KeyConditionExpression": "#reqId = :requestId AND createdAt >= :createdAt",
-                    "ExpressionAttributeNames": {"#reqId": "requestId"},
-                    "ExpressionAttributeValues": {
-                        ":requestId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.BETWEEN:
-                if sort_key2:
-                    return {
-                        "TableName": cls.get_table(),
-                        "IndexName": cls.get_table() + "GSI2",
-                        "KeyConditionExpression": "#reqId = :requestId AND createdAt BETWEEN :createdAt1 AND :createdAt2",
-                        "ExpressionAttributeNames": {"#reqId": "requestId"},
-                        "ExpressionAttributeValues": {
-                            ":requestId": {"S": partition_key},
-                            ":createdAt1": {"S": sort_key1},
-                            ":createdAt2": {"S": sort_key2},
-                        },
-                        "ScanIndexForward": not reverse,
-                        "Limit": limit,
-                    }
-                else:
-                    return {}
-            elif sort_op == SortKeyComparison.BEGINS_WITH:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI2",
-                    "KeyConditionExpression": "#reqId = :requestId AND begins_with ( createdAt, :createdAt )",
-                    "ExpressionAttributeNames": {"#reqId": "requestId"},
-                    "ExpressionAttributeValues": {
-                        ":requestId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-        return {
-            "TableName": cls.get_table(),
-            "IndexName": cls.get_table() + "GSI2",
-            "KeyConditionExpression": "#reqId = :requestId",
-            "ExpressionAttributeNames": {"#reqId": "requestId"},
-            "ExpressionAttributeValues": {":requestId": {"S": partition_key}},
-            "ScanIndexForward": not reverse,
-            "Limit": limit,
-        }
-
-    @classmethod
-    def find(cls, query: dict, db_client=None):
-        if not db_client:
-            db_client = cls.new_db_client()
-        res = db_client.query(**query)
-        results = []
-        if not res.get("Items"):
-            return results
-        for item in res["Items"]:
-            _item = {}
-            for _key, _value in item.items():
-                for _, _subvalue in _value.items():
-                    _item[_key] = _subvalue
-                    break
-            results.append(ChatGptRequestHistory(_item, db_client))
-        return results
+        return cls.build_query(
+            partition_key,
+            sort_op,
+            sort_key1,
+            sort_key2,
+            limit,
+            reverse,
+            index="GSI2",
+            projection=projection,
+        )
 
     def save(self):
         item = {}
         self.validate()
-        json.loads(self._data["request"])  # Check JSON format
+        if self._data.get("request") is not None:
+            json.loads(self._data["request"])  # Check JSON format
         properties = self._schema.get("properties", {})
         for key, value in properties.items():
+            if self._data.get(key) is None:
+                continue
             if value.get("type") == "string":
                 item[key] = {"S": self._data.get(key)}
-            elif value.get("type") == "number":
-                item[key] = {"N": self._data.get(key)}
+            elif value.get("type") in ("number", "integer"):
+                item[key] = {"N": str(self._data.get(key))}
             elif value.get("type") == "boolean":
                 item[key] = {"BOOL": self._data.get(key)}
 
@@ -516,16 +277,37 @@ class ChatGptRequestHistory(ModelBase):
     def delete(self):
         self._db_client.delete_item(
             TableName=self.get_table(),
-            Key={
-                "talkRoomId": {"S": self._data.get("talkRoomId")},
-                "createdAt": {"S": self._data.get("createdAt")},
-            },
+            Key=self.get_key(),
         )
 
+    def get_request_tokens(self) -> dict | None:
+        """request の各メッセージのトークン数 (ChatGpt.get_request_tokens() の値) を返す。
+
+        トークン数を保存していない履歴の場合は None を返す。
+        """
+        token_counts = self.get("tokenCounts")
+        if not token_counts:
+            return None
+        try:
+            return json.loads(token_counts)
+        except ValueError:
+            return None
+
+    def is_error_response(self) -> bool:
+        """レスポンスの代わりにエラーメッセージを保存した履歴の場合は True を返す。"""
+        response = self.get("response")
+        if not response:
+            return True
+        try:
+            return bool(json.loads(response).get("error_message"))
+        except (ValueError, AttributeError):
+            return True
+
     def get_response_message_content(self):
-        if not self._data.get("response"):
+        response = self.get("response")
+        if not response:
             return None
-        response = json.loads(self._data["response"])
+        response = json.loads(response)
         if not response:
             return None
         if response.get("error_message"):
@@ -0,0 +1,162 @@
+import os
+import time
+import datetime
+from models.db_client import DbClient
+from models.model_base import KeySchema, ModelBase, SortKeyComparison
+
+
+class ConversationSummary(ModelBase):
+    """トークルームの古い受け答え (ConversationTurn) の要約。
+
+    トークルームごとに1件で、seq が lastSeq 以前の受け答えの代わりにリクエストに含める。
+    """
+
+    TABLE = os.getenv("DYNAMO_CONVERSATION_SUMMARY_TABLE", "ConversationSummaryTable")
+    # DynamoDB の TTL で削除されるまでの秒数(この期間を過ぎた要約は参照しない)
+    EXPIRES_AFTER_SEC = int(os.getenv("REQUEST_KEEP_SEC", 604800))
+    KEY_SCHEMAS = {None: KeySchema("talkRoomId")}
+
+    def __init__(
+        self, data: dict, db_client: DbClient | None = None, local: bool = False
+    ):
+        super().__init__(db_client, local=local)
+        self._schema = {
+            "type": "object",
+            "properties": {
+                "talkRoomId": {
+                    "type": "string",
+                    "minLength": 33,
+                    "maxLength": 33,
+                    "pattern": r"^U[0-9a-f]{32}$|^C[0-9a-f]{32}$|^R[0-9a-f]{32}$",
+                },
+                "summary": {
+                    "type": "string",
+                    "minLength": 0,
+                    "maxLength": 100000,
+                },
+                "lastSeq": {
+                    "type": "integer",  # 要約に含めた最後の受け答えの seq
+                    "minimum": 1,
+                },
+                "tokens": {
+                    "type": "integer",
+                },
+                "encoding": {
+                    "type": "string",  # トークン数を数えたエンコーディングの名前
+                },
+                "expiresAt": {
+                    "type": "integer",  # UNIX time (DynamoDB の TTL 属性)
+                },
+                "createdAt": {
+                    "type": "string",
+                    "pattern": r"^(?:[\+-]?\d{4}(?!\d{2}\b))(?:(-?)(?:(?:0[1-9]|1[0-2])(?:\1(?:[12]\d|0[1-9]|3[01]))?|W(?:[0-4]\d|5[0-2])(?:-?[1-7])?|(?:00[1-9]|0[1-9]\d|[12]\d{2}|3(?:[0-5]\d|6[1-6])))(?:[T\s](?:(?:(?:[01]\d|2[0-3])(?:(:?)[0-5]\d)?|24\:?00)(?:[\.,]\d+(?!:))?)?(?:\2[0-5]\d(?:[\.,]\d+)?)?(?:[zZ]|(?:[\+-])(?:[01]\d|2[0-3]):?(?:[0-5]\d)?)?)?)?$",
+                },
+            },
+            "required": ["talkRoomId", "summary", "lastSeq"],
+        }
+        self._data = data
+
+    @classmethod
+    def create_instance(
+        cls,
+        talk_room_id: str,
+        summary: str,
+        last_seq: int,
+        tokens: int | None = None,
+        encoding: str | None = None,
+        db_client: DbClient | None = None,
+    ) -> "ConversationSummary":
+        """
+        Args:
+            talk_room_id: トークルームのID
+            summary: 要約
+            last_seq: 要約に含めた最後の受け答えの seq
+            tokens: summary のトークン数
+            encoding: tokens を数えたエンコーディングの名前
+        """
+        conversation_summary = ConversationSummary(
+            {
+                "talkRoomId": talk_room_id,
+                "summary": summary,
+                "lastSeq": last_seq,
+                "createdAt": datetime.datetime.now().isoformat(),
+                "expiresAt": int(time.time()) + cls.EXPIRES_AFTER_SEC,
+            },
+            db_client=db_client,
+        )
+        if tokens is not None and encoding:
+            conversation_summary.tokens = tokens
+            conversation_summary.encoding = encoding
+        return conversation_summary
+
+    @classmethod
+    def create_table(cls, db_client: DbClient | None = None, local: bool = False):
+        if not db_client:
+            db_client = DbClient.get_client(local=local)
+        db_client.create_table(
+            TableName=cls.TABLE,
+            AttributeDefinitions=[
+                {"AttributeName": "talkRoomId", "AttributeType": "S"},
+            ],
+            KeySchema=[
+                {"AttributeName": "talkRoomId", "KeyType": "HASH"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+    @classmethod
+    def get_table(cls) -> str:
+        return cls.TABLE
+
+    @classmethod
+    def get_query(
+        cls,
+        partition_key: str,
+        sort_op: SortKeyComparison | None = None,
+        sort_key1: str | None = None,
+        sort_key2: str | None = None,
+        limit: int = 1,
+        reverse: bool = False,
+        projection: list | None = None,
+    ) -> dict:
+        return cls.build_query(
+            partition_key,
+            sort_op,
+            sort_key1,
+            sort_key2,
+            limit,
+            reverse,
+            projection=projection,
+        )
+
+    def save(self):
+        """要約を保存する。
+
+        より新しい受け答えまで含む要約が保存済みの場合は上書きせず、
+        ConditionalCheckFailedException を送出する。
+        """
+        item = {}
+        self.validate()
+        properties = self._schema.get("properties", {})
+        for key, value in properties.items():
+            if self._data.get(key) is None:
+                continue
+            if value.get("type") == "string":
+                item[key] = {"S": self._data.get(key)}
+            elif value.get("type") in ("number", "integer"):
+                item[key] = {"N": str(self._data.get(key))}
+            elif value.get("type") == "boolean":
+                item[key] = {"BOOL": self._data.get(key)}
+
+        self._db_client.put_item(
+            TableName=self.get_table(),
+            Item=item,
+            ConditionExpression="attribute_not_exists(talkRoomId) OR lastSeq < :lastSeq",
+            ExpressionAttributeValues={":lastSeq": item["lastSeq"]},
+        )
+
+    def delete(self):
+        self._db_client.delete_item(
+            TableName=self.get_table(),
+            Key=self.get_key(),
+        )
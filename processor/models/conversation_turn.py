@@ -0,0 +1,259 @@
+import os
+import time
+import datetime
+from typing import Callable, List
+from models.db_client import DbClient
+from models.model_base import KeySchema, ModelBase, SortKeyComparison
+
+
+class ConversationTurn(ModelBase):
+    """トークルームの1回の受け答え(ユーザーのメッセージと ChatGPT の応答)。
+
+    トークルームごとに連番 (seq) を振って1件ずつ追記するため、会話が長くなっても
+    1回の書き込みの大きさは変わらない。
+    """
+
+    TABLE = os.getenv("DYNAMO_CONVERSATION_TURN_TABLE", "ConversationTurnTable")
+    # DynamoDB の TTL で削除されるまでの秒数(この期間を過ぎた受け答えは参照しない)
+    EXPIRES_AFTER_SEC = int(os.getenv("REQUEST_KEEP_SEC", 604800))
+    KEY_SCHEMAS = {None: KeySchema("talkRoomId", "seq", "N")}
+
+    def __init__(
+        self, data: dict, db_client: DbClient | None = None, local: bool = False
+    ):
+        super().__init__(db_client, local=local)
+        self._schema = {
+            "type": "object",
+            "properties": {
+                "talkRoomId": {
+                    "type": "string",
+                    "minLength": 33,
+                    "maxLength": 33,
+                    "pattern": r"^U[0-9a-f]{32}$|^C[0-9a-f]{32}$|^R[0-9a-f]{32}$",
+                },
+                "seq": {
+                    "type": "integer",
+                    "minimum": 1,
+                },
+                "userId": {
+                    "type": "string",
+                    "minLength": 0,
+                    "maxLength": 33,
+                    "pattern": r"^U[0-9a-f]{32}$|^$",
+                },
+                "userMessage": {
+                    "type": "string",
+                    "minLength": 0,
+                    "maxLength": 100000,
+                },
+                "assistantMessage": {
+                    "type": "string",
+                    "minLength": 0,
+                    "maxLength": 100000,
+                },
+                "userTokens": {
+                    "type": "integer",
+                },
+                "assistantTokens": {
+                    "type": "integer",
+                },
+                "encoding": {
+                    "type": "string",  # トークン数を数えたエンコーディングの名前
+                },
+                "expiresAt": {
+                    "type": "integer",  # UNIX time (DynamoDB の TTL 属性)
+                },
+                "createdAt": {
+                    "type": "string",
+                    "pattern": r"^(?:[\+-]?\d{4}(?!\d{2}\b))(?:(-?)(?:(?:0[1-9]|1[0-2])(?:\1(?:[12]\d|0[1-9]|3[01]))?|W(?:[0-4]\d|5[0-2])(?:-?[1-7])?|(?:00[1-9]|0[1-9]\d|[12]\d{2}|3(?:[0-5]\d|6[1-6])))(?:[T\s](?:(?:(?:[01]\d|2[0-3])(?:(:?)[0-5]\d)?|24\:?00)(?:[\.,]\d+(?!:))?)?(?:\2[0-5]\d(?:[\.,]\d+)?)?(?:[zZ]|(?:[\+-])(?:[01]\d|2[0-3]):?(?:[0-5]\d)?)?)?)?$",
+                },
+            },
+            "required": ["talkRoomId", "seq", "userMessage"],
+        }
+        self._data = data
+
+    @classmethod
+    def create_instance(
+        cls,
+        talk_room_id: str,
+        user_id: str,
+        seq: int,
+        user_message: str,
+        assistant_message: str | None = None,
+        tokens: tuple[int, int] | None = None,
+        encoding: str | None = None,
+        db_client: DbClient | None = None,
+    ) -> "ConversationTurn":
+        """
+        Args:
+            talk_room_id: トークルームのID
+            user_id: ユーザーID
+            seq: トークルーム内の連番(1から)
+            user_message: ユーザーのメッセージ
+            assistant_message: ChatGPT の応答(エラーの場合は None)
+            tokens: user_message と assistant_message のトークン数
+            encoding: tokens を数えたエンコーディングの名前
+        """
+        conversation_turn = ConversationTurn(
+            {
+                "talkRoomId": talk_room_id,
+                "seq": seq,
+                "userId": user_id or "",
+                "userMessage": user_message,
+                "createdAt": datetime.datetime.now().isoformat(),
+                "expiresAt": int(time.time()) + cls.EXPIRES_AFTER_SEC,
+            },
+            db_client=db_client,
+        )
+        if assistant_message is not None:
+            conversation_turn.assistantMessage = assistant_message
+        if tokens and encoding:
+            # 次回のリクエストでトークン数を数え直さずに済むように保存する
+            conversation_turn.userTokens = tokens[0]
+            conversation_turn.assistantTokens = tokens[1]
+            conversation_turn.encoding = encoding
+        return conversation_turn
+
+    @classmethod
+    def create_table(cls, db_client: DbClient | None = None, local: bool = False):
+        if not db_client:
+            db_client = DbClient.get_client(local=local)
+        db_client.create_table(
+            TableName=cls.TABLE,
+            AttributeDefinitions=[
+                {"AttributeName": "talkRoomId", "AttributeType": "S"},
+                {"AttributeName": "seq", "AttributeType": "N"},
+            ],
+            KeySchema=[
+                {"AttributeName": "talkRoomId", "KeyType": "HASH"},
+                {"AttributeName": "seq", "KeyType": "RANGE"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+    @classmethod
+    def get_table(cls) -> str:
+        return cls.TABLE
+
+    @classmethod
+    def get_query(
+        cls,
+        partition_key: str,
+        sort_op: SortKeyComparison | None = None,
+        sort_key1: str | None = None,
+        sort_key2: str | None = None,
+        limit: int = 1,
+        reverse: bool = False,
+        projection: list | None = None,
+    ) -> dict:
+        return cls.build_query(
+            partition_key,
+            sort_op,
+            sort_key1,
+            sort_key2,
+            limit,
+            reverse,
+            projection=projection,
+        )
+
+    @classmethod
+    def find_recent(
+        cls,
+        talk_room_id: str,
+        since: str,
+        max_tokens: int,
+        count_tokens: Callable[[str], int],
+        encoding: str,
+        db_client=None,
+        page_size: int = 20,
+        after_seq: int = 0,
+    ) -> List["ConversationTurn"]:
+        """トークン数の制限に収まる範囲の、新しい受け答えを返す。
+
+        新しいものから順に page_size 件ずつ読み(find_iter)、トークン数の合計が max_tokens を超えるか、
+        since より前、または seq が after_seq 以下の受け答えに達した時点で読むのをやめる
+        (制限を超えた受け答えも含めて返す)。
+        保存済みのトークン数は、エンコーディングが同じ場合だけ使う。
+
+        Args:
+            talk_room_id: トークルームのID
+            since: これより前 (createdAt) の受け答えは返さない
+            max_tokens: トークン数の制限
+            count_tokens: トークン数を数える関数
+            encoding: count_tokens のエンコーディングの名前
+            page_size: 1回のクエリで読む件数
+            after_seq: この seq 以前の受け答え(要約済みの受け答え)は返さない
+
+        Returns:
+            list: 古い順の受け答え(userTokens と assistantTokens は encoding で数えた値)
+        """
+        turns = []
+        total_tokens = 0
+        for turn in cls.find_iter(
+            cls.get_query(talk_room_id, reverse=True), db_client, page_size=page_size
+        ):
+            if turn.createdAt < since or turn.seq <= after_seq:
+                break
+            if turn.encoding != encoding or turn.userTokens is None:
+                turn.userTokens = count_tokens(turn.userMessage)
+                turn.assistantTokens = count_tokens(turn.assistantMessage)
+            turns.append(turn)
+            total_tokens += turn.userTokens + (turn.assistantTokens or 0)
+            if total_tokens > max_tokens:
+                break
+        turns.reverse()
+        return turns
+
+    @classmethod
+    def get_latest_seq(cls, talk_room_id: str, db_client=None) -> int:
+        """トークルームの最新の seq を返す(受け答えが無い場合は 0)。"""
+        # キーだけを読む
+        turns = cls.find(
+            cls.get_query(talk_room_id, limit=1, reverse=True, projection=[]),
+            db_client,
+        )
+        return turns[0].seq if turns else 0
+
+    @classmethod
+    def to_request(cls, turns: List["ConversationTurn"]) -> tuple[list, list]:
+        """受け答えを ChatGPT のメッセージのリストと、各メッセージのトークン数のリストにする。"""
+        messages = []
+        counts = []
+        for turn in turns:
+            messages.append({"role": "user", "content": turn.userMessage})
+            counts.append(turn.userTokens)
+            if turn.assistantMessage is not None:
+                messages.append({"role": "assistant", "content": turn.assistantMessage})
+                counts.append(turn.assistantTokens)
+        return messages, counts
+
+    def save(self):
+        """受け答えを保存する。
+
+        同じ seq の受け答えが保存済みの場合は上書きせず、
+        ConditionalCheckFailedException を送出する。
+        """
+        item = {}
+        self.validate()
+        properties = self._schema.get("properties", {})
+        for key, value in properties.items():
+            if self._data.get(key) is None:
+                continue
+            if value.get("type") == "string":
+                item[key] = {"S": self._data.get(key)}
+            elif value.get("type") in ("number", "integer"):
+                item[key] = {"N": str(self._data.get(key))}
+            elif value.get("type") == "boolean":
+                item[key] = {"BOOL": self._data.get(key)}
+
+        self._db_client.put_item(
+            TableName=self.get_table(),
+            Item=item,
+            ConditionExpression="attribute_not_exists(seq)",
+        )
+
+    def delete(self):
+        self._db_client.delete_item(
+            TableName=self.get_table(),
+            Key=self.get_key(),
+        )
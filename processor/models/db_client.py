@@ -1,18 +1,39 @@
 import os
+import threading
 import boto3
+from botocore.config import Config
 
 
 class DbClient:
+    # boto3 のデフォルトセッションはクライアントの生成がスレッドセーフではないため排他する
+    # (生成したクライアントはスレッドセーフ)
+    _lock = threading.Lock()
+
     def __init__(self, *args, **argv):
-        self._db_client = boto3.client("dynamodb", *args, **argv)
+        with self._lock:
+            self._db_client = boto3.client("dynamodb", *args, **argv)
 
     def __getattr__(self, __name: str):
         return getattr(self._db_client, __name)
 
     @classmethod
-    def get_client(cls, region_name: str | None = None, local: bool = False):
+    def get_client(
+        cls,
+        region_name: str | None = None,
+        local: bool = False,
+        timeout: float | None = None,
+    ):
+        """
+        DynamoDB クライアントを生成する
+
+        timeout を指定した場合は、接続と読み込みのタイムアウトをその秒数にする
+        (処理の期限を超えて DynamoDB の応答を待たないようにする)。
+        """
         if not region_name:
             region_name = os.getenv("REGION", "ap-northeast-1")
+        argv = {}
+        if timeout is not None:
+            argv["config"] = Config(connect_timeout=timeout, read_timeout=timeout)
         if local:
             return DbClient(
                 endpoint_url="http://127.0.0.1:8000",
@@ -20,5 +41,6 @@ class DbClient:
                 aws_access_key_id="fakeMyKeyId",
                 aws_secret_access_key="fakeSecretAccessKey",
                 aws_session_token="fakeSessionToken",
+                **argv,
             )
-        return DbClient(region_name=region_name)
+        return DbClient(region_name=region_name, **argv)
@@ -1,6 +1,7 @@
 import json
+import functools
 from abc import ABCMeta, abstractmethod
-from typing import Any, List
+from typing import Any, Iterator, List, NamedTuple
 from enum import Enum
 from jsonschema import validate
 from models.db_client import DbClient
@@ -16,15 +17,80 @@ class SortKeyComparison(Enum):
     BEGINS_WITH = 7  # begins_with (a, substr) - true if the value of attribute a begins with a particular substring.
 
 
+# 比較演算子ごとの KeyConditionExpression のソートキーの条件({key} はソートキー名)
+# (キー名が DynamoDB の予約語と重なっても良いように、ExpressionAttributeNames で置き換える)
+_SORT_KEY_CONDITIONS = {
+    SortKeyComparison.EQ: "#{key} = :{key}",
+    SortKeyComparison.LT: "#{key} < :{key}",
+    SortKeyComparison.LE: "#{key} <= :{key}",
+    SortKeyComparison.GT: "#{key} > :{key}",
+    SortKeyComparison.GE: "#{key} >= :{key}",
+    SortKeyComparison.BETWEEN: "#{key} BETWEEN :{key}1 AND :{key}2",
+    SortKeyComparison.BEGINS_WITH: "begins_with ( #{key}, :{key} )",
+}
+
+
+class KeySchema(NamedTuple):
+    """テーブルまたはインデックスのキー"""
+
+    partition_key: str
+    sort_key: str | None = None
+    sort_key_type: str = "S"  # ソートキーの型 ("S" または "N")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_query_template(
+    model: type,
+    index: str | None,
+    sort_op: SortKeyComparison | None,
+    projection: tuple | None = None,
+) -> tuple:
+    """クエリの雛形と、値を埋めるプレースホルダーを生成する(モデル・インデックス・比較演算子・射影ごとに1回)。
+
+    Returns:
+        tuple: クエリの雛形、パーティションキーのプレースホルダー、ソートキーのプレースホルダーのタプル、ソートキーの型
+    """
+    key_schema = model.KEY_SCHEMAS[index]
+    template = {"TableName": model.get_table()}
+    if index:
+        template["IndexName"] = model.get_table() + index
+    partition_key = ":" + key_schema.partition_key
+    condition = "#%s = %s" % (key_schema.partition_key, partition_key)
+    names = {"#" + key_schema.partition_key: key_schema.partition_key}
+    sort_keys = ()
+    if sort_op:
+        sort_condition = _SORT_KEY_CONDITIONS[sort_op].format(key=key_schema.sort_key)
+        condition += " AND " + sort_condition
+        names["#" + key_schema.sort_key] = key_schema.sort_key  # type: ignore
+        if sort_op == SortKeyComparison.BETWEEN:
+            sort_keys = (":%s1" % key_schema.sort_key, ":%s2" % key_schema.sort_key)
+        else:
+            sort_keys = (":" + key_schema.sort_key,)  # type: ignore
+    template["KeyConditionExpression"] = condition
+    if projection is not None:
+        # テーブルとインデックスのキーは常に読む(遅延読み込みの get_item に使う)
+        fields = list(dict.fromkeys(model.get_key_attributes(index) + projection))
+        for field in fields:
+            names["#" + field] = field
+        template["ProjectionExpression"] = ", ".join("#" + f for f in fields)
+    template["ExpressionAttributeNames"] = names
+    return template, partition_key, sort_keys, key_schema.sort_key_type
+
+
 class ModelBase(object):
     __metaclass__ = ABCMeta
 
+    # テーブル (None) とインデックス(インデックス名のテーブル名より後の部分)ごとのキー
+    KEY_SCHEMAS: dict = {}
+
     def __init__(self, db_client: DbClient | None = None, local: bool = False):
         if not db_client:
             db_client = self.new_db_client(local=local)
         super().__setattr__("_db_client", db_client)
         super().__setattr__("_schema", {})
         super().__setattr__("_data", {})
+        # 射影で読み込んだ属性名の集合(None の場合はすべての属性を読み込み済み)
+        super().__setattr__("_projection", None)
 
     def __setattr__(self, __name: str, __value: Any):
         if __name == "_db_client":
@@ -33,11 +99,13 @@ class ModelBase(object):
             super().__setattr__(__name, __value)
         elif __name == "_data":
             super().__setattr__(__name, __value)
+        elif __name == "_projection":
+            super().__setattr__(__name, __value)
         else:
             self._data[__name] = __value  # type: ignore
 
     def __getattr__(self, __name: str) -> Any:
-        return self._data.get(__name)  # type: ignore
+        return self.get(__name)
 
     @classmethod
     def new_db_client(cls, local: bool = False) -> DbClient:
@@ -63,25 +131,197 @@ class ModelBase(object):
         sort_key2: str | None = None,
         limit: int = 1,
         reverse: bool = False,
+        projection: list | None = None,
     ) -> dict:
         pass
 
     @classmethod
-    @abstractmethod
+    def build_query(
+        cls,
+        partition_key: str,
+        sort_op: SortKeyComparison | None = None,
+        sort_key1: str | None = None,
+        sort_key2: str | None = None,
+        limit: int = 1,
+        reverse: bool = False,
+        index: str | None = None,
+        projection: list | None = None,
+    ) -> dict:
+        """KEY_SCHEMAS のキーでテーブルまたはインデックスに問い合わせるクエリを返す。
+
+        KeyConditionExpression 等の雛形はモデル・インデックス・比較演算子・射影ごとに一度だけ
+        生成してキャッシュし、呼び出しのたびに値だけを埋める。
+
+        Args:
+            partition_key: パーティションキーの値
+            sort_op: ソートキーの比較演算子(None の場合はパーティションキーだけで問い合わせる)
+            sort_key1: ソートキーの値
+            sort_key2: BETWEEN の上限の値
+            limit: 取得する最大件数
+            reverse: True の場合はソートキーの降順
+            index: インデックス名のテーブル名より後の部分(None の場合はテーブル)
+            projection: 読み込む属性名のリスト(テーブルとインデックスのキーは常に読む)。
+                None の場合はすべての属性を読む
+        """
+        if not (sort_op and sort_key1):
+            sort_op = None
+        elif sort_op == SortKeyComparison.BETWEEN and not sort_key2:
+            return {}
+        template, partition_key_name, sort_key_names, sort_key_type = (
+            _get_query_template(
+                cls, index, sort_op, None if projection is None else tuple(projection)
+            )
+        )
+        query = dict(template)
+        query["ExpressionAttributeNames"] = dict(template["ExpressionAttributeNames"])
+        values = {partition_key_name: {"S": partition_key}}
+        for name, value in zip(sort_key_names, (sort_key1, sort_key2)):
+            values[name] = {sort_key_type: str(value)}
+        query["ExpressionAttributeValues"] = values
+        if sort_op != SortKeyComparison.EQ:
+            query["ScanIndexForward"] = not reverse
+            query["Limit"] = limit
+        return query
+
+    @classmethod
+    def get_key_attributes(cls, index: str | None = None) -> tuple:
+        """テーブルのキーと、index のキーの属性名を返す。"""
+        attributes = []
+        for key_schema in (cls.KEY_SCHEMAS[None], cls.KEY_SCHEMAS[index]):
+            attributes.append(key_schema.partition_key)
+            if key_schema.sort_key:
+                attributes.append(key_schema.sort_key)
+        return tuple(dict.fromkeys(attributes))
+
+    @classmethod
+    def get_projection(cls, query: dict) -> set | None:
+        """クエリの ProjectionExpression で読み込む属性名の集合を返す(射影しない場合は None)。"""
+        if not query.get("ProjectionExpression"):
+            return None
+        names = query.get("ExpressionAttributeNames", {})
+        return {
+            names.get(name.strip(), name.strip())
+            for name in query["ProjectionExpression"].split(",")
+        }
+
+    @classmethod
+    def from_item(
+        cls,
+        item: dict,
+        db_client: DbClient | None = None,
+        projection: set | None = None,
+    ) -> "ModelBase":
+        """DynamoDB の項目(属性の型付きの値)からモデルを生成する。
+
+        projection を指定した場合は、それ以外の属性を参照した時点で項目全体を読み直す。
+        """
+        _item = {}
+        for _key, _value in item.items():
+            for _type, _subvalue in _value.items():
+                if _type == "N":
+                    _subvalue = int(_subvalue)
+                _item[_key] = _subvalue
+                break
+        model = cls(_item, db_client)  # type: ignore
+        model._projection = projection
+        return model
+
+    @classmethod
+    def find_iter(
+        cls,
+        query: dict,
+        db_client: DbClient | None = None,
+        page_size: int | None = None,
+        max_items: int | None = None,
+    ) -> Iterator["ModelBase"]:
+        """クエリの結果を1件ずつ返すイテレーター。
+
+        LastEvaluatedKey でページを進めながら、次のページは必要になった時点で読む
+        (途中で反復をやめれば、それ以降のページは読まない)。
+
+        Args:
+            query: クエリ
+            page_size: 1回のクエリで読む最大件数(None の場合はクエリの Limit)
+            max_items: 返す最大件数(None の場合は無制限)
+        """
+        if not db_client:
+            db_client = cls.new_db_client()
+        projection = cls.get_projection(query)
+        query = dict(query)
+        if page_size:
+            query["Limit"] = page_size
+        page_size = query.get("Limit")
+        count = 0
+        while max_items is None or count < max_items:
+            if max_items is not None and page_size:
+                # 返す件数より多くは読まない
+                query["Limit"] = min(page_size, max_items - count)
+            res = db_client.query(**query)
+            for item in res.get("Items", []):
+                yield cls.from_item(item, db_client, projection)
+                count += 1
+            if not res.get("LastEvaluatedKey"):
+                return
+            query["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+    @classmethod
     def find(cls, query: dict, db_client: DbClient | None = None) -> List["ModelBase"]:
-        pass
+        """クエリの結果をリストで返す。
+
+        クエリの Limit の件数に達するか、結果が無くなるまでページを読む
+        (1回のクエリの上限 1MB で結果が切り捨てられない)。
+        """
+        return list(cls.find_iter(query, db_client, max_items=query.get("Limit")))
 
     def serialize(self):
         return json.dumps(self._data, ensure_ascii=False, sort_keys=True)
 
+    def get_key(self) -> dict:
+        """テーブルのキー(delete_item 等の Key)を返す。"""
+        key_schema = self.KEY_SCHEMAS[None]
+        key = {
+            key_schema.partition_key: {"S": self._data.get(key_schema.partition_key)}
+        }
+        if key_schema.sort_key:
+            key[key_schema.sort_key] = {
+                key_schema.sort_key_type: str(self._data.get(key_schema.sort_key))
+            }
+        return key
+
     def get_db_client(self) -> DbClient:
         return self._db_client
 
+    def is_loaded(self, field: str) -> bool:
+        """field を読み込み済み(射影で除いていない)の場合は True を返す。"""
+        return self._projection is None or field in self._projection
+
+    def load(self):
+        """射影で読み込まなかった属性を含め、項目全体を get_item で読み直す。
+
+        読み込み済みの属性に設定した値は、読み直した値より優先する。
+        項目が削除されていた場合は LookupError を送出する。
+        """
+        res = self._db_client.get_item(TableName=self.get_table(), Key=self.get_key())
+        if not res.get("Item"):
+            raise LookupError("Item not found: %s" % json.dumps(self.get_key()))
+        data = self.from_item(res["Item"], self._db_client)._data
+        data.update(self._data)
+        self._data = data
+        self._projection = None
+
     def validate(self):
+        if self._projection is not None:
+            # 一部の属性だけを読み込んだモデルを保存すると、他の属性が失われる
+            raise ValueError(
+                "Cannot save a model loaded with a projection (call load() first)"
+            )
         validate(instance=self._data, schema=self._schema)
 
     def get(self, field: str) -> Any:
-        return self._data.get(field)
+        if not self.is_loaded(field) and field in self._schema.get("properties", {}):
+            # 射影で読み込まなかった属性は、参照した時点で読み直す
+            self.load()
+        return self._data.get(field)  # type: ignore
 
     def set(self, field: str, value: Any):
         self._data[field] = value
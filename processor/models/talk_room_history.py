@@ -1,13 +1,16 @@
 import os
 import datetime
-from typing import List
 from models.db_client import DbClient
-from models.model_base import ModelBase, SortKeyComparison
+from models.model_base import KeySchema, ModelBase, SortKeyComparison
 
 
 class TalkRoomHistory(ModelBase):
 
     TABLE = os.getenv("DYNAMO_TALK_ROOM_HISTORY_TABLE", "TalkRoomHistoryTable")
+    KEY_SCHEMAS = {
+        None: KeySchema("talkRoomId", "createdAt"),
+        "GSI1": KeySchema("userId", "createdAt"),
+    }
 
     def __init__(
         self, data: dict, db_client: DbClient | None = None, local: bool = False
@@ -42,7 +45,9 @@ class TalkRoomHistory(ModelBase):
         self._data = data
 
     @classmethod
-    def from_line_event(cls, line_event, local: bool = False) -> "TalkRoomHistory":
+    def from_line_event(
+        cls, line_event, local: bool = False, db_client: DbClient | None = None
+    ) -> "TalkRoomHistory":
         text_message = None
         user_id = None
         group_id = None
@@ -65,6 +70,7 @@ class TalkRoomHistory(ModelBase):
                 "textMessage": text_message,
                 "createdAt": datetime.datetime.now().isoformat(),
             },
+            db_client=db_client,
             local=local,
         )
 
@@ -112,94 +118,17 @@ class TalkRoomHistory(ModelBase):
         sort_key2: str | None = None,
         limit: int = 1,
         reverse: bool = False,
+        projection: list | None = None,
     ) -> dict:
-        if sort_op and sort_key1:
-            if sort_op == SortKeyComparison.EQ:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt = :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                }
-            elif sort_op == SortKeyComparison.LT:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt < :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.LE:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt <= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GT:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt > :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GE:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt >= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.BETWEEN:
-                if sort_key2:
-                    return {
-                        "TableName": cls.get_table(),
-                        "KeyConditionExpression": "talkRoomId = :talkRoomId AND createdAt BETWEEN :createdAt1 AND :createdAt2",
-                        "ExpressionAttributeValues": {
-                            ":talkRoomId": {"S": partition_key},
-                            ":createdAt1": {"S": sort_key1},
-                            ":createdAt2": {"S": sort_key2},
-                        },
-                        "ScanIndexForward": not reverse,
-                        "Limit": limit,
-                    }
-                else:
-                    return {}
-            elif sort_op == SortKeyComparison.BEGINS_WITH:
-                return {
-                    "TableName": cls.get_table(),
-                    "KeyConditionExpression": "talkRoomId = :talkRoomId AND begins_with ( createdAt, :createdAt )",
-                    "ExpressionAttributeValues": {
-                        ":talkRoomId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-        return {
-            "TableName": cls.get_table(),
-            "KeyConditionExpression": "talkRoomId = :talkRoomId",
-            "ExpressionAttributeValues": {":talkRoomId": {"S": partition_key}},
-            "ScanIndexForward": not reverse,
-            "Limit": limit,
-        }
+        return cls.build_query(
+            partition_key,
+            sort_op,
+            sort_key1,
+            sort_key2,
+            limit,
+            reverse,
+            projection=projection,
+        )
 
     @classmethod
     def get_gs1_query(
@@ -210,119 +139,18 @@ class TalkRoomHistory(ModelBase):
         sort_key2: str | None = None,
         limit: int = 1,
         reverse: bool = False,
+        projection: list | None = None,
     ) -> dict:
-        if sort_op and sort_key1:
-            if sort_op == SortKeyComparison.EQ:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt = :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                }
-            elif sort_op == SortKeyComparison.LT:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt < :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.LE:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt <= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GT:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt > :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.GE:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND createdAt >= :createdAt",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-            elif sort_op == SortKeyComparison.BETWEEN:
-                if sort_key2:
-                    return {
-                        "TableName": cls.get_table(),
-                        "IndexName": cls.get_table() + "GSI1",
-                        "KeyConditionExpression": "userId = :userId AND createdAt BETWEEN :createdAt1 AND :createdAt2",
-                        "ExpressionAttributeValues": {
-                            ":userId": {"S": partition_key},
-                            ":createdAt1": {"S": sort_key1},
-                            ":createdAt2": {"S": sort_key2},
-                        },
-                        "ScanIndexForward": not reverse,
-                        "Limit": limit,
-                    }
-                else:
-                    return {}
-            elif sort_op == SortKeyComparison.BEGINS_WITH:
-                return {
-                    "TableName": cls.get_table(),
-                    "IndexName": cls.get_table() + "GSI1",
-                    "KeyConditionExpression": "userId = :userId AND begins_with ( createdAt, :createdAt )",
-                    "ExpressionAttributeValues": {
-                        ":userId": {"S": partition_key},
-                        ":createdAt": {"S": sort_key1},
-                    },
-                    "ScanIndexForward": not reverse,
-                    "Limit": limit,
-                }
-        return {
-            "TableName": cls.get_table(),
-            "IndexName": cls.get_table() + "GSI1",
-            "KeyConditionExpression": "userId = :userId",
-            "ExpressionAttributeValues": {":userId": {"S": partition_key}},
-            "ScanIndexForward": not reverse,
-            "Limit": limit,
-        }
-
-    @classmethod
-    def find(cls, query: dict, db_client=None) -> List["TalkRoomHistory"]:
-        if not db_client:
-            db_client = cls.new_db_client()
-        res = db_client.query(**query)
-        results = []
-        if not res.get("Items"):
-            return results
-        for item in res["Items"]:
-            _item = {}
-            for _key, _value in item.items():
-                for _, _subvalue in _value.items():
-                    _item[_key] = _subvalue
-                    break
-            results.append(TalkRoomHistory(_item, db_client))
-        return results
+        return cls.build_query(
+            partition_key,
+            sort_op,
+            sort_key1,
+            sort_key2,
+            limit,
+            reverse,
+            index="GSI1",
+            projection=projection,
+        )
 
     def save(self):
         item = {}
@@ -344,8 +172,5 @@ class TalkRoomHistory(ModelBase):
     def delete(self):
         self._db_client.delete_item(
             TableName=self.get_table(),
-            Key={
-                "talkRoomId": {"S": self._data.get("talkRoomId")},
-                "createdAt": {"S": self._data.get("createdAt")},
-            },
+            Key=self.get_key(),
         )
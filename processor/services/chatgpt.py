@@ -1,12 +1,171 @@
 import os
+import asyncio
+import atexit
+import bisect
+import itertools
+import random
+import threading
+import time
 import openai
 import tiktoken
+from collections import deque
 from enum import Enum
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    wait,
+)
+from common.logger_factory import LoggerFactory
+
+# ログ出力設定
+LOGGER_LEVEL = os.environ.get("LOGGER_LEVEL", "INFO")
+logger = LoggerFactory.get_logger(__name__, log_level=LOGGER_LEVEL)
 
 openai.organization = os.environ.get("OPENAI_ORGANIZATION", "").strip("\"'")
 openai.api_key = os.environ.get("OPENAI_API_KEY", "").strip("\"'")
 
+# モデル名ごとの tiktoken のエンコーディング
+# (tiktoken.encoding_for_model はモデル名の解決とエンコーディングの検索を毎回行うため、結果を保持する)
+_encodings: dict[str, tiktoken.Encoding] = {}
+
+
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """モデル名に対応する tiktoken のエンコーディングを返す(初回のみ読み込む)。
+
+    BPE ファイルは TIKTOKEN_CACHE_DIR から読み込まれる(無い場合はダウンロードされる)。
+    """
+    encoding = _encodings.get(model_name)
+    if encoding is None:
+        encoding = tiktoken.encoding_for_model(model_name)
+        _encodings[model_name] = encoding
+    return encoding
+
+
+# タイムアウトを指定した OpenAI API の呼び出しに使うスレッドプール(全リクエストで共有する)
+OPENAI_EXECUTOR_MAX_WORKERS = int(os.environ.get("OPENAI_EXECUTOR_MAX_WORKERS", 10))
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """OpenAI API の呼び出しに使う共有のスレッドプールを返す(初回のみ生成する)。
+
+    リクエストごとにスレッドプールを生成すると、Lambda のコンテナが再利用される間
+    スレッドが増え続けるため、最大 OPENAI_EXECUTOR_MAX_WORKERS スレッドのプールを共有する。
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=OPENAI_EXECUTOR_MAX_WORKERS,
+                    thread_name_prefix="openai",
+                )
+    return _executor
+
+
+@atexit.register
+def shutdown_executor() -> None:
+    """共有のスレッドプールを終了する(実行中の呼び出しは待たない)。"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+# 再送する OpenAI API のエラー(レート制限、サーバ側のエラー、接続エラー)
+RETRIABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+)
+
+# 再送の最大回数と、再送までの待ち時間(指数バックオフ)の初期値/上限
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 3))
+OPENAI_RETRY_BASE_SEC = float(os.environ.get("OPENAI_RETRY_BASE_SEC", 0.5))
+OPENAI_RETRY_MAX_SEC = float(os.environ.get("OPENAI_RETRY_MAX_SEC", 8))
+
+
+def get_retry_delay(
+    attempt: int, error: Exception, deadline: float | None = None
+) -> float | None:
+    """attempt 回目(0 始まり)の送信が失敗した後、再送までに待つ秒数を返す。
+
+    待ち時間は指数バックオフの上限までの一様乱数(フルジッター)とし、
+    Retry-After ヘッダーがあればそれ以上待つ。再送しない場合は None を返す。
+
+    Args:
+        attempt: 失敗した送信の回数 - 1
+        error: 送信時に発生した例外
+        deadline: 再送を含めて応答を待てる期限 (time.monotonic() の値)
+    """
+    if attempt >= OPENAI_MAX_RETRIES:
+        return None
+    # APIError のうち、リクエスト内容に問題がある 4xx (レート制限以外) は再送しない
+    http_status = getattr(error, "http_status", None)
+    if (
+        http_status is not None
+        and 400 <= http_status < 500
+        and not isinstance(error, openai.error.RateLimitError)
+    ):
+        return None
+    delay = random.uniform(
+        0, min(OPENAI_RETRY_MAX_SEC, OPENAI_RETRY_BASE_SEC * 2**attempt)
+    )
+    headers = getattr(error, "headers", None) or {}
+    try:
+        delay = max(delay, float(headers.get("retry-after", 0)))
+    except (TypeError, ValueError):
+        pass
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+
+def get_attempt_timeout(
+    timeout: float | None, deadline: float | None = None
+) -> float | None:
+    """1回の送信のタイムアウト秒数を、期限までの残り時間以内に切り詰めて返す。
+
+    期限を過ぎている場合は TimeoutError を送出する。
+    """
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise FutureTimeoutError()
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+# 応答時間がこのパーセンタイルを超えた場合に、同じリクエストをもう1つ送信する(0 の場合は送信しない)
+OPENAI_HEDGE_PERCENTILE = float(os.environ.get("OPENAI_HEDGE_PERCENTILE", 0))
+# パーセンタイルの計算に使う、最近の応答時間の数(この数に満たない間は送信しない)
+OPENAI_HEDGE_MIN_SAMPLES = 20
+_latencies: deque = deque(maxlen=200)
+_latencies_lock = threading.Lock()
+
+
+def record_latency(latency: float) -> None:
+    """OpenAI API の応答時間を記録する。"""
+    with _latencies_lock:
+        _latencies.append(latency)
+
+
+def get_hedge_delay() -> float | None:
+    """同じリクエストをもう1つ送信するまでの秒数を返す。送信しない場合は None を返す。"""
+    if OPENAI_HEDGE_PERCENTILE <= 0:
+        return None
+    with _latencies_lock:
+        if len(_latencies) < OPENAI_HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(_latencies)
+    index = min(int(len(latencies) * OPENAI_HEDGE_PERCENTILE / 100), len(latencies) - 1)
+    return latencies[index]
+
 
 class ChatGptRole(Enum):
     SYSTEM = "system"
@@ -22,6 +181,21 @@ class ChatGptRole(Enum):
 
 
 class ChatGpt:
+    # ストリーミング時に、生成途中の応答を on_chunk に渡す条件
+    # (STREAM_CHUNK_MIN_CHARS 文字以上で文末に達したとき、または STREAM_CHUNK_MAX_CHARS 文字に達したとき)
+    STREAM_CHUNK_MIN_CHARS = 100
+    STREAM_CHUNK_MAX_CHARS = 2000
+    SENTENCE_TERMINATORS = ("。", "！", "？", "!", "?", ".", "\n")
+
+    @classmethod
+    def preload_encoding(cls, model_name: str = "") -> None:
+        """コールドスタート時に tiktoken のエンコーディングを読み込んでおく。"""
+        if not model_name:
+            model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo").strip(
+                "\"'"
+            )
+        get_encoding(model_name)
+
     def __init__(
         self,
         model_name: str = "",
@@ -29,6 +203,8 @@ class ChatGpt:
         system_message: str = "",
         text_message: str = "",
         past_request: list = [],
+        past_request_tokens: dict | None = None,
+        completion_tokens: int | None = None,
     ) -> None:
         if not model_name:
             model_name = os.environ.get("OPENAI_MODEL_NAME", "gpt-3.5-turbo").strip(
@@ -40,89 +216,375 @@ class ChatGpt:
             system_message = os.environ.get(
                 "OPENAI_CHAT_GPT_SYSTEM_MESSAGE", "This is a default system."
             ).strip("\"'")
+        if completion_tokens is None:
+            completion_tokens = int(
+                os.environ.get("OPENAI_COMPLETION_RESERVED_TOKENS", 0)  # type: ignore
+            )
         self.model_name = model_name
-        self.max_tokens = max_tokens
+        # 応答(completion)用に確保するトークン数を除いた分を、リクエストに使う
+        self.completion_tokens = completion_tokens
+        self.max_tokens = max_tokens - completion_tokens
+        self.encoding = get_encoding(model_name)
         self.response = None
         self.tokens = self.count_tokens(system_message)
         self.request = [{"role": ChatGptRole.SYSTEM.value, "content": system_message}]
+        # self.request の各メッセージのトークン数
+        self.request_tokens = [self.tokens]
 
         if text_message:
-            remaining_available_tokens = self.remaining_available_tokens(text_message)
-            if remaining_available_tokens < 0:
-                # トークン数の制限を超える分のテキストは切り捨てる
-                text_message = text_message[:remaining_available_tokens]
+            # トークン数の制限を超える分のテキストは切り捨てる
+            text_message = self.truncate_tokens(
+                text_message, self.max_tokens - self.tokens
+            )
             # text_messageを送信用メッセージリストに追加
-            while not self.add_message(ChatGptRole.USER, text_message):
-                # トークン数の制限を超える場合は追加されない
-                # その場合はテキストの末尾を切り捨てて追加できるまで繰り返す
-                text_message = text_message[:-1]
+            self.add_message(ChatGptRole.USER, text_message)
 
         if past_request and type(past_request) is list:
-            for message in reversed(past_request):
-                if type(message) is dict:
-                    # 過去の受け答えを、新しい順に送信用メッセージリストに追加
-                    if not self.add_message(
-                        ChatGptRole.value_of(message.get("role")),
-                        message.get("content", ""),
-                        reverse=True,
-                    ):
-                        # 追加できなくなった時点で終了(トークン制限を超える古いメッセージは無視)
-                        break
+            self.add_past_request(past_request, past_request_tokens)
+
+    def add_past_request(
+        self, past_request: list, past_request_tokens: dict | None = None
+    ) -> None:
+        """過去の受け答えを、トークン数の制限に収まる範囲で新しいものから順に追加する。
+
+        過去のリクエストのシステムメッセージより後のメッセージが対象。
+        新しい順に累積したトークン数の中から制限に収まる位置を二分探索で求め、
+        システムメッセージの直後に一度に挿入する。
+        """
+        # 過去のリクエストと同じエンコーディングで数えたトークン数があれば再利用する
+        past_counts = [None] * len(past_request)
+        if (
+            past_request_tokens
+            and past_request_tokens.get("encoding") == self.encoding.name
+            and len(past_request_tokens.get("counts", [])) == len(past_request)
+        ):
+            past_counts = past_request_tokens["counts"]
+        messages = []
+        counts = []
+        for message, tokens in zip(past_request, past_counts):
+            if type(message) is not dict:
+                continue
+            role = ChatGptRole.value_of(message.get("role"))
+            if role == ChatGptRole.SYSTEM:
+                # システムメッセージより古いメッセージは使わない
+                messages = []
+                counts = []
+                continue
+            content = message.get("content", "")
+            messages.append({"role": role.value, "content": content})
+            counts.append(self.count_tokens(content) if tokens is None else tokens)
+        if not messages:
+            return
+
+        # 新しいメッセージから累積したトークン数(単調増加)
+        cumulative_counts = list(itertools.accumulate(reversed(counts)))
+        n = bisect.bisect_right(cumulative_counts, self.max_tokens - self.tokens)
+        if n == 0:
+            return
+        i = self._get_history_index()
+        self.request[i:i] = messages[-n:]
+        self.request_tokens[i:i] = counts[-n:]
+        self.tokens += cumulative_counts[n - 1]
 
     def count_tokens(self, content: str | None) -> int:
         if not content:
             return 0
-        enc = tiktoken.encoding_for_model(self.model_name)
-        return len(enc.encode(content))
+        return len(self.encoding.encode(content))
+
+    def truncate_tokens(self, content: str, max_tokens: int) -> str:
+        """content を先頭から max_tokens トークン以内に切り詰める。
+
+        エンコードは1回だけ行い、先頭 max_tokens トークンをデコードする。
+        マルチバイト文字の途中で切れた場合、その文字は捨てる。
+        """
+        if max_tokens <= 0:
+            return ""
+        tokens = self.encoding.encode(content)
+        if len(tokens) <= max_tokens:
+            return content
+        cut = max_tokens
+        while cut > 0:
+            content = self.encoding.decode_bytes(tokens[:cut]).decode(
+                "utf-8", errors="ignore"
+            )
+            # デコード結果を再エンコードするとトークン数が変わる場合があるため確認し、
+            # 収まらない場合は切る位置を1トークンずつ前にずらす
+            if len(self.encoding.encode(content)) <= max_tokens:
+                return content
+            cut -= 1
+        return ""
 
     def remaining_available_tokens(self, content: str) -> int:
         _tokens = self.count_tokens(content)
         return self.max_tokens - (self.tokens + _tokens)
 
     def add_message(
-        self, role: ChatGptRole, content: str, reverse: bool = False
+        self,
+        role: ChatGptRole,
+        content: str,
+        reverse: bool = False,
+        tokens: int | None = None,
     ) -> bool:
         if role == ChatGptRole.SYSTEM:
             return False
-        _tokens = self.count_tokens(content)
+        _tokens = self.count_tokens(content) if tokens is None else tokens
         if self.tokens + _tokens > self.max_tokens:
             return False
         if reverse:
-            self.request.insert(1, {"role": role.value, "content": content})
+            i = self._get_history_index()
+            self.request.insert(i, {"role": role.value, "content": content})
+            self.request_tokens.insert(i, _tokens)
         else:
             self.request.append({"role": role.value, "content": content})
+            self.request_tokens.append(_tokens)
         self.tokens += _tokens
         return True
 
-    def send(self, timeout: float | None = None) -> bool:
-        if len(self.request) < 2:
+    def add_summary(self, content: str, tokens: int | None = None) -> bool:
+        """それまでの会話の要約を、システムメッセージの直後にシステムメッセージとして追加する。
+
+        過去の受け答えより先に追加すること。トークン数の制限に収まらない場合は追加せずに False を返す。
+        """
+        _tokens = self.count_tokens(content) if tokens is None else tokens
+        if self.tokens + _tokens > self.max_tokens:
             return False
-        if self.request[1]["role"] == ChatGptRole.ASSISTANT.value:
-            del self.request[1]
-            if len(self.request) < 2:
-                return False
-        if timeout is not None:
-            tpe = ThreadPoolExecutor(max_workers=1)
+        i = self._get_history_index()
+        self.request.insert(i, {"role": ChatGptRole.SYSTEM.value, "content": content})
+        self.request_tokens.insert(i, _tokens)
+        self.tokens += _tokens
+        return True
+
+    def _get_history_index(self) -> int:
+        """先頭のシステムメッセージ(要約を含む)の直後、過去の受け答えを挿入する位置を返す。"""
+        i = 0
+        while (
+            i < len(self.request)
+            and self.request[i]["role"] == ChatGptRole.SYSTEM.value
+        ):
+            i += 1
+        return i
+
+    def send(
+        self,
+        timeout: float | None = None,
+        on_chunk: Callable[[str, bool], None] | None = None,
+        deadline: float | None = None,
+    ) -> bool:
+        """リクエストを OpenAI のサーバに送信し、応答を受信する。
+
+        レート制限やサーバ側のエラーの場合は、ジッターを加えた指数バックオフで再送する。
+
+        Args:
+            timeout: 1回の送信のタイムアウト秒数。ストリーミング時は HTTP の接続/読み込みのタイムアウト
+            on_chunk: 指定した場合はストリーミングで受信し、生成途中の応答を
+                on_chunk(テキスト, 最後の部分か) で順に渡す
+            deadline: 再送を含めて応答を待てる期限 (time.monotonic() の値)。
+                ストリーミング時は、期限までに受信した部分で応答を打ち切る
+
+        Returns:
+            bool: 送信した場合は True
+        """
+        params = self._get_params()
+        if params is None:
+            return False
+        for attempt in itertools.count():
+            chunk_sent = False
+            attempt_timeout = get_attempt_timeout(timeout, deadline)
+
+            def _on_chunk(text: str, last: bool):
+                nonlocal chunk_sent
+                chunk_sent = True
+                on_chunk(text, last)  # type: ignore
+
             try:
-                future = tpe.submit(
-                    openai.ChatCompletion.create,
-                    model=self.model_name,
-                    messages=self.request,
-                    timeout=timeout,
+                if on_chunk is not None:
+                    self.response = self._receive_stream(
+                        params, attempt_timeout, _on_chunk, deadline
+                    )
+                elif attempt_timeout is not None:
+                    self.response = self._create_with_timeout(params, attempt_timeout)
+                else:
+                    self.response = openai.ChatCompletion.create(**params)
+                return True
+            except RETRIABLE_ERRORS as e:
+                # 生成途中の応答を渡し始めた後は再送しない
+                delay = None if chunk_sent else get_retry_delay(attempt, e, deadline)
+                if delay is None:
+                    raise
+                logger.warning("Retry the OpenAI API request in %.2f sec: %s", delay, e)
+                time.sleep(delay)
+        return False  # pragma: no cover
+
+    async def asend(
+        self, timeout: float | None = None, deadline: float | None = None
+    ) -> bool:
+        """send の asyncio 版。イベントループをブロックせずに応答を待つ。
+
+        Args:
+            timeout: 1回の送信のタイムアウト秒数
+            deadline: 再送を含めて応答を待てる期限 (time.monotonic() の値)
+
+        Returns:
+            bool: 送信した場合は True
+        """
+        params = self._get_params()
+        if params is None:
+            return False
+        for attempt in itertools.count():
+            attempt_timeout = get_attempt_timeout(timeout, deadline)
+            try:
+                self.response = await asyncio.wait_for(
+                    openai.ChatCompletion.acreate(
+                        request_timeout=attempt_timeout, **params
+                    ),
+                    attempt_timeout,
                 )
-                self.response = future.result(timeout=timeout)
-            except FutureTimeoutError:
-                tpe.shutdown(wait=False, cancel_futures=True)
-                raise
-        else:
-            self.response = openai.ChatCompletion.create(
-                model=self.model_name, messages=self.request
+                return True
+            except RETRIABLE_ERRORS as e:
+                delay = get_retry_delay(attempt, e, deadline)
+                if delay is None:
+                    raise
+                logger.warning("Retry the OpenAI API request in %.2f sec: %s", delay, e)
+                await asyncio.sleep(delay)
+        return False  # pragma: no cover
+
+    def _create_with_timeout(self, params: dict, timeout: float) -> dict:
+        """共有のスレッドプールで ChatCompletion API を呼び出し、timeout 秒まで待つ。
+
+        OPENAI_HEDGE_PERCENTILE を指定した場合、最近の応答時間のパーセンタイルを超えても
+        応答が無ければ同じリクエストをもう1つ送信し、先に返った応答を使う。
+        """
+
+        def create():
+            start = time.monotonic()
+            # HTTP のタイムアウトも指定し、タイムアウト後にスレッドが占有され続けないようにする
+            response = openai.ChatCompletion.create(
+                timeout=timeout, request_timeout=timeout, **params
             )
-        return True
+            record_latency(time.monotonic() - start)
+            return response
+
+        end = time.monotonic() + timeout
+        futures = [get_executor().submit(create)]
+        hedge_delay = get_hedge_delay()
+        try:
+            if hedge_delay is not None and hedge_delay < timeout:
+                done, _ = wait(futures, timeout=hedge_delay)
+                if not done:
+                    logger.info("Send a hedged request after %.2f sec", hedge_delay)
+                    futures.append(get_executor().submit(create))
+            while True:
+                remaining = end - time.monotonic()
+                done, _ = wait(
+                    futures, timeout=max(remaining, 0), return_when=FIRST_COMPLETED
+                )
+                if not done:
+                    raise FutureTimeoutError()
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                futures = [f for f in futures if f not in done]
+                if not futures:
+                    # すべて失敗した場合は、最後に失敗したリクエストの例外を送出する
+                    raise done.pop().exception()  # type: ignore
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _get_params(self) -> dict | None:
+        """ChatCompletion API に渡すパラメータを返す。送信するメッセージが無い場合は None"""
+        i = self._get_history_index()
+        if len(self.request) <= i:
+            return None
+        if self.request[i]["role"] == ChatGptRole.ASSISTANT.value:
+            del self.request[i]
+            self.tokens -= self.request_tokens.pop(i)
+            if len(self.request) <= i:
+                return None
+        params = {"model": self.model_name, "messages": self.request}
+        if self.completion_tokens > 0:
+            # 応答のトークン数を、確保したトークン数までに制限する
+            params["max_tokens"] = self.completion_tokens
+        return params
+
+    def _receive_stream(
+        self,
+        params: dict,
+        timeout: float | None,
+        on_chunk: Callable[[str, bool], None],
+        deadline: float | None = None,
+    ) -> dict:
+        """stream=True で応答を受信し、区切りのよい長さごとに on_chunk に渡す。
+
+        最後の部分かどうかを on_chunk に伝えるため、区切った部分は次の差分を
+        受信してから渡す。受信し終えた応答は、stream=False の場合と同じ形式で返す。
+
+        timeout は HTTP の読み込みごとのタイムアウトのため、差分が届き続ける限り
+        生成全体の時間は制限されない。deadline (time.monotonic() の値) を過ぎた場合は
+        それまでに受信した部分で応答を打ち切り (finish_reason は "length")、
+        何も受信していない場合は TimeoutError を送出する。
+        """
+        chunks = openai.ChatCompletion.create(
+            stream=True, request_timeout=timeout, **params
+        )
+        contents = []
+        buffer = ""
+        ready = None
+        response = {}
+        finish_reason = None
+        for chunk in chunks:
+            if deadline is not None and time.monotonic() >= deadline:
+                if not contents:
+                    raise FutureTimeoutError()
+                logger.warning("Truncated the streamed response at the deadline")
+                finish_reason = "length"
+                break
+            if not response:
+                response = {
+                    "id": chunk.get("id"),
+                    "object": "chat.completion",
+                    "created": chunk.get("created"),
+                    "model": chunk.get("model"),
+                }
+            if not chunk.get("choices"):
+                continue
+            choice = chunk["choices"][0]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            delta = choice.get("delta", {}).get("content")
+            if not delta:
+                continue
+            if ready is not None:
+                on_chunk(ready, False)
+                ready = None
+            contents.append(delta)
+            buffer += delta
+            if len(buffer) >= self.STREAM_CHUNK_MAX_CHARS or (
+                len(buffer) >= self.STREAM_CHUNK_MIN_CHARS
+                and buffer.rstrip(" ").endswith(self.SENTENCE_TERMINATORS)
+            ):
+                ready, buffer = buffer, ""
+        last = ready if ready is not None else buffer
+        if last:
+            on_chunk(last, True)
+        response["choices"] = [
+            {
+                "index": 0,
+                "message": {
+                    "role": ChatGptRole.ASSISTANT.value,
+                    "content": "".join(contents),
+                },
+                "finish_reason": finish_reason,
+            }
+        ]
+        return response
 
     def get_request(self):
         return self.request
 
+    def get_request_tokens(self) -> dict:
+        """リクエストの各メッセージのトークン数を、数えたエンコーディング名とともに返す。"""
+        return {"encoding": self.encoding.name, "counts": list(self.request_tokens)}
+
     def get_response(self) -> dict:
         return self.response  # type: ignore
 
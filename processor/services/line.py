@@ -1,6 +1,9 @@
 import os
 import sys
-from linebot import LineBotApi
+import aiohttp
+from linebot import LineBotApi, AsyncLineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
 from linebot.models import TextSendMessage, StickerSendMessage
 from common.logger_factory import LoggerFactory
 
@@ -33,6 +36,24 @@ class Line:
                     line_event.get("replyToken"), TextSendMessage(text=text_message)
                 )
 
+    @classmethod
+    def push_text_message(
+        cls, line_event, text_message: str | None, quick_reply: list | None = None
+    ):
+        """line_event のトークルーム(ルーム/グループ/ユーザー)にテキストを送信する。
+
+        応答トークンは1回しか使えないため、2通目以降の送信に使う。
+        """
+        source = line_event.get("source", {})
+        to = source.get("roomId") or source.get("groupId") or source.get("userId")
+        if text_message and to:
+            if quick_reply and len(quick_reply) > 0 and type(quick_reply[0]) is dict:
+                cls.line_bot_api.push_message(
+                    to, TextSendMessage(text=text_message, quick_reply=quick_reply)
+                )
+            else:
+                cls.line_bot_api.push_message(to, TextSendMessage(text=text_message))
+
     @classmethod
     def reply_sticker_message(
         cls,
@@ -59,3 +80,73 @@ class Line:
                         sticker_id=sticker_id,
                     ),
                 )
+
+
+class LineStreamReplier:
+    """生成途中の応答を分割して送信する(1通目は応答メッセージ、2通目以降はプッシュメッセージ)。
+
+    ChatGpt.send の on_chunk に send を渡して使う。
+    LINE への送信に失敗した場合は、例外を error に保持して以降の送信を行わない
+    (OpenAI のエラーとして扱われないように、on_chunk からは例外を送出しない)。
+    """
+
+    def __init__(self, line_event, quick_reply: list | None = None):
+        self.line_event = line_event
+        self.quick_reply = quick_reply
+        self.sent_count = 0
+        self.sent_text = ""
+        self.error: LineBotApiError | None = None
+
+    def send(self, text_message: str, last: bool = False):
+        if self.error is not None:
+            return
+        # クイックリプライは最後のメッセージにのみ付ける
+        quick_reply = self.quick_reply if last else None
+        try:
+            if self.sent_count == 0:
+                Line.reply_text_message(self.line_event, text_message, quick_reply)
+            else:
+                Line.push_text_message(self.line_event, text_message, quick_reply)
+        except LineBotApiError as e:
+            logger.error("Failed to send a streamed reply to LINE: %s", e)
+            self.error = e
+            return
+        self.sent_count += 1
+        self.sent_text += text_message
+
+
+class AsyncLine:
+    """Line の asyncio 版。aiohttp のセッションを使うため async with の中で使う。
+
+    [Example]
+        async with AsyncLine() as line:
+            await line.reply_text_message(line_event, "Hello!")
+    """
+
+    def __init__(self):
+        self.session = None
+        self.line_bot_api = None
+
+    async def __aenter__(self) -> "AsyncLine":
+        self.session = aiohttp.ClientSession()
+        self.line_bot_api = AsyncLineBotApi(
+            channel_access_token, AiohttpAsyncHttpClient(self.session)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()  # type: ignore
+
+    async def reply_text_message(
+        self, line_event, text_message: str | None, quick_reply: list | None = None
+    ):
+        if text_message:
+            if quick_reply and len(quick_reply) > 0 and type(quick_reply[0]) is dict:
+                await self.line_bot_api.reply_message(  # type: ignore
+                    line_event.get("replyToken"),
+                    TextSendMessage(text=text_message, quick_reply=quick_reply),
+                )
+            else:
+                await self.line_bot_api.reply_message(  # type: ignore
+                    line_event.get("replyToken"), TextSendMessage(text=text_message)
+                )
@@ -0,0 +1,23 @@
+import time
+from unittest import TestCase, mock
+from common.deadline import Deadline
+
+
+class DeadlineTestCase(TestCase):
+    def test_from_context_001(self):
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 30000
+        deadline = Deadline.from_context(context, margin=3)
+        self.assertAlmostEqual(deadline.remaining(), 27, delta=0.1)  # type: ignore
+        self.assertIsNone(Deadline.from_context(None))
+
+    def test_timeout_001(self):
+        deadline = Deadline.after(5)
+        self.assertEqual(deadline.timeout(1), 1)
+        self.assertAlmostEqual(deadline.timeout(10), 5, delta=0.1)
+        self.assertAlmostEqual(deadline.split(5).remaining(), 1, delta=0.1)
+        self.assertIs(deadline.split(1), deadline)
+
+        deadline = Deadline(time.monotonic() - 1)
+        self.assertTrue(deadline.expired())
+        self.assertEqual(deadline.timeout(10), 0)
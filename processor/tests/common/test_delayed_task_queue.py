@@ -0,0 +1,29 @@
+import time
+from unittest import TestCase
+from common.delayed_task_queue import DelayedTaskQueue
+
+
+class DelayedTaskQueueTestCase(TestCase):
+    def test_schedule_001(self):
+        # schedule() は待たずに戻り、タスクは実行予定時刻の順に実行される
+        queue = DelayedTaskQueue()
+        executed = []
+        start = time.monotonic()
+        queue.schedule(0.2, executed.append, "b", key="b")
+        queue.schedule(0.1, executed.append, "a", key="a")
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertListEqual(queue.wait(), [])
+        self.assertListEqual(executed, ["a", "b"])
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_wait_001(self):
+        # 失敗したタスクと、タイムアウトまでに実行されなかったタスクの key が返る
+        queue = DelayedTaskQueue()
+
+        def fail():
+            raise RuntimeError("test")
+
+        queue.schedule(0, fail, key="failed")
+        queue.schedule(10, fail, key="not started")
+        self.assertCountEqual(queue.wait(timeout=0.2), ["failed", "not started"])
+        self.assertListEqual(queue.wait(), [])
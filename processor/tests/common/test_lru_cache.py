@@ -0,0 +1,26 @@
+from unittest import TestCase
+from common.lru_cache import LruCache
+
+
+class LruCacheTestCase(TestCase):
+    def test_put_001(self):
+        cache = LruCache(max_bytes=10)
+        self.assertTrue(cache.put("a", "A", 4))
+        self.assertTrue(cache.put("b", "B", 4))
+        self.assertEqual(cache.get("a"), "A")  # "b" が最も長く参照されていない
+        self.assertTrue(cache.put("c", "C", 4))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+        self.assertEqual(cache.bytes, 8)
+
+        # 上限より大きい値はキャッシュしない
+        self.assertFalse(cache.put("d", "D", 11))
+        self.assertEqual(len(cache), 2)
+
+        # 同じキーの値は置き換える
+        self.assertTrue(cache.put("a", "AA", 7))
+        self.assertEqual(cache.get("a"), "AA")
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(cache.bytes, 7)
+        self.assertEqual((cache.hits, cache.misses), (4, 2))
@@ -0,0 +1,85 @@
+from unittest import TestCase, mock
+from common import semantic_cache
+from common.semantic_cache import SemanticCache, normalize_text
+
+
+class SemanticCacheTestCase(TestCase):
+    def test_normalize_text_001(self):
+        # 全角/半角、大文字/小文字、句読点、空白の違いを除く
+        self.assertEqual(
+            normalize_text("ＬＩＮＥの　使い方を教えて。 "),
+            normalize_text("LINEの使い方を教えて"),
+        )
+        self.assertEqual(normalize_text("Hello,   World!!"), "hello world")
+
+    def test_get_001(self):
+        cache = SemanticCache(threshold=0.7)
+        cache.put("system", "営業時間を教えてください。", "A")
+        cache.put("system", "定休日はいつですか？", "B")
+
+        # ほぼ同じ内容の質問には登録済みの値を返す
+        self.assertEqual(cache.get("system", "営業時間を教えてください"), "A")
+        self.assertEqual(cache.get("system", "営業時間を教えてください！！"), "A")
+        self.assertEqual(cache.get("system", "営業時間を教えてくださいね"), "A")
+        self.assertEqual(cache.get("system", "定休日は いつ ですか?"), "B")
+
+        # 内容の異なる質問や、システムメッセージの異なる質問には返さない
+        self.assertIsNone(cache.get("system", "駐車場はありますか？"))
+        self.assertIsNone(cache.get("other", "営業時間を教えてください。"))
+        self.assertIsNone(cache.get("system", "。。。"))
+
+    def test_put_001(self):
+        cache = SemanticCache(threshold=0.9, max_entries=2)
+        cache.put("system", "What time do you open?", "A")
+        cache.put(
+            "system", "What time do you open", "AA"
+        )  # 同じテキストの値は置き換える
+        self.assertEqual(len(cache), 1)
+        cache.put("system", "Where is the station?", "B")
+        self.assertEqual(cache.get("system", "what time do you open"), "AA")
+        cache.put("system", "How much is the ticket?", "C")
+
+        # 最も長く参照されていないものから破棄する
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("system", "Where is the station?"))
+        self.assertEqual(cache.get("system", "What time do you open?"), "AA")
+
+    def test_get_002(self):
+        # ttl 秒を過ぎた値は返さない
+        cache = SemanticCache(threshold=0.9, ttl=10)
+        with mock.patch.object(semantic_cache.time, "monotonic", return_value=100):
+            cache.put("system", "What time do you open?", "A")
+        with mock.patch.object(semantic_cache.time, "monotonic", return_value=105):
+            self.assertEqual(cache.get("system", "What time do you open?"), "A")
+        with mock.patch.object(semantic_cache.time, "monotonic", return_value=110):
+            self.assertIsNone(cache.get("system", "What time do you open?"))
+        self.assertEqual(len(cache), 0)
+
+    def test_get_003(self):
+        # 登録順に期限切れを確認する(参照で並び順が変わっても、登録時刻で破棄する)
+        cache = SemanticCache(threshold=0.9, ttl=10)
+        with mock.patch.object(semantic_cache.time, "monotonic", return_value=100):
+            cache.put("system", "What time do you open?", "A")
+        with mock.patch.object(semantic_cache.time, "monotonic", return_value=105):
+            cache.put("system", "Where is the station?", "B")
+            self.assertEqual(cache.get("system", "What time do you open?"), "A")
+        with mock.patch.object(semantic_cache.time, "monotonic", return_value=110):
+            self.assertIsNone(cache.get("system", "What time do you open?"))
+            self.assertEqual(cache.get("system", "Where is the station?"), "B")
+        self.assertEqual(len(cache), 1)
+
+        # 置き換えや破棄で削除済みの登録は、溜め込まずに除く
+        cache = SemanticCache(threshold=0.9, max_entries=2, ttl=10)
+        for i in range(10):
+            cache.put("system", "Question number %d" % (i % 3), i)
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(len(cache._registered), 4)
+
+    def test_put_002(self):
+        # max_text_chars を超えるテキストはキャッシュしない
+        cache = SemanticCache(threshold=0.9, max_text_chars=20)
+        cache.put("system", "What time do you open?", "A")
+        self.assertEqual(len(cache), 0)
+        cache.put("system", "Where is it?", "B")
+        self.assertEqual(cache.get("system", "Where is it?"), "B")
+        self.assertIsNone(cache.get("system", "Where is it? " * 10))
@@ -0,0 +1,96 @@
+import datetime
+from unittest import TestCase
+from models.db_client import DbClient
+from models.model_base import SortKeyComparison
+from models.conversation_turn import ConversationTurn
+
+
+class ConversationTurnTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Connect to DynamoDB local
+        # cf. https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/DynamoDBLocal.html
+        cls.db_client = DbClient.get_client(local=True)
+
+        # set table_name
+        cls.table_name = "ConversationTurnTable"
+
+        cls.talk_room_id = "R0123456789abcdef0123456789abcdef"
+        cls.user_id = "U0123456789abcdef0123456789abcdef"
+        ConversationTurn.create_table(db_client=cls.db_client, local=True)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.db_client.delete_table(TableName=cls.table_name)
+        cls.db_client.close()
+
+    def test_save_find_delete_001(self):
+        turns = [
+            ConversationTurn.create_instance(
+                self.talk_room_id,
+                self.user_id,
+                seq,
+                "Question %d" % seq,
+                "Answer %d" % seq,
+                tokens=(2, 2),
+                encoding="cl100k_base",
+                db_client=self.db_client,
+            )
+            for seq in range(1, 4)
+        ]
+        for turn in turns:
+            turn.save()
+        self.assertEqual(
+            ConversationTurn.get_latest_seq(self.talk_room_id, self.db_client), 3
+        )
+
+        # 同じ seq の受け答えは上書きしない
+        with self.assertRaises(
+            self.db_client.exceptions.ConditionalCheckFailedException
+        ):
+            ConversationTurn.create_instance(
+                self.talk_room_id,
+                self.user_id,
+                3,
+                "Another question",
+                db_client=self.db_client,
+            ).save()
+
+        records = ConversationTurn.find(
+            ConversationTurn.get_query(
+                self.talk_room_id, SortKeyComparison.GE, sort_key1="2", limit=10
+            ),
+            self.db_client,
+        )
+        self.assertEqual(len(records), 2)
+        self.assertDictEqual(turns[1]._data, records[0]._data)
+        self.assertDictEqual(turns[2]._data, records[1]._data)
+
+        # 新しいものから1件ずつ読み、トークン数の制限を超えた時点でやめる
+        since = (datetime.datetime.now() - datetime.timedelta(seconds=60)).isoformat()
+        records = ConversationTurn.find_recent(
+            self.talk_room_id,
+            since,
+            5,
+            len,
+            "cl100k_base",
+            db_client=self.db_client,
+            page_size=1,
+        )
+        self.assertEqual([record.seq for record in records], [2, 3])
+
+        # エンコーディングが異なる場合はトークン数を数え直す
+        records = ConversationTurn.find_recent(
+            self.talk_room_id, since, 100, len, "p50k_base", db_client=self.db_client
+        )
+        self.assertEqual([record.userTokens for record in records], [10, 10, 10])
+        messages, counts = ConversationTurn.to_request(records)
+        self.assertEqual(len(messages), 6)
+        self.assertEqual(messages[-1], {"role": "assistant", "content": "Answer 3"})
+        self.assertEqual(counts[-1], 8)
+
+        for turn in turns:
+            turn.delete()
+        self.assertEqual(
+            ConversationTurn.get_latest_seq(self.talk_room_id, self.db_client), 0
+        )
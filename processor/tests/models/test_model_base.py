@@ -0,0 +1,209 @@
+import json
+from unittest import TestCase, mock
+from models.model_base import SortKeyComparison
+from models.talk_room_history import TalkRoomHistory
+from models.conversation_turn import ConversationTurn
+from models.chat_gpt_request_history import ChatGptRequestHistory
+
+
+class ModelBaseTestCase(TestCase):
+    def test_build_query_001(self):
+        query = TalkRoomHistory.get_gs1_query(
+            "U0123456789abcdef0123456789abcdef",
+            SortKeyComparison.BETWEEN,
+            sort_key1="2023-01-01",
+            sort_key2="2023-01-31",
+            limit=10,
+            reverse=True,
+        )
+        self.assertDictEqual(
+            query,
+            {
+                "TableName": TalkRoomHistory.get_table(),
+                "IndexName": TalkRoomHistory.get_table() + "GSI1",
+                "KeyConditionExpression": "#userId = :userId AND #createdAt BETWEEN :createdAt1 AND :createdAt2",
+                "ExpressionAttributeNames": {
+                    "#userId": "userId",
+                    "#createdAt": "createdAt",
+                },
+                "ExpressionAttributeValues": {
+                    ":userId": {"S": "U0123456789abcdef0123456789abcdef"},
+                    ":createdAt1": {"S": "2023-01-01"},
+                    ":createdAt2": {"S": "2023-01-31"},
+                },
+                "ScanIndexForward": False,
+                "Limit": 10,
+            },
+        )
+
+        # BETWEEN の上限が無い場合は空のクエリを返す
+        self.assertDictEqual(
+            TalkRoomHistory.get_query(
+                "R0123456789abcdef0123456789abcdef",
+                SortKeyComparison.BETWEEN,
+                sort_key1="2023-01-01",
+            ),
+            {},
+        )
+
+    def test_build_query_002(self):
+        # 数値のソートキーの値は文字列にする。EQ の場合は件数と順序を指定しない
+        query = ConversationTurn.get_query(
+            "R0123456789abcdef0123456789abcdef", SortKeyComparison.EQ, sort_key1=3  # type: ignore
+        )
+        self.assertEqual(
+            query["KeyConditionExpression"], "#talkRoomId = :talkRoomId AND #seq = :seq"
+        )
+        self.assertEqual(query["ExpressionAttributeValues"][":seq"], {"N": "3"})
+        self.assertNotIn("Limit", query)
+
+        # クエリの変更はキャッシュした雛形に影響しない
+        query["ExpressionAttributeNames"]["#other"] = "other"
+        self.assertNotIn(
+            "#other",
+            ConversationTurn.get_query("R0123456789abcdef0123456789abcdef")[
+                "ExpressionAttributeNames"
+            ],
+        )
+
+    def test_get_key_001(self):
+        turn = ConversationTurn.create_instance(
+            "R0123456789abcdef0123456789abcdef", "", 3, "Hi!", db_client=object()  # type: ignore
+        )
+        self.assertDictEqual(
+            turn.get_key(),
+            {
+                "talkRoomId": {"S": "R0123456789abcdef0123456789abcdef"},
+                "seq": {"N": "3"},
+            },
+        )
+
+    def test_find_iter_001(self):
+        # LastEvaluatedKey でページを進め、必要になった時点で次のページを読む
+        items = [
+            {
+                "talkRoomId": {"S": "R0123456789abcdef0123456789abcdef"},
+                "seq": {"N": str(seq)},
+                "userMessage": {"S": "Q%d" % seq},
+            }
+            for seq in range(1, 6)
+        ]
+
+        def query(**kwargs):
+            start = kwargs.get("ExclusiveStartKey", 0)
+            end = start + kwargs["Limit"]
+            res = {"Items": items[start:end]}
+            if end < len(items):
+                res["LastEvaluatedKey"] = end
+            return res
+
+        db_client = mock.Mock()
+        db_client.query.side_effect = query
+        turns = ConversationTurn.find_iter(
+            ConversationTurn.get_query("R0123456789abcdef0123456789abcdef"),
+            db_client,
+            page_size=2,
+        )
+        self.assertEqual(next(turns).seq, 1)  # type: ignore
+        self.assertEqual(db_client.query.call_count, 1)
+        self.assertEqual([turn.seq for turn in turns], [2, 3, 4, 5])  # type: ignore
+        self.assertEqual(db_client.query.call_count, 3)
+
+        # find はクエリの Limit の件数までページを読む(最後のページは必要な件数だけ読む)
+        db_client.query.reset_mock()
+        turns = ConversationTurn.find(
+            dict(
+                ConversationTurn.get_query("R0123456789abcdef0123456789abcdef"),
+                Limit=3,
+            ),
+            db_client,
+        )
+        self.assertEqual([turn.seq for turn in turns], [1, 2, 3])  # type: ignore
+        self.assertEqual(db_client.query.call_count, 1)
+
+        db_client.query.reset_mock()
+        turns = list(
+            ConversationTurn.find_iter(
+                ConversationTurn.get_query("R0123456789abcdef0123456789abcdef"),
+                db_client,
+                page_size=2,
+                max_items=3,
+            )
+        )
+        self.assertEqual(len(turns), 3)
+        self.assertEqual(
+            [c.kwargs["Limit"] for c in db_client.query.call_args_list], [2, 1]
+        )
+
+    def test_projection_001(self):
+        # 射影にはテーブルとインデックスのキーを含める
+        query = ChatGptRequestHistory.get_gs2_query(
+            "0123abcd", limit=1, reverse=True, projection=["response"]
+        )
+        self.assertEqual(
+            query["ProjectionExpression"],
+            "#talkRoomId, #createdAt, #requestId, #response",
+        )
+        self.assertEqual(query["ExpressionAttributeNames"]["#response"], "response")
+        self.assertNotIn("ProjectionExpression", ChatGptRequestHistory.get_query("R0"))
+
+        # 射影で読まなかった属性は、参照した時点で get_item で読み直す
+        key = {
+            "talkRoomId": {"S": "R0123456789abcdef0123456789abcdef"},
+            "createdAt": {"S": "2023-01-01T00:00:00"},
+            "requestId": {"S": "0123abcd"},
+        }
+        db_client = mock.Mock()
+        db_client.query.return_value = {"Items": [dict(key, response={"S": "{}"})]}
+        db_client.get_item.return_value = {
+            "Item": dict(key, response={"S": "{}"}, request={"S": "[]"})
+        }
+        history = ChatGptRequestHistory.find(query, db_client)[0]
+        self.assertEqual(history.response, "{}")
+        self.assertFalse(history.is_loaded("request"))
+        self.assertEqual(db_client.get_item.call_count, 0)
+
+        # 一部の属性だけを読み込んだモデルは保存できない
+        with self.assertRaises(ValueError):
+            history.validate()
+
+        self.assertEqual(history.request, "[]")
+        self.assertTrue(history.is_loaded("request"))
+        db_client.get_item.assert_called_once_with(
+            TableName=ChatGptRequestHistory.get_table(),
+            Key={k: v for k, v in key.items() if k != "requestId"},
+        )
+
+        # 項目が削除されていた場合は LookupError を送出する
+        db_client.get_item.return_value = {}
+        history = ChatGptRequestHistory.find(query, db_client)[0]
+        with self.assertRaises(LookupError):
+            history.get("request")
+
+    def test_projection_002(self):
+        # レスポンスやトークン数を参照するメソッドも、射影で読まなかった属性を読み直す
+        key = {
+            "talkRoomId": {"S": "R0123456789abcdef0123456789abcdef"},
+            "createdAt": {"S": "2023-01-01T00:00:00"},
+        }
+        response = {"choices": [{"message": {"role": "assistant", "content": "Hi"}}]}
+        db_client = mock.Mock()
+        db_client.query.return_value = {"Items": [key]}
+        db_client.get_item.return_value = {
+            "Item": dict(
+                key,
+                response={"S": json.dumps(response)},
+                tokenCounts={"S": json.dumps({"total": 3})},
+            )
+        }
+        query = ChatGptRequestHistory.get_query(
+            "R0123456789abcdef0123456789abcdef", projection=["request"]
+        )
+
+        history = ChatGptRequestHistory.find(query, db_client)[0]
+        self.assertFalse(history.is_error_response())
+        history = ChatGptRequestHistory.find(query, db_client)[0]
+        self.assertEqual(history.get_response_message_content(), "Hi")
+        history = ChatGptRequestHistory.find(query, db_client)[0]
+        self.assertEqual(history.get_request_tokens(), {"total": 3})
+        self.assertEqual(db_client.get_item.call_count, 3)
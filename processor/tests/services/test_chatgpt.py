@@ -1,9 +1,50 @@
 import os
-from unittest import TestCase
-from services.chatgpt import ChatGpt, ChatGptRole
+import json
+import asyncio
+import threading
+import time
+from collections import deque
+import openai
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
+from services import chatgpt as chatgpt_service
+from services.chatgpt import ChatGpt, ChatGptRole, get_encoding, get_executor
 from concurrent.futures import TimeoutError as FutureTimeoutError
 
 
+class FakeStreamingHandler(BaseHTTPRequestHandler):
+    """stream=True の ChatCompletion を模した Server-Sent Events を返す"""
+
+    deltas = ["こんにちは。", "今日は", "良い天気ですね。", "Bye!"]
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunks = [{"role": "assistant"}] + [{"content": d} for d in self.deltas] + [{}]
+        for i, delta in enumerate(chunks):
+            chunk = {
+                "id": "chatcmpl-test",
+                "object": "chat.completion.chunk",
+                "created": 1679540861,
+                "model": "gpt-3.5-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": "stop" if i == len(chunks) - 1 else None,
+                    }
+                ],
+            }
+            self.wfile.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
 class ChatGptTestCase(TestCase):
     def test_init_001(self):
         chatgpt = ChatGpt(
@@ -103,6 +144,149 @@ class ChatGptTestCase(TestCase):
             {"role": ChatGptRole.USER.value, "content": "No thanks. This is a test."},
         )
 
+    def test_init_002(self):
+        # トークン数の制限を超えるテキストは、制限ちょうどのトークン数に切り詰められる
+        text_message = "これはトークン数の制限を超える長いメッセージです。" * 1000
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=100,
+            system_message="You are the ChatGPT.",
+            text_message=text_message,
+        )
+        request = chatgpt.get_request()
+        self.assertEqual(len(request), 2)
+        self.assertEqual(request[1]["role"], ChatGptRole.USER.value)
+        self.assertTrue(text_message.startswith(request[1]["content"]))
+        self.assertLessEqual(chatgpt.tokens, 100)
+        self.assertGreaterEqual(chatgpt.tokens, 96)
+
+        # 英語のテキストも、空にならずに制限以内に切り詰められる
+        chatgpt = ChatGpt(model_name="gpt-3.5-turbo", max_tokens=100)
+        for text, max_tokens in (("hello world " * 20, 30), ("hello world " * 20, 50)):
+            truncated = chatgpt.truncate_tokens(text, max_tokens)
+            self.assertTrue(text.startswith(truncated))
+            self.assertLessEqual(chatgpt.count_tokens(truncated), max_tokens)
+            self.assertGreaterEqual(chatgpt.count_tokens(truncated), max_tokens - 1)
+        self.assertEqual(chatgpt.truncate_tokens("hello", 10), "hello")
+
+    def test_init_003(self):
+        # 保存済みのトークン数があれば、過去のメッセージのトークン数を数え直さない
+        past_request = [
+            {"role": ChatGptRole.SYSTEM.value, "content": "You are the ChatGPT."},
+            {"role": ChatGptRole.USER.value, "content": "Hi, ChatGPT!"},
+            {
+                "role": ChatGptRole.ASSISTANT.value,
+                "content": "Hello! How can I assist you today?",
+            },
+        ]
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="No thanks. This is a test.",
+            past_request=past_request,
+        )
+        request_tokens = chatgpt.get_request_tokens()
+        self.assertEqual(request_tokens["encoding"], chatgpt.encoding.name)
+        self.assertEqual(len(request_tokens["counts"]), 4)
+        self.assertEqual(sum(request_tokens["counts"]), chatgpt.tokens)
+
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="No thanks. This is a test.",
+            past_request=past_request,
+            past_request_tokens={
+                "encoding": chatgpt.encoding.name,
+                "counts": [0, 1000, 2000],
+            },
+        )
+        self.assertEqual(chatgpt.get_request_tokens()["counts"][1:3], [1000, 2000])
+
+        # エンコーディングが異なる場合は数え直す
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="No thanks. This is a test.",
+            past_request=past_request,
+            past_request_tokens={"encoding": "unknown", "counts": [0, 1000, 2000]},
+        )
+        self.assertEqual(chatgpt.get_request_tokens(), request_tokens)
+
+    def test_init_004(self):
+        # トークン数の制限(応答用に確保する分を除く)に収まる新しいメッセージのみを使う
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=200,
+            system_message="You are the ChatGPT.",
+            text_message="No thanks. This is a test.",
+            past_request=[
+                {"role": ChatGptRole.SYSTEM.value, "content": "Old system message."},
+                {"role": ChatGptRole.USER.value, "content": "First question."},
+                {"role": ChatGptRole.SYSTEM.value, "content": "You are the ChatGPT."},
+                {"role": ChatGptRole.USER.value, "content": "Second question."},
+                {"role": ChatGptRole.ASSISTANT.value, "content": "Second answer."},
+                {"role": ChatGptRole.USER.value, "content": "Third question."},
+            ],
+            past_request_tokens={
+                "encoding": get_encoding("gpt-3.5-turbo").name,
+                "counts": [0, 0, 0, 60, 20, 20],
+            },
+            completion_tokens=100,
+        )
+        self.assertEqual(chatgpt.completion_tokens, 100)
+        self.assertEqual(chatgpt.max_tokens, 100)
+        self.assertEqual(
+            [message["content"] for message in chatgpt.get_request()],
+            [
+                "You are the ChatGPT.",
+                "Second answer.",
+                "Third question.",
+                "No thanks. This is a test.",
+            ],
+        )
+        self.assertEqual(chatgpt.get_request_tokens()["counts"][1:3], [20, 20])
+        self.assertEqual(sum(chatgpt.get_request_tokens()["counts"]), chatgpt.tokens)
+        self.assertLessEqual(chatgpt.tokens, 100)
+
+    def test_add_summary_001(self):
+        # 要約はシステムメッセージの直後、過去の受け答えより前に追加する
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="Third question.",
+        )
+        self.assertTrue(chatgpt.add_summary("Summary of the conversation.", 10))
+        self.assertFalse(chatgpt.add_summary("Too long summary.", 4096))
+        chatgpt.add_past_request(
+            [
+                {"role": ChatGptRole.ASSISTANT.value, "content": "First answer."},
+                {"role": ChatGptRole.USER.value, "content": "Second question."},
+            ]
+        )
+        self.assertEqual(
+            [message["content"] for message in chatgpt.get_request()],
+            [
+                "You are the ChatGPT.",
+                "Summary of the conversation.",
+                "First answer.",
+                "Second question.",
+                "Third question.",
+            ],
+        )
+        self.assertEqual(chatgpt.get_request_tokens()["counts"][1], 10)
+        self.assertEqual(sum(chatgpt.get_request_tokens()["counts"]), chatgpt.tokens)
+
+        # 要約の直後の応答(assistant)のメッセージは送信しない
+        params = chatgpt._get_params()
+        self.assertEqual(
+            [message["role"] for message in params["messages"]],  # type: ignore
+            ["system", "system", "user", "user"],
+        )
+
     def test_send_001(self):
         chatgpt = ChatGpt(
             model_name="gpt-3.5-turbo",
@@ -112,3 +296,213 @@ class ChatGptTestCase(TestCase):
             past_request=[],
         )
         self.assertRaises(FutureTimeoutError, chatgpt.send, 0.0001)
+
+    def test_send_002(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeStreamingHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="Hi, ChatGPT!",
+        )
+        received = []
+        with mock.patch.object(
+            openai, "api_base", "http://127.0.0.1:%d/v1" % server.server_port
+        ), mock.patch.object(openai, "api_key", "sk-test"), mock.patch.object(
+            ChatGpt, "STREAM_CHUNK_MIN_CHARS", 5
+        ):
+            self.assertTrue(
+                chatgpt.send(
+                    timeout=10,
+                    on_chunk=lambda text, last: received.append((text, last)),
+                )
+            )
+        # 文末で区切られ、最後の部分のみ last=True で渡される
+        self.assertEqual(
+            received,
+            [
+                ("こんにちは。", False),
+                ("今日は良い天気ですね。", False),
+                ("Bye!", True),
+            ],
+        )
+        self.assertEqual(
+            chatgpt.get_response_message_content(),
+            "こんにちは。今日は良い天気ですね。Bye!",
+        )
+        self.assertEqual(chatgpt.get_response()["choices"][0]["finish_reason"], "stop")
+
+    def test_send_006(self):
+        # 差分が届き続けても、期限を過ぎたら受信した部分で応答を打ち切る
+        now = [0.0]
+
+        def create(**kwargs):
+            deltas = [{"role": "assistant"}] + [
+                {"content": d} for d in FakeStreamingHandler.deltas
+            ]
+            for delta in deltas:
+                now[0] += 1  # 1秒ごとに差分が届く
+                yield {"id": "chatcmpl-test", "choices": [{"index": 0, "delta": delta}]}
+
+        def send(deadline):
+            now[0] = 0.0
+            chatgpt = ChatGpt(
+                model_name="gpt-3.5-turbo",
+                max_tokens=4096,
+                system_message="You are the ChatGPT.",
+                text_message="Hi, ChatGPT!",
+            )
+            received = []
+            chatgpt.send(
+                timeout=10,
+                on_chunk=lambda text, last: received.append((text, last)),
+                deadline=deadline,
+            )
+            return chatgpt, received
+
+        with mock.patch.object(
+            openai.ChatCompletion, "create", side_effect=create
+        ), mock.patch.object(chatgpt_service.time, "monotonic", lambda: now[0]):
+            chatgpt, received = send(3.5)
+            self.assertEqual(received, [("こんにちは。今日は", True)])
+            self.assertEqual(
+                chatgpt.get_response_message_content(), "こんにちは。今日は"
+            )
+            self.assertEqual(
+                chatgpt.get_response()["choices"][0]["finish_reason"], "length"
+            )
+
+            # 何も受信していない場合はタイムアウトにする
+            self.assertRaises(FutureTimeoutError, send, 1.5)
+
+    def test_send_003(self):
+        # タイムアウトを指定しても、リクエストごとにスレッドが増えない
+        response = {
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": "Hello!"}}
+            ]
+        }
+        with mock.patch.object(openai.ChatCompletion, "create", return_value=response):
+            for _ in range(50):
+                chatgpt = ChatGpt(
+                    model_name="gpt-3.5-turbo",
+                    max_tokens=4096,
+                    system_message="You are the ChatGPT.",
+                    text_message="Hi, ChatGPT!",
+                )
+                self.assertTrue(chatgpt.send(timeout=10))
+                self.assertEqual(chatgpt.get_response_message_content(), "Hello!")
+        executor = get_executor()
+        self.assertIs(executor, get_executor())
+        self.assertLessEqual(len(executor._threads), executor._max_workers)
+
+    def test_asend_001(self):
+        response = {
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": "Hello!"}}
+            ]
+        }
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="Hi, ChatGPT!",
+        )
+        with mock.patch.object(
+            openai.ChatCompletion, "acreate", mock.AsyncMock(return_value=response)
+        ) as acreate:
+            self.assertTrue(asyncio.run(chatgpt.asend(timeout=10)))
+        self.assertEqual(acreate.call_args.kwargs["messages"], chatgpt.get_request())
+        self.assertEqual(chatgpt.get_response_message_content(), "Hello!")
+
+    def test_send_004(self):
+        # レート制限とサーバ側のエラーは再送する
+        response = {
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": "Hello!"}}
+            ]
+        }
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="Hi, ChatGPT!",
+        )
+        with mock.patch.object(
+            chatgpt_service, "OPENAI_RETRY_BASE_SEC", 0.01
+        ), mock.patch.object(
+            openai.ChatCompletion,
+            "create",
+            side_effect=[
+                openai.error.RateLimitError("rate limit"),
+                openai.error.APIError("server error", http_status=500),
+                response,
+            ],
+        ) as create:
+            self.assertTrue(chatgpt.send(timeout=10))
+        self.assertEqual(create.call_count, 3)
+        self.assertEqual(chatgpt.get_response_message_content(), "Hello!")
+
+        # リクエスト内容に問題がある場合と、期限までに再送できない場合は再送しない
+        with mock.patch.object(
+            openai.ChatCompletion,
+            "create",
+            side_effect=openai.error.APIError("bad request", http_status=400),
+        ) as create:
+            self.assertRaises(openai.error.APIError, chatgpt.send, 10)
+        self.assertEqual(create.call_count, 1)
+        with mock.patch.object(
+            chatgpt_service, "OPENAI_RETRY_BASE_SEC", 1
+        ), mock.patch.object(
+            openai.ChatCompletion,
+            "create",
+            side_effect=openai.error.RateLimitError("rate limit"),
+        ) as create, mock.patch.object(
+            chatgpt_service.random, "uniform", return_value=1
+        ):
+            self.assertRaises(
+                openai.error.RateLimitError,
+                chatgpt.send,
+                10,
+                deadline=time.monotonic() + 0.5,
+            )
+        self.assertEqual(create.call_count, 1)
+
+    def test_send_005(self):
+        # 応答時間がパーセンタイルを超えた場合、同じリクエストをもう1つ送信して先の応答を使う
+        responses = [
+            (1.0, {"choices": [{"index": 0, "message": {"content": "slow"}}]}),
+            (0.0, {"choices": [{"index": 0, "message": {"content": "fast"}}]}),
+        ]
+        lock = threading.Lock()
+
+        def create(**kwargs):
+            with lock:
+                delay, response = responses.pop(0)
+            time.sleep(delay)
+            return response
+
+        chatgpt = ChatGpt(
+            model_name="gpt-3.5-turbo",
+            max_tokens=4096,
+            system_message="You are the ChatGPT.",
+            text_message="Hi, ChatGPT!",
+        )
+        with mock.patch.object(
+            chatgpt_service, "OPENAI_HEDGE_PERCENTILE", 50
+        ), mock.patch.object(
+            chatgpt_service, "_latencies", deque([0.05] * 20, maxlen=200)
+        ), mock.patch.object(
+            openai.ChatCompletion, "create", side_effect=create
+        ) as create_mock:
+            start = time.monotonic()
+            self.assertTrue(chatgpt.send(timeout=10))
+            elapsed = time.monotonic() - start
+        self.assertEqual(create_mock.call_count, 2)
+        self.assertEqual(chatgpt.get_response_message_content(), "fast")
+        self.assertLess(elapsed, 0.5)
@@ -1,6 +1,11 @@
+import asyncio
 import datetime
+import json
+import time
 import warnings
-from unittest import TestCase
+from unittest import TestCase, mock
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error
 from models.db_client import DbClient
 from models.talk_room_history import TalkRoomHistory
 from models.chat_gpt_request_history import ChatGptRequestHistory
@@ -55,3 +60,494 @@ class AppTestCase(TestCase):
         self.assertIsNotNone(result)
         self.assertEqual(result.talkRoomId, "Ca56f94637c0000000000000000000000")  # type: ignore
         self.assertEqual(result.userId, "U4af49806290000000000000000000000")  # type: ignore
+
+
+class ProcessSqsEventTestCase(TestCase):
+    @staticmethod
+    def create_record(message_id, group_id, event_type="follow"):
+        return {
+            "messageId": message_id,
+            "eventSource": "aws:sqs",
+            "attributes": {"MessageGroupId": group_id},
+            "body": json.dumps({"event_type": event_type, "line_event": {}}),
+        }
+
+    def test_process_sqs_event_001(self):
+        # 失敗したレコードと、同じメッセージグループの後続のレコードのみが失敗として返る
+        records = [
+            self.create_record("m1", "g1"),
+            self.create_record("m2", "g2"),
+            self.create_record("m3", "g1"),
+            self.create_record("m4", "g2"),
+        ]
+        processed = []
+
+        def process_sqs_record(record, deadline=None):
+            processed.append(record["messageId"])
+            if record["messageId"] == "m1":
+                raise RuntimeError("test")
+
+        with mock.patch.object(app, "process_sqs_record", process_sqs_record):
+            result = app.lambda_handler({"Records": records}, None)
+        self.assertCountEqual(processed, ["m1", "m2", "m4"])
+        self.assertDictEqual(
+            result,
+            {"batchItemFailures": [{"itemIdentifier": "m1"}, {"itemIdentifier": "m3"}]},
+        )
+
+    def test_process_sqs_event_002(self):
+        # 同じメッセージグループのレコードは受信順に処理される
+        records = [self.create_record("m%d" % i, "g%d" % (i % 3)) for i in range(9)]
+        processed = []
+
+        def process_sqs_record(record, deadline=None):
+            time.sleep(0.01)
+            processed.append(record["messageId"])
+
+        with mock.patch.object(app, "process_sqs_record", process_sqs_record):
+            result = app.lambda_handler({"Records": records}, None)
+        self.assertDictEqual(result, {"batchItemFailures": []})
+        for group in range(3):
+            self.assertEqual(
+                [m for m in processed if int(m[1:]) % 3 == group],
+                ["m%d" % i for i in range(9) if i % 3 == group],
+            )
+
+    def test_process_sqs_event_003(self):
+        records = [self.create_record("m1", "g1"), self.create_record("m2", "g2")]
+        result = app.lambda_handler({"Records": records}, None)
+        self.assertDictEqual(result, {"batchItemFailures": []})
+
+    def test_process_sqs_event_004(self):
+        # PROCESSOR_ASYNC の場合、異なるトークルームの応答待ちを重ねて処理する
+        records = [
+            self.create_record("m%d" % i, "g%d" % (i % 5), event_type="text_message")
+            for i in range(10)
+        ]
+        replied = []
+
+        async def process_text_message_event_async(line_event, deadline=None):
+            await asyncio.sleep(0.1)
+            return mock.Mock(get_response_message_content=lambda: "answer")
+
+        async def reply_text_message(self, line_event, text_message, quick_reply=None):
+            replied.append(text_message)
+            if len(replied) == 1:
+                raise RuntimeError("test")
+
+        with mock.patch.object(app, "PROCESSOR_ASYNC", True), mock.patch.object(
+            app, "process_text_message_event_async", process_text_message_event_async
+        ), mock.patch.object(app.AsyncLine, "reply_text_message", reply_text_message):
+            start = time.perf_counter()
+            result = app.lambda_handler({"Records": records}, None)
+            elapsed = time.perf_counter() - start
+        # 5グループ x 2レコードを直列に処理すると 1.0 秒かかる
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(len(replied), 9)
+        self.assertEqual(len(result["batchItemFailures"]), 2)
+
+    def test_process_sqs_event_005(self):
+        # 残り時間が足りない場合は、処理を始めずに失敗として返す
+        records = [self.create_record("m%d" % i, "g%d" % (i % 2)) for i in range(4)]
+        deadlines = {}
+
+        def process_sqs_record(record, deadline=None):
+            deadlines[record["messageId"]] = deadline.remaining()
+
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 4000
+        with mock.patch.object(app, "process_sqs_record", process_sqs_record):
+            result = app.lambda_handler({"Records": records}, context)
+        self.assertEqual(deadlines, {})
+        self.assertEqual(len(result["batchItemFailures"]), 4)
+
+        # 各レコードの持ち時間は OPENAI_REQUEST_TIMEOUT 秒(残り時間がそれより短い場合は残り時間)
+        context.get_remaining_time_in_millis.return_value = 23000
+        with mock.patch.object(app, "process_sqs_record", process_sqs_record):
+            result = app.lambda_handler({"Records": records}, context)
+        self.assertDictEqual(result, {"batchItemFailures": []})
+        self.assertAlmostEqual(deadlines["m0"], 10, delta=0.5)
+        self.assertAlmostEqual(deadlines["m2"], 10, delta=0.5)
+
+        deadlines.clear()
+        context.get_remaining_time_in_millis.return_value = 9000
+        with mock.patch.object(app, "process_sqs_record", process_sqs_record):
+            result = app.lambda_handler({"Records": records}, context)
+        self.assertDictEqual(result, {"batchItemFailures": []})
+        self.assertAlmostEqual(deadlines["m0"], 6, delta=0.5)
+
+    def test_process_sqs_event_006(self):
+        # 遅延させた返信の失敗は、レコードの失敗にしない(後続のレコードは処理済みのため)
+        records = [
+            self.create_record("m1", "g1", event_type="sticker_message"),
+            self.create_record("m2", "g1"),
+        ]
+        reply_sticker_message = mock.Mock(side_effect=RuntimeError("test"))
+        with mock.patch.object(
+            app, "NON_TEXT_MESSAGE_REPLY_DELAY_SEC", 0
+        ), mock.patch.object(app.Line, "reply_sticker_message", reply_sticker_message):
+            result = app.lambda_handler({"Records": records}, None)
+        reply_sticker_message.assert_called_once()
+        self.assertDictEqual(result, {"batchItemFailures": []})
+
+    def test_process_sqs_event_007(self):
+        # 再処理しても成功しない例外のレコードは処理済みとし、後続のレコードを処理する
+        records = [
+            self.create_record("m1", "g1", event_type="text_message"),
+            self.create_record("m2", "g1"),
+            dict(self.create_record("m3", "g1"), body="{invalid"),
+            self.create_record("m4", "g1"),
+            self.create_record("m5", "g2", event_type="text_message"),
+            self.create_record("m6", "g2"),
+        ]
+        errors = {
+            # 応答トークンの期限切れ等
+            "m1": LineBotApiError(400, {}, error=Error(message="Invalid reply token")),
+            # レート制限は再処理する
+            "m5": LineBotApiError(429, {}, error=Error(message="Too many requests")),
+        }
+        processed = []
+
+        def process_text_message_event(line_event, on_chunk=None, deadline=None):
+            processed.append(line_event["id"])
+            raise errors[line_event["id"]]
+
+        for record in records:
+            if record["messageId"] in errors:
+                record["body"] = json.dumps(
+                    {
+                        "event_type": "text_message",
+                        "line_event": {"id": record["messageId"]},
+                    }
+                )
+        with mock.patch.object(
+            app, "process_text_message_event", process_text_message_event
+        ):
+            result = app.lambda_handler({"Records": records}, None)
+        self.assertCountEqual(processed, ["m1", "m5"])
+        self.assertDictEqual(
+            result,
+            {"batchItemFailures": [{"itemIdentifier": "m5"}, {"itemIdentifier": "m6"}]},
+        )
+
+    def test_process_sqs_event_008(self):
+        # ストリーミング中の LINE への送信の失敗は、OpenAI のタイムアウトとして扱わない
+        chatgpt = app.ChatGpt(
+            system_message="You are the ChatGPT.", text_message="Hi, ChatGPT!"
+        )
+
+        def send(self, timeout=None, on_chunk=None, deadline=None):
+            for text, last in (("Hel", False), ("lo", False), ("!", True)):
+                on_chunk(text, last)
+            self.response = {"choices": [{"message": {"content": "Hello!"}}]}
+            return True
+
+        model = mock.Mock(get_response_message_content=lambda: "Hello!")
+        reply_text_message = mock.Mock()
+        push_text_message = mock.Mock(
+            side_effect=LineBotApiError(500, {}, error=Error(message="test"))
+        )
+        records = [self.create_record("m1", "g1", event_type="text_message")]
+        records[0]["body"] = json.dumps(
+            {"event_type": "text_message", "line_event": {"replyToken": "r1"}}
+        )
+        with mock.patch.object(app, "OPENAI_STREAM", True), mock.patch.object(
+            app,
+            "prepare_text_message_event",
+            return_value=(mock.Mock(), chatgpt, None),
+        ), mock.patch.object(app.ChatGpt, "send", send), mock.patch.object(
+            app, "save_chatgpt_request_history", return_value=model
+        ) as save, mock.patch.object(
+            app.Line, "reply_text_message", reply_text_message
+        ), mock.patch.object(
+            app.Line, "push_text_message", push_text_message
+        ):
+            result = app.lambda_handler({"Records": records}, None)
+
+            # 応答は正常に保存し、送信済みの部分は再送しない
+            self.assertDictEqual(result, {"batchItemFailures": []})
+            save.assert_called_once_with(mock.ANY, chatgpt)
+            reply_text_message.assert_called_once_with(
+                {"replyToken": "r1"}, "Hel", None
+            )
+            push_text_message.assert_called_once()
+
+            # 何も送信できなかった場合は、レコードの失敗とする
+            reply_text_message.side_effect = push_text_message.side_effect
+            reply_text_message.reset_mock()
+            result = app.lambda_handler({"Records": records}, None)
+            self.assertDictEqual(
+                result, {"batchItemFailures": [{"itemIdentifier": "m1"}]}
+            )
+            reply_text_message.assert_called_once()
+
+
+class FindChatGptRequestHistoryTestCase(TestCase):
+    def test_find_chatgpt_request_history_001(self):
+        # 同じ内容のリクエストの履歴は、2回目以降はキャッシュから返す
+        past_time = datetime.datetime.now() - datetime.timedelta(seconds=60)
+        history = ChatGptRequestHistory(
+            {
+                "talkRoomId": "R0123456789abcdef0123456789abcdef",
+                "userId": "U0123456789abcdef0123456789abcdef",
+                "requestId": "0" * 64,
+                "request": "[]",
+                "response": json.dumps(
+                    {"choices": [{"message": {"content": "Hello!"}}]}
+                ),
+                "createdAt": datetime.datetime.now().isoformat(),
+            },
+            db_client=mock.Mock(),
+        )
+        with mock.patch.object(
+            app, "response_cache", app.LruCache(1024 * 1024)
+        ), mock.patch.object(
+            ChatGptRequestHistory, "find", return_value=[history]
+        ) as find:
+            for _ in range(3):
+                result = app.find_chatgpt_request_history(
+                    "0" * 64, past_time, mock.Mock()
+                )
+                self.assertEqual(result.get_response_message_content(), "Hello!")  # type: ignore
+            self.assertEqual(find.call_count, 1)
+
+            # past_time より前の履歴は返さない
+            self.assertIsNone(
+                app.find_chatgpt_request_history(
+                    "0" * 64, datetime.datetime.now(), mock.Mock()
+                )
+            )
+
+    def test_find_similar_chatgpt_request_history_001(self):
+        # 会話履歴の無いリクエストでは、ほぼ同じ内容の質問の履歴を返す
+        past_time = datetime.datetime.now() - datetime.timedelta(seconds=60)
+        request = [
+            {"role": "system", "content": "You are the ChatGPT."},
+            {"role": "user", "content": "営業時間を教えてください。"},
+        ]
+        history = ChatGptRequestHistory(
+            {
+                "talkRoomId": "R0123456789abcdef0123456789abcdef",
+                "userId": "U0123456789abcdef0123456789abcdef",
+                "requestId": "0" * 64,
+                "request": json.dumps(request, ensure_ascii=False),
+                "response": json.dumps(
+                    {"choices": [{"message": {"content": "10時からです。"}}]}
+                ),
+                "createdAt": datetime.datetime.now().isoformat(),
+            },
+            db_client=mock.Mock(),
+        )
+        with mock.patch.object(
+            app, "response_cache", app.LruCache(1024 * 1024)
+        ), mock.patch.object(app, "semantic_cache", app.SemanticCache(0.8)):
+            app.cache_chatgpt_request_history(history)
+            request[1]["content"] = "営業時間を教えてください！"
+            result = app.find_similar_chatgpt_request_history(
+                request, past_time, mock.Mock()
+            )
+            self.assertEqual(result.get_response_message_content(), "10時からです。")  # type: ignore
+
+            # 会話履歴を含むリクエストには返さない
+            self.assertIsNone(
+                app.find_similar_chatgpt_request_history(
+                    request[:1]
+                    + [
+                        {"role": "user", "content": "こんにちは"},
+                        {"role": "assistant", "content": "こんにちは!"},
+                    ]
+                    + request[1:],
+                    past_time,
+                    mock.Mock(),
+                )
+            )
+
+
+class SaveConversationTurnTestCase(TestCase):
+    def test_save_conversation_turn_001(self):
+        # 同じ seq の受け答えが先に保存されていた場合は、最新の seq を読み直して保存し直す
+        db_client = mock.Mock()
+        db_client.exceptions.ConditionalCheckFailedException = type(
+            "ConditionalCheckFailedException", (Exception,), {}
+        )
+        db_client.put_item.side_effect = [
+            db_client.exceptions.ConditionalCheckFailedException(),
+            {},
+        ]
+        talk_room_history = TalkRoomHistory(
+            {
+                "talkRoomId": "R0123456789abcdef0123456789abcdef",
+                "userId": "U0123456789abcdef0123456789abcdef",
+                "textMessage": "Hi, ChatGPT!",
+                "createdAt": datetime.datetime.now().isoformat(),
+            },
+            db_client=db_client,
+        )
+        chatgpt = app.ChatGpt(
+            system_message="You are the ChatGPT.", text_message="Hi, ChatGPT!"
+        )
+        with mock.patch.object(
+            app.ConversationTurn, "get_latest_seq", side_effect=[4, 5]
+        ):
+            result = app.save_conversation_turn(talk_room_history, chatgpt, "Hello!")
+        self.assertEqual(result.seq, 6)  # type: ignore
+        self.assertEqual(result.userMessage, "Hi, ChatGPT!")  # type: ignore
+        self.assertEqual(result.assistantMessage, "Hello!")  # type: ignore
+        self.assertEqual(db_client.put_item.call_count, 2)
+
+    def test_save_cached_conversation_turn_001(self):
+        # キャッシュから応答した場合も、受け答えを ConversationTurn に追記する
+        chatgpt = app.ChatGpt(
+            system_message="You are the ChatGPT.", text_message="Hi, ChatGPT!"
+        )
+        history = ChatGptRequestHistory(
+            {
+                "talkRoomId": "R0123456789abcdef0123456789abcdef",
+                "userId": "U0123456789abcdef0123456789abcdef",
+                "requestId": "0" * 64,
+                "response": json.dumps(
+                    {"choices": [{"message": {"content": "Hello!"}}]}
+                ),
+                "createdAt": datetime.datetime.now().isoformat(),
+            },
+            db_client=mock.Mock(),
+        )
+        talk_room_history = mock.Mock()
+        with mock.patch.object(
+            app,
+            "prepare_text_message_event",
+            return_value=(talk_room_history, chatgpt, history),
+        ), mock.patch.object(app, "save_conversation_turn") as save, mock.patch.object(
+            app.ChatGpt, "send"
+        ) as send:
+            with mock.patch.object(app, "CONVERSATION_STORE", "turn_log"):
+                self.assertIs(app.process_text_message_event(mock.Mock()), history)
+                self.assertIs(
+                    asyncio.run(app.process_text_message_event_async(mock.Mock())),
+                    history,
+                )
+            self.assertEqual(
+                save.call_args_list,
+                [mock.call(talk_room_history, chatgpt, "Hello!")] * 2,
+            )
+            send.assert_not_called()
+
+            # 会話履歴をリクエスト履歴に保存する場合は追記しない
+            save.reset_mock()
+            with mock.patch.object(app, "CONVERSATION_STORE", "request_history"):
+                app.process_text_message_event(mock.Mock())
+            save.assert_not_called()
+
+
+class SummarizeConversationTestCase(TestCase):
+    def test_summarize_conversation_001(self):
+        # 新しい受け答えを残し、それより古い受け答えをそれまでの要約とあわせて要約する
+        db_client = mock.Mock()
+        talk_room_id = "R0123456789abcdef0123456789abcdef"
+        summary = app.ConversationSummary.create_instance(
+            talk_room_id, "Previous summary.", 2, db_client=db_client
+        )
+        turns = [
+            app.ConversationTurn.create_instance(
+                talk_room_id, "", seq, "Q%d" % seq, "A%d" % seq, db_client=db_client
+            )
+            for seq in (3, 4)
+        ]
+        with mock.patch.object(
+            app, "CONVERSATION_SUMMARY_KEEP_TURNS", 2
+        ), mock.patch.object(
+            app.ConversationSummary, "find", return_value=[summary]
+        ), mock.patch.object(
+            app.ConversationTurn, "get_latest_seq", return_value=6
+        ), mock.patch.object(
+            app.ConversationTurn, "find", return_value=turns
+        ) as find, mock.patch.object(
+            app.ChatGpt, "send", return_value=True
+        ), mock.patch.object(
+            app.ChatGpt, "get_response_message_content", return_value="New summary."
+        ):
+            result = app.summarize_conversation(talk_room_id, db_client)
+            query = find.call_args[0][0]
+            self.assertEqual(query["ExpressionAttributeValues"][":seq1"], {"N": "3"})
+            self.assertEqual(query["ExpressionAttributeValues"][":seq2"], {"N": "4"})
+        self.assertEqual(result.summary, "New summary.")  # type: ignore
+        self.assertEqual(result.lastSeq, 4)  # type: ignore
+        db_client.put_item.assert_called_once()
+
+        # 最大数を超える場合は、要約に含めた受け答えまでを要約済みにする
+        db_client.reset_mock()
+        with mock.patch.object(
+            app, "CONVERSATION_SUMMARY_KEEP_TURNS", 2
+        ), mock.patch.object(
+            app, "CONVERSATION_SUMMARY_MAX_TURNS", 1
+        ), mock.patch.object(
+            app.ConversationSummary, "find", return_value=[summary]
+        ), mock.patch.object(
+            app.ConversationTurn, "get_latest_seq", return_value=6
+        ), mock.patch.object(
+            app.ConversationTurn, "find", return_value=turns[:1]
+        ) as find, mock.patch.object(
+            app.ChatGpt, "send", return_value=True
+        ), mock.patch.object(
+            app.ChatGpt, "get_response_message_content", return_value="New summary."
+        ):
+            result = app.summarize_conversation(talk_room_id, db_client)
+            query = find.call_args[0][0]
+            self.assertTrue(query["ScanIndexForward"])
+            self.assertEqual(query["Limit"], 1)
+        self.assertEqual(result.lastSeq, 3)  # type: ignore
+
+        # 要約用のトークン数を確保した残りに収まる受け答えまでを要約済みにする
+        long_turns = [
+            app.ConversationTurn.create_instance(
+                talk_room_id, "", seq, "hello " * 100, "A", db_client=db_client
+            )
+            for seq in (3, 4, 5, 6)
+        ]
+        # 受け答え 2.5 件分のトークン数が残るように、要約用のトークン数を確保する
+        chatgpt = app.ChatGpt(
+            system_message=app.CONVERSATION_SUMMARY_SYSTEM_MESSAGE, completion_tokens=0
+        )
+        turn_tokens = (
+            chatgpt.count_tokens("user: " + "hello " * 100)
+            + chatgpt.count_tokens("assistant: A")
+            + 2
+        )
+        completion_tokens = (
+            chatgpt.max_tokens
+            - chatgpt.tokens
+            - chatgpt.count_tokens("Previous summary.")
+            - 1
+            - int(turn_tokens * 2.5)
+        )
+        sent = []
+        with mock.patch.object(
+            app, "CONVERSATION_SUMMARY_KEEP_TURNS", 2
+        ), mock.patch.object(
+            app, "CONVERSATION_SUMMARY_COMPLETION_TOKENS", completion_tokens
+        ), mock.patch.object(
+            app.ConversationSummary, "find", return_value=[summary]
+        ), mock.patch.object(
+            app.ConversationTurn, "get_latest_seq", return_value=8
+        ), mock.patch.object(
+            app.ConversationTurn, "find", return_value=long_turns
+        ), mock.patch.object(
+            app.ChatGpt,
+            "send",
+            autospec=True,
+            side_effect=lambda chatgpt, timeout: sent.append(chatgpt) or True,
+        ), mock.patch.object(
+            app.ChatGpt, "get_response_message_content", return_value="New summary."
+        ):
+            result = app.summarize_conversation(talk_room_id, db_client)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(result.lastSeq, 4)  # type: ignore
+        chatgpt = sent[0]
+        self.assertEqual(chatgpt.completion_tokens, completion_tokens)
+        self.assertEqual(chatgpt.request[1]["content"].count("hello"), 200)
+
+        # 要約する受け答えが無い場合は要約しない
+        with mock.patch.object(
+            app.ConversationSummary, "find", return_value=[summary]
+        ), mock.patch.object(app.ConversationTurn, "get_latest_seq", return_value=6):
+            self.assertIsNone(app.summarize_conversation(talk_room_id, db_client))
@@ -1,30 +1,13 @@
 import os
 import sys
 import json
+import base64
+import hashlib
+import hmac
 import logging
-import boto3
-import uuid
-from linebot import LineBotApi, WebhookHandler
-from linebot.models import (
-    FollowEvent,
-    UnfollowEvent,
-    MessageEvent,
-    PostbackEvent,
-    JoinEvent,
-    LeaveEvent,
-    MemberJoinedEvent,
-    MemberLeftEvent,
-    TextMessage,
-    TextSendMessage,
-    ImageMessage,
-    VideoMessage,
-    AudioMessage,
-    LocationMessage,
-    StickerMessage,
-    FileMessage,
-)
-from linebot.exceptions import LineBotApiError, InvalidSignatureError
+import time
 from common import utils
+from common.sqs_batch_sender import SqsBatchSender
 
 # ログ出力設定
 LOGGER_LEVEL = os.environ.get("LOGGER_LEVEL")
@@ -45,9 +28,110 @@ if channel_access_token is None:
 
 queue_url = os.environ.get("SQS_QUEUE_URL", "")
 
-line_bot_api = LineBotApi(channel_access_token)
-handler = WebhookHandler(channel_secret)
-sqs_client = boto3.client("sqs")
+# true の場合、LINEイベントを line-bot-sdk のオブジェクトに変換せず、受信したJSONのままSQSに通知する
+RAW_PASSTHROUGH = os.environ.get("WEBHOOK_RAW_PASSTHROUGH", "").lower() in (
+    "1",
+    "true",
+)
+
+# line-bot-sdk と boto3 は import に時間がかかるため、必要になるまで import しない
+# (python benchmarks/import_time.py でモジュールごとの import 時間を確認できる)
+line_bot_api = None
+sqs_sender = SqsBatchSender(queue_url)
+
+# LINEから再送されたイベントの件数(コンテナの起動以降)
+redelivered_event_count = 0
+
+# マスク後のID
+MASKED_ID = "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
+
+# Webhookのリクエストに含まれるイベントのtypeと、LINEイベントのクラスの対応表
+# (get_event_classes で初回に生成する)
+EVENT_CLASSES = {}
+
+# SQSに通知するLINEイベントと、イベント種別(event_type)の対応表
+# キーは (イベントのtype, メッセージのtype) で、メッセージイベント以外はメッセージのtypeを None とする
+EVENT_TYPES = {
+    ("message", "text"): "text_message",
+    ("message", "image"): "image_message",
+    ("message", "video"): "video_message",
+    ("message", "audio"): "audio_message",
+    ("message", "location"): "location_message",
+    ("message", "sticker"): "sticker_message",
+    ("message", "file"): "file_message",
+    ("follow", None): "follow",
+    ("unfollow", None): "unfollow",
+    ("join", None): "join",
+    ("leave", None): "leave",
+    ("memberJoined", None): "member_joined",
+    ("memberLeft", None): "member_left",
+}
+
+
+class InvalidSignatureError(Exception):
+    """
+    x-line-signatureの署名が正しくない
+    """
+
+
+class LineMessagingApiError(Exception):
+    """
+    LINE Messaging APIの呼び出しに失敗した
+    """
+
+
+def get_line_bot_api():
+    """
+    LineBotApi を返却する(初回呼び出し時に生成する)
+
+    Returns
+    -------
+    line_bot_api : linebot.LineBotApi
+        LineBotApi
+    """
+    global line_bot_api
+    if line_bot_api is None:
+        from linebot import LineBotApi
+
+        line_bot_api = LineBotApi(channel_access_token)
+    return line_bot_api
+
+
+def get_event_classes():
+    """
+    Webhookのリクエストに含まれるイベントのtypeと、LINEイベントのクラスの対応表を返却する
+    (初回呼び出し時に linebot.models を import する)
+
+    Returns
+    -------
+    event_classes : dict
+        イベントのtypeと、LINEイベントのクラスの対応表
+    """
+    if not EVENT_CLASSES:
+        from linebot.models import (
+            FollowEvent,
+            UnfollowEvent,
+            MessageEvent,
+            PostbackEvent,
+            JoinEvent,
+            LeaveEvent,
+            MemberJoinedEvent,
+            MemberLeftEvent,
+        )
+
+        EVENT_CLASSES.update(
+            {
+                "message": MessageEvent,
+                "follow": FollowEvent,
+                "unfollow": UnfollowEvent,
+                "join": JoinEvent,
+                "leave": LeaveEvent,
+                "postback": PostbackEvent,
+                "memberJoined": MemberJoinedEvent,
+                "memberLeft": MemberLeftEvent,
+            }
+        )
+    return EVENT_CLASSES
 
 
 def get_sigunature(key_search_dict):
@@ -70,414 +154,259 @@ def get_sigunature(key_search_dict):
             return signature
 
 
-def convert_user_id(event):
+def convert_user_id(event, body_json):
     """
-    LINE UserIdのマスク処理
+    LINE UserId/GroupId/RoomId、応答トークン、メッセージ本文のマスク処理
 
     Parameters
     ----------
     event : dict
         Webhookへのリクエスト内容。
+    body_json : dict
+        Webhookへのリクエストのbodyをパースしたもの(変更しない)
 
     Returns
     -------
     log_event : dict
-        UserIdマスク後のリクエスト内容。
+        UserId/GroupId/RoomId、応答トークン、メッセージ本文マスク後のリクエスト内容。
     """
-    log_body = json.loads(event["body"])
+    log_body = dict(body_json)
     update_body = []
-    for linebot_event in log_body["events"]:
-        linebot_event["source"]["userId"] = "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
+    for linebot_event in body_json.get("events", []):
+        linebot_event = dict(linebot_event)
+        if "replyToken" in linebot_event:
+            linebot_event["replyToken"] = MASKED_ID
+        message = linebot_event.get("message")
+        if isinstance(message, dict) and "text" in message:
+            linebot_event["message"] = dict(message, text=MASKED_ID)
+        if linebot_event.get("source"):
+            source = dict(linebot_event["source"])
+            for key in ("userId", "groupId", "roomId"):
+                if key in source:
+                    source[key] = MASKED_ID
+            linebot_event["source"] = source
         update_body.append(linebot_event)
-    del log_body["events"]
     log_body["events"] = update_body
-    log_event = event
+    log_event = dict(event)
     log_event["body"] = json.dumps(log_body, ensure_ascii=False)
 
     return log_event
 
 
-def get_fifo_message_group_id(line_event):
-    _line_event = line_event.as_json_dict()
-    if _line_event.get("source"):
-        user_id = _line_event["source"].get("userId", "")
-        group_id = _line_event["source"].get("groupId", "")
-        talk_room_id = _line_event["source"].get("roomId", "")
-        if not talk_room_id:
-            if group_id:
-                talk_room_id = group_id
-            elif user_id:
-                talk_room_id = user_id
-        return talk_room_id
-    return "line-bot-using-chatgpt"
-
-
-def get_fifo_message_deduplication_id():
-    return str(uuid.uuid4())
-
-
-@handler.add(PostbackEvent)
-def postback(line_event):
+class MaskedLogEvent:
     """
-    Webhookに送信されたLINEポストバックイベントについて処理を実施する
-
-    Parameters
-    ----------
-    line_event: dict
-        LINEポストバックイベント内容。
+    ログ出力時にだけマスク処理を行うためのラッパー
 
+    logger にそのまま渡すと、ログが実際に出力される場合のみ __str__ が呼ばれる。
     """
 
-    param_list = line_event.postback.data.split("&")
-    action = None
-    action_type = None
-    for param in param_list:
-        if param.split("=")[0] == "action":
-            action = param.split("=")[1]
-        elif param.split("=")[0] == "action_type":
-            action_type = param.split("=")[1]
-        elif param.split("=")[0] == "lang":
-            # TODO: setup the language
-            # language = param.split("=")[1]
-            pass
-
-    if action == "quick_reply":
-        if action_type == "yes":
-            line_bot_api.reply_message(
-                line_event.reply_token, TextSendMessage(text="YES is selected.")
-            )
-        else:
-            line_bot_api.reply_message(
-                line_event.reply_token, TextSendMessage(text="NO is selected.")
-            )
-    else:
-        logger.error("[ERROR]Detect an undefined action!")
+    def __init__(self, event, body_json):
+        self.event = event
+        self.body_json = body_json
 
+    def __str__(self):
+        return str(convert_user_id(self.event, self.body_json))
 
-@handler.add(MessageEvent, message=TextMessage)
-def text_message(line_event):
-    """
-    Webhookに送信されたLINEメッセージイベント(テキスト)について処理を実施する
-
-    Parameters
-    ----------
-    line_event : dict
-        LINEメッセージイベント内容。
 
+def verify_signature(body, signature):
     """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "text_message",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
-
+    x-line-signatureの署名を検証する
 
-@handler.add(MessageEvent, message=ImageMessage)
-def image_message(line_event):
-    """
-    Webhookに送信されたLINEメッセージイベント(画像)について処理を実施する
     Parameters
     ----------
-    line_event: dict
-        LINEメッセージイベント内容。
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "image_message",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
-
+    body : str
+        Webhookへのリクエストのbody
+    signature : str
+        LINE Botの署名
 
-@handler.add(MessageEvent, message=VideoMessage)
-def video_message(line_event):
-    """
-    Webhookに送信されたLINEメッセージイベント(動画)について処理を実施する
-    Parameters
-    ----------
-    line_event: dict
-        LINEメッセージイベント内容。
+    Returns
+    -------
+    result : bool
+        署名が正しい場合は True
     """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "video_message",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    if not signature:
+        return False
+    digest = hmac.new(
+        channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256
+    ).digest()
+    return hmac.compare_digest(signature.encode("utf-8"), base64.b64encode(digest))
 
 
-@handler.add(MessageEvent, message=AudioMessage)
-def audio_message(line_event):
+def get_event_type(event_json):
     """
-    Webhookに送信されたLINEメッセージイベント(音声)について処理を実施する
-    Parameters
-    ----------
-    line_event: dict
-        LINEメッセージイベント内容。
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "audio_message",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    LINEイベントに対応するSQS通知用のイベント種別を返却する
 
-
-@handler.add(MessageEvent, message=LocationMessage)
-def location_message(line_event):
-    """
-    Webhookに送信されたLINEメッセージイベント(位置情報)について処理を実施する
     Parameters
     ----------
-    line_event: dict
-        LINEメッセージイベント内容。
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "location_message",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    event_json : dict
+        Webhookへのリクエストに含まれるLINEイベント(パース済みのJSON)
 
-
-@handler.add(MessageEvent, message=StickerMessage)
-def sticker_message(line_event):
-    """
-    Webhookに送信されたLINEメッセージイベント(スタンプ)について処理を実施する
-    Parameters
-    ----------
-    line_event: dict
-        LINEメッセージイベント内容。
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "sticker_message",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    Returns
+    -------
+    event_type : str or None
+        イベント種別。EVENT_TYPES に無いイベントの場合は None
+    """
+    if event_json.get("type") == "message":
+        message = event_json.get("message")
+        if not isinstance(message, dict):
+            # 形式が不正なメッセージイベントは未対応のイベントとして扱う
+            return None
+        return EVENT_TYPES.get(("message", message.get("type")))
+    return EVENT_TYPES.get((event_json.get("type"), None))
+
+
+def get_fifo_message_group_id(line_event_dict):
+    if line_event_dict.get("source"):
+        user_id = line_event_dict["source"].get("userId", "")
+        group_id = line_event_dict["source"].get("groupId", "")
+        talk_room_id = line_event_dict["source"].get("roomId", "")
+        if not talk_room_id:
+            if group_id:
+                talk_room_id = group_id
+            elif user_id:
+                talk_room_id = user_id
+        return talk_room_id
+    return "line-bot-using-chatgpt"
 
 
-@handler.add(MessageEvent, message=FileMessage)
-def file_message(line_event):
+def get_fifo_message_deduplication_id(line_event_dict):
     """
-    Webhookに送信されたLINEメッセージイベント(ファイル)について処理を実施する
-    Parameters
-    ----------
-    line_event: dict
-        LINEメッセージイベント内容。
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "file_message",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    FIFOキューの重複排除IDを返却する
 
-
-@handler.add(FollowEvent)
-def follow(line_event):
-    """
-    Webhookに送信されたLINEフォローイベントについて処理を実施する
+    LINEが再送したイベント(deliveryContext.isRedelivery)も同じIDになるため、
+    重複排除期間(5分)内の再送はSQSで破棄される。
 
     Parameters
     ----------
-    line_event: dict
-        LINEフォローイベント内容。
+    line_event_dict : dict
+        LINEイベント内容。
 
+    Returns
+    -------
+    deduplication_id : str
+        webhookEventId。無い場合は再送ごとに変わる deliveryContext を除いた内容のハッシュ値
     """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "follow",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    webhook_event_id = line_event_dict.get("webhookEventId")
+    if webhook_event_id:
+        return webhook_event_id
+    content = {k: v for k, v in line_event_dict.items() if k != "deliveryContext"}
+    return hashlib.sha256(
+        json.dumps(content, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
 
 
-@handler.add(UnfollowEvent)
-def unfollow(line_event):
+def postback(line_event):
     """
-    Webhookに送信されたLINEフォロー解除イベントについて処理を実施する
+    Webhookに送信されたLINEポストバックイベントについて処理を実施する
 
     Parameters
     ----------
     line_event: dict
-        LINEフォロー解除イベント内容。
-
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "unfollow",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
-
+        LINEポストバックイベント内容。
 
-@handler.add(JoinEvent)
-def join(line_event):
     """
-    Webhookに送信されたLINE参加イベントについて処理を実施する
 
-    Parameters
-    ----------
-    line_event: dict
-        LINE参加イベント内容。
+    param_list = line_event.postback.data.split("&")
+    action = None
+    action_type = None
+    for param in param_list:
+        if param.split("=")[0] == "action":
+            action = param.split("=")[1]
+        elif param.split("=")[0] == "action_type":
+            action_type = param.split("=")[1]
+        elif param.split("=")[0] == "lang":
+            # TODO: setup the language
+            # language = param.split("=")[1]
+            pass
 
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "join",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    if action == "quick_reply":
+        from linebot.models import TextSendMessage
+        from linebot.exceptions import LineBotApiError
+
+        try:
+            if action_type == "yes":
+                get_line_bot_api().reply_message(
+                    line_event.reply_token, TextSendMessage(text="YES is selected.")
+                )
+            else:
+                get_line_bot_api().reply_message(
+                    line_event.reply_token, TextSendMessage(text="NO is selected.")
+                )
+        except LineBotApiError as e:
+            raise LineMessagingApiError(e.message) from e
+    else:
+        logger.error("[ERROR]Detect an undefined action!")
 
 
-@handler.add(LeaveEvent)
-def leave(line_event):
+def enqueue_event(event_type, line_event_dict):
     """
-    Webhookに送信されたLINE退出イベントについて処理を実施する
+    LINEイベントをSQSへの送信待ちに追加する
+    (lambda_handler でまとめて送信する)
 
     Parameters
     ----------
-    line_event: dict
-        LINE退出イベント内容。
-
-    """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
+    event_type : str
+        イベント種別
+    line_event_dict : dict
+        LINEイベント内容。
+
+    """
+    global redelivered_event_count
+    if line_event_dict.get("deliveryContext", {}).get("isRedelivery"):
+        # 重複排除期間内であれば、同じ重複排除IDのメッセージはSQSで破棄される
+        redelivered_event_count += 1
+        logger.info(
+            "Received a redelivered event: %s (%d redelivered in total)",
+            line_event_dict.get("webhookEventId"),
+            redelivered_event_count,
+        )
+    sqs_sender.add(
+        json.dumps(
             {
-                "event_type": "leave",
-                "line_event": line_event.as_json_dict(),
+                "event_type": event_type,
+                "line_event": line_event_dict,
             },
             ensure_ascii=False,
         ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
+        get_fifo_message_group_id(line_event_dict),
+        get_fifo_message_deduplication_id(line_event_dict),
     )
 
 
-@handler.add(MemberJoinedEvent)
-def member_joined(line_event):
-    """
-    Webhookに送信されたLINEメンバー参加イベントについて処理を実施する
-
-    Parameters
-    ----------
-    line_event: dict
-        LINEメンバー参加イベント内容。
-
+def handle(body, body_json, signature):
     """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "member_joined",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    署名を検証し、パース済みのbodyに含まれるLINEイベントを処理する
+    (WebhookHandler.handle と異なり、bodyを再度パースしない)
 
-
-@handler.add(MemberLeftEvent)
-def member_left(line_event):
-    """
-    Webhookに送信されたLINEメンバー退出イベントについて処理を実施する
+    RAW_PASSTHROUGH が有効な場合は、ポストバックイベント以外のLINEイベントを
+    line-bot-sdk のオブジェクトに変換せず、受信したJSONのままSQSに通知する。
 
     Parameters
     ----------
-    line_event: dict
-        LINEメンバー退出イベント内容。
-
+    body : str
+        Webhookへのリクエストのbody(署名の検証に使う)
+    body_json : dict
+        Webhookへのリクエストのbodyをパースしたもの
+    signature : str
+        LINE Botの署名
     """
-    # SQSにメッセージを通知
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(
-            {
-                "event_type": "member_left",
-                "line_event": line_event.as_json_dict(),
-            },
-            ensure_ascii=False,
-        ),
-        MessageGroupId=get_fifo_message_group_id(line_event),
-        MessageDeduplicationId=get_fifo_message_deduplication_id(),
-    )
+    if not verify_signature(body, signature):
+        raise InvalidSignatureError("Invalid signature. signature=%s" % signature)
+    for event_json in body_json.get("events", []):
+        if event_json.get("type") == "postback":
+            postback(get_event_classes()["postback"].new_from_json_dict(event_json))
+            continue
+        event_type = get_event_type(event_json)
+        if event_type is None:
+            logger.info("Ignore an unsupported event type: %s", event_json.get("type"))
+            continue
+        if RAW_PASSTHROUGH:
+            enqueue_event(event_type, event_json)
+        else:
+            line_event = get_event_classes()[event_json["type"]].new_from_json_dict(
+                event_json
+            )
+            enqueue_event(event_type, line_event.as_json_dict())
 
 
 def lambda_handler(event, context):
@@ -496,26 +425,49 @@ def lambda_handler(event, context):
     Response : dict
         Webhookへのレスポンス内容。
     """
-    log_event = event.copy()
-    logger.info(convert_user_id(log_event))
-    signature = get_sigunature(event["headers"])
-    body = event["body"]
     error_json = utils.create_error_response("Error")
     error_json["isBase64Encoded"] = False
+    body = event["body"]
+    try:
+        body_json = json.loads(body)
+    except ValueError:
+        logger.error("Failed to parse the request body", exc_info=True)
+        return error_json
+    logger.info("%s", MaskedLogEvent(event, body_json))
+    signature = get_sigunature(event["headers"])
 
+    dispatch_start = time.perf_counter()
     try:
-        handler.handle(body, signature)
-    except LineBotApiError as e:
-        logger.error(
-            "Got exception from LINE Messaging API: %s\n" % e.message, exc_info=True
-        )
+        handle(body, body_json, signature)
+    except LineMessagingApiError as e:
+        logger.error("Got exception from LINE Messaging API: %s\n", e, exc_info=True)
+        # 例外発生前に処理したイベントは送信する
+        failed_entries = sqs_sender.flush()
+        if failed_entries:
+            logger.error(
+                "Failed to send %d event(s) to SQS: %s",
+                len(failed_entries),
+                [entry["MessageDeduplicationId"] for entry in failed_entries],
+            )
         return error_json
     except InvalidSignatureError as e:
-        logger.error(
-            "Got exception from LINE Messaging API: %s\n" % e.message, exc_info=True
-        )
+        logger.error("Got exception from LINE Messaging API: %s\n", e, exc_info=True)
+        sqs_sender.clear()
         return error_json
     else:
+        logger.debug(
+            "Dispatched %d event(s) in %.3f ms",
+            len(sqs_sender),
+            (time.perf_counter() - dispatch_start) * 1000,
+        )
+        # 1回のリクエストに含まれるイベントをまとめてSQSに通知
+        failed_entries = sqs_sender.flush()
+        if failed_entries:
+            logger.error("Failed to send %d event(s) to SQS", len(failed_entries))
+            return error_json
         ok_json = utils.create_success_response(json.dumps("Success"))
         ok_json["isBase64Encoded"] = False
         return ok_json
+    finally:
+        # 予期しない例外で中断した場合も、送信待ちのイベントを次の呼び出しに持ち越さない
+        sqs_sender.clear()
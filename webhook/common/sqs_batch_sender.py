@@ -0,0 +1,202 @@
+"""
+SQSへのバッチ送信
+"""
+
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+
+class SqsBatchSender:
+    """
+    1回のWebhookリクエストで受け取ったイベントをまとめてSQSに送信する
+
+    send_message_batch は1回の呼び出しで最大10件まで送信できるため、
+    add() で溜めたメッセージを flush() で10件ずつ送信し、
+    送信に失敗したメッセージのみを再送する。
+
+    また、重複排除期間内に送信済みの重複排除IDを持つメッセージは、
+    SQSに送信せずに破棄し、その件数を suppressed_count に数える。
+    """
+
+    MAX_BATCH_SIZE = 10
+
+    # SQS FIFOキューの重複排除期間(秒)
+    DEDUPLICATION_INTERVAL_SEC = 300
+
+    # 記憶しておく送信済みの重複排除IDの最大数
+    MAX_SENT_IDS = 10000
+
+    def __init__(self, queue_url, sqs_client=None, max_retries=3, retry_interval=0.05):
+        """
+        Parameters
+        ----------
+        queue_url : str
+            送信先のSQSキューのURL
+        sqs_client : botocore.client.SQS
+            SQSクライアント(省略した場合は最初の送信時に生成する)
+        max_retries : int
+            送信に失敗したメッセージを再送する最大回数
+        retry_interval : float
+            再送前の待機秒数(再送のたびに2倍にする)
+        """
+        self.queue_url = queue_url
+        self._sqs_client = sqs_client
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self._entries = []
+        self._pending_ids = set()
+        self._sent_ids = OrderedDict()
+        self.suppressed_count = 0
+
+    @property
+    def sqs_client(self):
+        """
+        SQSクライアント
+
+        boto3 の import とクライアントの生成はコールドスタート時間の大部分を占めるため、
+        実際に送信するまで遅延させる。
+        """
+        if self._sqs_client is None:
+            import boto3
+
+            self._sqs_client = boto3.client("sqs")
+        return self._sqs_client
+
+    @sqs_client.setter
+    def sqs_client(self, sqs_client):
+        self._sqs_client = sqs_client
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, message_body, message_group_id, message_deduplication_id):
+        """
+        送信するメッセージを追加する
+
+        Parameters
+        ----------
+        message_body : str
+            メッセージ本文
+        message_group_id : str
+            FIFOキューのメッセージグループID
+        message_deduplication_id : str
+            FIFOキューの重複排除ID
+
+        Returns
+        -------
+        added : bool
+            重複したメッセージとして破棄した場合は False
+        """
+        self._expire_sent_ids()
+        if (
+            message_deduplication_id in self._pending_ids
+            or message_deduplication_id in self._sent_ids
+        ):
+            self.suppressed_count += 1
+            logger.info(
+                "Suppressed a duplicate message: %s (%d suppressed in total)",
+                message_deduplication_id,
+                self.suppressed_count,
+            )
+            return False
+        self._pending_ids.add(message_deduplication_id)
+        self._entries.append(
+            {
+                "Id": str(len(self._entries)),
+                "MessageBody": message_body,
+                "MessageGroupId": message_group_id,
+                "MessageDeduplicationId": message_deduplication_id,
+            }
+        )
+        return True
+
+    def clear(self):
+        """
+        送信待ちのメッセージを破棄する
+        """
+        self._entries = []
+        self._pending_ids = set()
+
+    def flush(self):
+        """
+        送信待ちのメッセージを10件ずつ送信する
+
+        Returns
+        -------
+        failed_entries : list
+            再送しても送信できなかったメッセージ
+        """
+        entries = self._entries
+        self.clear()
+        failed_entries = []
+        for i in range(0, len(entries), self.MAX_BATCH_SIZE):
+            failed_entries.extend(
+                self._send_with_retry(entries[i : i + self.MAX_BATCH_SIZE])
+            )
+        # 送信に失敗したメッセージは再送を受け付けるため、送信済みとして記憶しない
+        failed_ids = {entry["MessageDeduplicationId"] for entry in failed_entries}
+        now = time.monotonic()
+        for entry in entries:
+            if entry["MessageDeduplicationId"] not in failed_ids:
+                self._sent_ids[entry["MessageDeduplicationId"]] = now
+                self._sent_ids.move_to_end(entry["MessageDeduplicationId"])
+        while len(self._sent_ids) > self.MAX_SENT_IDS:
+            self._sent_ids.popitem(last=False)
+        return failed_entries
+
+    def _expire_sent_ids(self):
+        """
+        重複排除期間を過ぎた送信済みの重複排除IDを破棄する
+        """
+        expired_at = time.monotonic() - self.DEDUPLICATION_INTERVAL_SEC
+        while self._sent_ids:
+            deduplication_id, sent_at = next(iter(self._sent_ids.items()))
+            if sent_at > expired_at:
+                break
+            del self._sent_ids[deduplication_id]
+
+    def _send_with_retry(self, entries):
+        """
+        send_message_batch を実行し、失敗したメッセージのみを再送する
+
+        Parameters
+        ----------
+        entries : list
+            送信するメッセージ(最大10件)
+
+        Returns
+        -------
+        failed_entries : list
+            再送しても送信できなかったメッセージ
+        """
+        failed_entries = []
+        interval = self.retry_interval
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(interval)
+                interval *= 2
+            try:
+                response = self.sqs_client.send_message_batch(
+                    QueueUrl=self.queue_url, Entries=entries
+                )
+            except Exception:
+                logger.warning("Failed to call send_message_batch", exc_info=True)
+                continue
+            entries_by_id = {entry["Id"]: entry for entry in entries}
+            retry_entries = []
+            for failure in response.get("Failed", []):
+                entry = entries_by_id[failure["Id"]]
+                if failure.get("SenderFault"):
+                    # リクエスト内容に問題がある場合は再送しても成功しないため諦める
+                    logger.error("Failed to send a message to SQS: %s", failure)
+                    failed_entries.append(entry)
+                else:
+                    retry_entries.append(entry)
+            entries = retry_entries
+            if not entries:
+                return failed_entries
+        logger.error("Gave up sending %d message(s) to SQS", len(entries))
+        return failed_entries + entries
@@ -0,0 +1,104 @@
+import time
+from unittest import TestCase, mock
+from common.sqs_batch_sender import SqsBatchSender
+
+
+class SqsBatchSenderTestCase(TestCase):
+    def setUp(self):
+        self.sqs_client = mock.Mock()
+        self.sqs_client.send_message_batch.return_value = {"Failed": []}
+        self.sender = SqsBatchSender(
+            "https://sqs.example/queue.fifo", self.sqs_client, retry_interval=0
+        )
+
+    def add(self, count, start=0):
+        for i in range(start, start + count):
+            self.assertTrue(self.sender.add("body%d" % i, "group", "dedup%d" % i))
+
+    def test_flush_001(self):
+        # 10件ずつ送信する
+        self.add(23)
+        self.assertEqual(len(self.sender), 23)
+        self.assertEqual(self.sender.flush(), [])
+        self.assertEqual(
+            [
+                len(c.kwargs["Entries"])
+                for c in self.sqs_client.send_message_batch.call_args_list
+            ],
+            [10, 10, 3],
+        )
+        self.assertEqual(len(self.sender), 0)
+
+    def test_flush_002(self):
+        # 失敗したメッセージのみを再送する
+        self.add(3)
+        self.sqs_client.send_message_batch.side_effect = [
+            {"Failed": [{"Id": "1", "SenderFault": False, "Code": "InternalError"}]},
+            {"Failed": []},
+        ]
+        self.assertEqual(self.sender.flush(), [])
+        calls = self.sqs_client.send_message_batch.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            [entry["MessageDeduplicationId"] for entry in calls[1].kwargs["Entries"]],
+            ["dedup1"],
+        )
+
+    def test_flush_003(self):
+        # SenderFault の失敗は再送せずに返す
+        self.add(2)
+        self.sqs_client.send_message_batch.return_value = {
+            "Failed": [
+                {"Id": "0", "SenderFault": True, "Code": "InvalidParameterValue"}
+            ]
+        }
+        failed_entries = self.sender.flush()
+        self.assertEqual(self.sqs_client.send_message_batch.call_count, 1)
+        self.assertEqual(
+            [entry["MessageDeduplicationId"] for entry in failed_entries], ["dedup0"]
+        )
+
+        # 送信できなかったメッセージは重複として破棄しない
+        self.assertTrue(self.sender.add("body0", "group", "dedup0"))
+        self.assertFalse(self.sender.add("body1", "group", "dedup1"))
+
+    def test_flush_004(self):
+        # 再送の回数を超えたメッセージを返す(再送のたびに待機秒数を2倍にする)
+        sender = SqsBatchSender(
+            "https://sqs.example/queue.fifo",
+            self.sqs_client,
+            max_retries=2,
+            retry_interval=0.01,
+        )
+        sender.add("body", "group", "dedup")
+        self.sqs_client.send_message_batch.return_value = {
+            "Failed": [{"Id": "0", "SenderFault": False}]
+        }
+        with mock.patch("common.sqs_batch_sender.time.sleep") as sleep:
+            self.assertEqual(len(sender.flush()), 1)
+        self.assertEqual(self.sqs_client.send_message_batch.call_count, 3)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.01, 0.02])
+
+    def test_add_001(self):
+        # 送信待ちと送信済みの重複排除IDのメッセージは破棄する
+        self.add(1)
+        self.assertFalse(self.sender.add("body0", "group", "dedup0"))
+        self.sender.flush()
+        self.assertFalse(self.sender.add("body0", "group", "dedup0"))
+        self.assertEqual(self.sender.suppressed_count, 2)
+        self.assertEqual(len(self.sender), 0)
+
+        # 重複排除期間を過ぎた重複排除IDは受け付ける
+        expired_at = time.monotonic() + SqsBatchSender.DEDUPLICATION_INTERVAL_SEC + 1
+        with mock.patch(
+            "common.sqs_batch_sender.time.monotonic", return_value=expired_at
+        ):
+            self.assertTrue(self.sender.add("body0", "group", "dedup0"))
+
+    def test_add_002(self):
+        # 記憶する送信済みの重複排除IDの数には上限がある
+        with mock.patch.object(SqsBatchSender, "MAX_SENT_IDS", 2):
+            self.add(3)
+            self.sender.flush()
+            self.assertTrue(self.sender.add("body0", "group", "dedup0"))
+            self.assertFalse(self.sender.add("body2", "group", "dedup2"))
@@ -0,0 +1,183 @@
+import os
+import json
+import base64
+import hashlib
+import hmac
+from unittest import TestCase, mock
+
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-channel-secret")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-channel-access-token")
+import app  # noqa: E402
+
+
+class LambdaHandlerTestCase(TestCase):
+    def setUp(self):
+        self.sqs_client = mock.Mock()
+        self.sqs_client.send_message_batch.return_value = {"Failed": []}
+        app.sqs_sender.sqs_client = self.sqs_client
+        app.sqs_sender.retry_interval = 0
+        app.sqs_sender.clear()
+
+    def create_event(self, *line_events):
+        body = json.dumps({"destination": "U0", "events": list(line_events)})
+        digest = hmac.new(
+            app.channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256
+        ).digest()
+        return {
+            "headers": {"X-Line-Signature": base64.b64encode(digest).decode("utf-8")},
+            "body": body,
+        }
+
+    def create_line_event(self, webhook_event_id, message):
+        return {
+            "type": "message",
+            "webhookEventId": webhook_event_id,
+            "source": {"type": "user", "userId": "U0123456789abcdef0123456789abcdef"},
+            "message": message,
+        }
+
+    @mock.patch("app.RAW_PASSTHROUGH", True)
+    def test_lambda_handler_001(self):
+        event = self.create_event(
+            self.create_line_event("01A", {"type": "text", "text": "Hi"}),
+            self.create_line_event("01B", {"type": "text", "text": "Hello"}),
+        )
+        self.assertEqual(app.lambda_handler(event, None)["statusCode"], 200)
+        entries = self.sqs_client.send_message_batch.call_args.kwargs["Entries"]
+        self.assertEqual(
+            [entry["MessageDeduplicationId"] for entry in entries], ["01A", "01B"]
+        )
+
+        # 署名が正しくない場合は送信しない
+        self.sqs_client.send_message_batch.reset_mock()
+        event["headers"]["X-Line-Signature"] = "invalid"
+        self.assertNotEqual(app.lambda_handler(event, None)["statusCode"], 200)
+        self.sqs_client.send_message_batch.assert_not_called()
+
+    @mock.patch("app.RAW_PASSTHROUGH", True)
+    def test_lambda_handler_002(self):
+        # 形式が不正なイベントは未対応のイベントとして無視する
+        event = self.create_event(
+            self.create_line_event("02A", {"type": "text", "text": "Hi"}),
+            self.create_line_event("02B", "invalid"),
+            self.create_line_event("02C", {"type": "text", "text": "Hello"}),
+        )
+        with self.assertLogs(app.logger, "INFO") as logs:
+            self.assertEqual(app.lambda_handler(event, None)["statusCode"], 200)
+        self.assertIn(
+            "Ignore an unsupported event type: message", "\n".join(logs.output)
+        )
+        entries = self.sqs_client.send_message_batch.call_args.kwargs["Entries"]
+        self.assertEqual(
+            [entry["MessageDeduplicationId"] for entry in entries], ["02A", "02C"]
+        )
+
+    @mock.patch("app.RAW_PASSTHROUGH", True)
+    def test_lambda_handler_003(self):
+        # 予期しない例外で中断したリクエストのイベントを、次のリクエストで送信しない
+        event = self.create_event(
+            self.create_line_event("03A", {"type": "text", "text": "Hi"}),
+            self.create_line_event("03B", {"type": "text", "text": "Hello"}),
+        )
+        with mock.patch(
+            "app.get_event_type", side_effect=["text_message", RuntimeError()]
+        ):
+            with self.assertRaises(RuntimeError):
+                app.lambda_handler(event, None)
+        self.assertEqual(len(app.sqs_sender), 0)
+
+        event = self.create_event(
+            self.create_line_event("03C", {"type": "text", "text": "Hello"})
+        )
+        self.assertEqual(app.lambda_handler(event, None)["statusCode"], 200)
+        entries = self.sqs_client.send_message_batch.call_args.kwargs["Entries"]
+        self.assertEqual(
+            [entry["MessageDeduplicationId"] for entry in entries], ["03C"]
+        )
+
+    @mock.patch("app.RAW_PASSTHROUGH", False)
+    def test_lambda_handler_004(self):
+        # line-bot-sdk でパースしたイベントを送信する
+        event = self.create_event(
+            self.create_line_event("04A", {"id": "1", "type": "text", "text": "Hi"}),
+            {
+                "type": "follow",
+                "webhookEventId": "04B",
+                "timestamp": 0,
+                "mode": "active",
+                "replyToken": "reply-token",
+                "source": {"type": "user", "userId": "U0"},
+            },
+        )
+        self.assertEqual(app.lambda_handler(event, None)["statusCode"], 200)
+        entries = self.sqs_client.send_message_batch.call_args.kwargs["Entries"]
+        self.assertEqual(
+            [entry["MessageDeduplicationId"] for entry in entries], ["04A", "04B"]
+        )
+        bodies = [json.loads(entry["MessageBody"]) for entry in entries]
+        self.assertEqual(
+            [body["event_type"] for body in bodies], ["text_message", "follow"]
+        )
+        self.assertEqual(bodies[0]["line_event"]["message"]["text"], "Hi")
+        self.assertEqual(bodies[1]["line_event"]["replyToken"], "reply-token")
+
+    def test_lambda_handler_005(self):
+        # ポストバックイベントはSQSに送信せず、その場で応答する
+        line_bot_api = mock.Mock()
+        event = self.create_event(
+            {
+                "type": "postback",
+                "webhookEventId": "05A",
+                "timestamp": 0,
+                "mode": "active",
+                "replyToken": "reply-token",
+                "source": {"type": "user", "userId": "U0"},
+                "postback": {"data": "action=quick_reply&action_type=yes"},
+            }
+        )
+        with mock.patch("app.get_line_bot_api", return_value=line_bot_api):
+            self.assertEqual(app.lambda_handler(event, None)["statusCode"], 200)
+        reply_token, message = line_bot_api.reply_message.call_args.args
+        self.assertEqual(reply_token, "reply-token")
+        self.assertEqual(message.text, "YES is selected.")
+        self.sqs_client.send_message_batch.assert_not_called()
+
+    def test_masked_log_event_001(self):
+        user_id = "U0123456789abcdef0123456789abcdef"
+        line_event = dict(
+            self.create_line_event("M01", {"type": "text", "text": "secret text"}),
+            replyToken="secret-reply-token",
+        )
+        event = self.create_event(line_event)
+        body_json = json.loads(event["body"])
+        with self.assertLogs(app.logger, "INFO") as logs:
+            app.logger.info("%s", app.MaskedLogEvent(event, body_json))
+        output = "\n".join(logs.output)
+        self.assertIn(app.MASKED_ID, output)
+        for raw in (user_id, "secret-reply-token", "secret text"):
+            self.assertNotIn(raw, output)
+
+        # マスク処理はパース済みのbodyとリクエスト内容を変更しない
+        self.assertEqual(body_json["events"][0], line_event)
+        self.assertIn(user_id, event["body"])
+
+    def test_get_fifo_message_deduplication_id_001(self):
+        line_event = self.create_line_event(None, {"type": "text", "text": "Hi"})
+        del line_event["webhookEventId"]
+        deduplication_id = app.get_fifo_message_deduplication_id(line_event)
+
+        # 同じ内容のイベントは再送(deliveryContext)でも同じID
+        redelivered = dict(line_event, deliveryContext={"isRedelivery": True})
+        self.assertEqual(
+            app.get_fifo_message_deduplication_id(dict(line_event)), deduplication_id
+        )
+        self.assertEqual(
+            app.get_fifo_message_deduplication_id(redelivered), deduplication_id
+        )
+
+        # 内容が異なるイベントは異なるID
+        other = self.create_line_event(None, {"type": "text", "text": "Hello"})
+        del other["webhookEventId"]
+        self.assertNotEqual(
+            app.get_fifo_message_deduplication_id(other), deduplication_id
+        )